@@ -3,8 +3,13 @@ Panel de Administración para CRM Autocares David
 Gestión de usuarios, invitaciones y permisos
 """
 import streamlit as st
-from supabase_client import get_supabase, get_admin_client
-from datetime import datetime, timedelta
+from supabase_client import get_supabase, get_admin_client, paginar_keyset
+from cola_escritura import obtener_cola, ahora_iso
+from auth import invalidar_sesiones_usuario
+from permisos import obtener_matriz_permisos, guardar_permisos_usuario, PERMISO_POR_DEFECTO
+from resumen_accesos import obtener_resumen_accesos, totales_por, truncar_periodo
+from datetime import datetime, timedelta, timezone
+import pandas as pd
 
 
 # Secciones disponibles en el CRM
@@ -21,6 +26,45 @@ SECCIONES = [
     'Configuracion'
 ]
 
+# Filas por página en las listas con "Cargar más"
+TAMANO_PAGINA = 50
+
+# Periodos de la gráfica de actividad: etiqueta -> (granularidad del resumen, ventana)
+PERIODOS_ACTIVIDAD = {
+    "Últimas 48 horas": ('hora', timedelta(hours=48)),
+    "Últimos 30 días": ('dia', timedelta(days=30)),
+    "Últimos 90 días": ('dia', timedelta(days=90)),
+}
+
+
+def _lista_paginada(clave: str, cargar_pagina) -> list:
+    """
+    Acumula en session_state las páginas ya cargadas de una lista.
+    cargar_pagina(cursor) debe devolver el resultado de paginar_keyset.
+    Retorna las filas acumuladas; pintar _boton_cargar_mas(clave, ...) tras la lista.
+    """
+    if clave not in st.session_state:
+        pagina = cargar_pagina(None)
+        st.session_state[clave] = {'filas': pagina['filas'], 'cursor': pagina['cursor']}
+    return st.session_state[clave]['filas']
+
+
+def _boton_cargar_mas(clave: str, cargar_pagina):
+    """Muestra el botón "Cargar más" si quedan páginas por cargar."""
+    estado = st.session_state.get(clave)
+    if not estado or not estado['cursor']:
+        return
+    if st.button("⬇️ Cargar más", key=f"mas_{clave}"):
+        pagina = cargar_pagina(estado['cursor'])
+        estado['filas'].extend(pagina['filas'])
+        estado['cursor'] = pagina['cursor']
+        st.rerun()
+
+
+def _reiniciar_lista(clave: str):
+    """Descarta las páginas cargadas para volver a leer desde el principio."""
+    st.session_state.pop(clave, None)
+
 
 def panel_admin():
     """Panel principal de administración"""
@@ -51,14 +95,19 @@ def gestionar_usuarios():
     st.subheader("Gestión de Usuarios")
 
     admin_client = get_admin_client()
-    usuarios = admin_client.table('usuarios').select('*').order('fecha_registro', desc=True).execute()
 
-    if not usuarios.data:
+    def cargar_pagina(cursor):
+        return paginar_keyset(lambda: admin_client.table('usuarios').select('*'), TAMANO_PAGINA, cursor,
+                              columna_fecha='fecha_registro')
+
+    usuarios = _lista_paginada('admin_usuarios', cargar_pagina)
+
+    if not usuarios:
         st.info("No hay usuarios registrados.")
         return
 
     # Mostrar usuarios en tabla
-    for user in usuarios.data:
+    for user in usuarios:
         with st.container():
             col1, col2, col3, col4, col5 = st.columns([3, 2, 2, 2, 2])
 
@@ -86,6 +135,8 @@ def gestionar_usuarios():
                     btn_label = "Hacer Usuario" if user['rol'] == 'admin' else "Hacer Admin"
                     if st.button(btn_label, key=f"rol_{user['id']}", type="secondary"):
                         admin_client.table('usuarios').update({'rol': nuevo_rol}).eq('id', user['id']).execute()
+                        invalidar_sesiones_usuario(user['id'])
+                        _reiniciar_lista('admin_usuarios')
                         st.success(f"Rol cambiado a {nuevo_rol}")
                         st.rerun()
 
@@ -95,14 +146,20 @@ def gestionar_usuarios():
                     if user['activo']:
                         if st.button("Desactivar", key=f"deact_{user['id']}", type="secondary"):
                             admin_client.table('usuarios').update({'activo': False}).eq('id', user['id']).execute()
+                            invalidar_sesiones_usuario(user['id'])
+                            _reiniciar_lista('admin_usuarios')
                             st.rerun()
                     else:
                         if st.button("Activar", key=f"act_{user['id']}", type="primary"):
                             admin_client.table('usuarios').update({'activo': True}).eq('id', user['id']).execute()
+                            invalidar_sesiones_usuario(user['id'])
+                            _reiniciar_lista('admin_usuarios')
                             st.rerun()
 
             st.divider()
 
+    _boton_cargar_mas('admin_usuarios', cargar_pagina)
+
 
 def gestionar_invitaciones():
     """Crear y gestionar invitaciones"""
@@ -265,6 +322,19 @@ def gestionar_permisos():
         st.info("No hay usuarios activos para configurar permisos.")
         return
 
+    matriz = obtener_matriz_permisos()
+
+    # Vista general: todos los usuarios activos × secciones, desde la misma matriz
+    with st.expander("📋 Vista general de permisos"):
+        filas = []
+        for u in usuarios.data:
+            fila = {'Usuario': u['nombre'] or u['email']}
+            for seccion in SECCIONES:
+                p = matriz.get(u['id'], {}).get(seccion, PERMISO_POR_DEFECTO)
+                fila[seccion] = ('✏️' if p['editar'] else '👁️') if p['ver'] else '—'
+            filas.append(fila)
+        st.dataframe(filas, use_container_width=True, hide_index=True)
+
     # Selector de usuario
     opciones_usuarios = {u['email']: u for u in usuarios.data}
     usuario_sel = st.selectbox(
@@ -281,13 +351,12 @@ def gestionar_permisos():
         if user['rol'] == 'admin':
             st.info("ℹ️ Los administradores tienen acceso completo a todas las secciones.")
 
-        # Obtener permisos actuales
-        permisos = admin_client.table('permisos_seccion').select('*').eq('usuario_id', user['id']).execute()
-        permisos_dict = {p['seccion']: p for p in permisos.data}
+        # Permisos actuales (de la matriz cacheada, sin consulta por usuario)
+        permisos_dict = matriz.get(user['id'], {})
 
         # Crear formulario de permisos
         st.write("")
-        cambios = []
+        cambios = {}
 
         # Header
         col_header = st.columns([4, 2, 2])
@@ -303,7 +372,7 @@ def gestionar_permisos():
         for seccion in SECCIONES:
             col1, col2, col3 = st.columns([4, 2, 2])
 
-            permiso_actual = permisos_dict.get(seccion, {'puede_ver': True, 'puede_editar': False})
+            permiso_actual = permisos_dict.get(seccion, PERMISO_POR_DEFECTO)
 
             with col1:
                 st.write(seccion)
@@ -311,7 +380,7 @@ def gestionar_permisos():
             with col2:
                 ver = st.checkbox(
                     "Ver",
-                    value=permiso_actual.get('puede_ver', True),
+                    value=permiso_actual['ver'],
                     key=f"ver_{user['id']}_{seccion}",
                     label_visibility="collapsed"
                 )
@@ -319,63 +388,90 @@ def gestionar_permisos():
             with col3:
                 editar = st.checkbox(
                     "Editar",
-                    value=permiso_actual.get('puede_editar', False),
+                    value=permiso_actual['editar'],
                     key=f"edit_{user['id']}_{seccion}",
                     label_visibility="collapsed",
                     disabled=not ver  # No puede editar si no puede ver
                 )
 
-            cambios.append({
-                'seccion': seccion,
-                'ver': ver,
-                'editar': editar if ver else False
-            })
+            cambios[seccion] = {'ver': ver, 'editar': editar if ver else False}
 
         st.write("")
         if st.button("💾 Guardar Permisos", type="primary"):
-            for c in cambios:
-                admin_client.table('permisos_seccion').upsert({
-                    'usuario_id': user['id'],
-                    'seccion': c['seccion'],
-                    'puede_ver': c['ver'],
-                    'puede_editar': c['editar']
-                }, on_conflict='usuario_id,seccion').execute()
+            guardar_permisos_usuario(user['id'], cambios)
 
             st.success("✅ Permisos guardados correctamente")
             st.rerun()
 
 
 def ver_log_accesos():
-    """Muestra el log de accesos recientes"""
+    """Muestra la actividad (desde los resúmenes) y, bajo demanda, el log de accesos detallado"""
     st.subheader("Log de Accesos")
 
     admin_client = get_admin_client()
 
-    # Obtener últimos 100 accesos
-    logs = admin_client.table('log_accesos').select('*, usuarios(email, nombre)')\
-        .order('timestamp', desc=True)\
-        .limit(100).execute()
+    # Actividad agregada: se lee log_accesos_resumen, no el log completo
+    granularidad, ventana = PERIODOS_ACTIVIDAD[st.selectbox("Periodo", list(PERIODOS_ACTIVIDAD), index=1)]
+    # Truncado a la hora/día: la caché se reutiliza hasta que empieza el siguiente periodo
+    desde = truncar_periodo((datetime.now(timezone.utc) - ventana).isoformat(), granularidad)
+    resumen = obtener_resumen_accesos(granularidad, desde)
+
+    if resumen:
+        col_act, col_sec = st.columns(2)
+        with col_act:
+            st.markdown("**Actividad**")
+            actividad = pd.Series(totales_por(resumen, 'periodo'))
+            actividad.index = pd.to_datetime(actividad.index)
+            st.bar_chart(actividad.sort_index())
+        with col_sec:
+            st.markdown("**Secciones más usadas**")
+            uso = totales_por([f for f in resumen if f['seccion']], 'seccion')
+            st.bar_chart(pd.Series(uso, name='Accesos'))
+
+        usuarios = admin_client.table('usuarios').select('id, nombre, email').execute().data or []
+        nombres = {u['id']: u['nombre'] or u['email'] for u in usuarios}
+        st.markdown("**Usuarios más activos**")
+        st.dataframe([
+            {'Usuario': nombres.get(uid, 'Desconocido'), 'Acciones': total}
+            for uid, total in list(totales_por(resumen, 'usuario_id').items())[:10]
+        ], use_container_width=True, hide_index=True)
+    else:
+        st.info("No hay actividad en el periodo seleccionado.")
 
-    if not logs.data:
-        st.info("No hay registros de acceso.")
+    # Eventos individuales: solo se consultan si se piden
+    if not st.toggle("🔍 Ver eventos individuales", key="log_detalle"):
         return
 
-    # Filtros
+    # Filtros (se aplican en la consulta para que cada página venga ya filtrada)
     col1, col2 = st.columns(2)
     with col1:
         filtro_accion = st.selectbox("Filtrar por acción", ["Todas", "login", "logout", "view", "edit"])
     with col2:
         filtro_seccion = st.selectbox("Filtrar por sección", ["Todas"] + SECCIONES)
 
+    def consulta_log():
+        query = admin_client.table('log_accesos').select('*, usuarios(email, nombre)').gte('timestamp', desde)
+        if filtro_accion != "Todas":
+            query = query.eq('accion', filtro_accion)
+        if filtro_seccion != "Todas":
+            query = query.eq('seccion', filtro_seccion)
+        return query
+
+    def cargar_pagina(cursor):
+        return paginar_keyset(consulta_log, TAMANO_PAGINA, cursor, columna_fecha='timestamp')
+
+    clave = f"admin_log_{desde}_{filtro_accion}_{filtro_seccion}"
+    if st.button("🔄 Actualizar", key="log_refrescar"):
+        _reiniciar_lista(clave)
+    logs = _lista_paginada(clave, cargar_pagina)
+
+    if not logs:
+        st.info("No hay registros de acceso.")
+        return
+
     # Mostrar logs
-    for log in logs.data:
-        # Aplicar filtros
-        if filtro_accion != "Todas" and log['accion'] != filtro_accion:
-            continue
-        if filtro_seccion != "Todas" and log.get('seccion') != filtro_seccion:
-            continue
-
-        usuario_info = log.get('usuarios', {})
+    for log in logs:
+        usuario_info = log.get('usuarios') or {}
         nombre = usuario_info.get('nombre') or usuario_info.get('email', 'Desconocido')
 
         timestamp = datetime.fromisoformat(log['timestamp'].replace('Z', '+00:00'))
@@ -393,16 +489,17 @@ def ver_log_accesos():
             f"{timestamp.strftime('%d/%m/%Y %H:%M')}"
         )
 
+    _boton_cargar_mas(clave, cargar_pagina)
 
-def registrar_accion(usuario_id: str, accion: str, seccion: str = None):
-    """Registra una acción en el log de accesos"""
-    admin_client = get_admin_client()
 
+def registrar_accion(usuario_id: str, accion: str, seccion: str = None):
+    """Registra una acción en el log de accesos (escritura diferida, no bloquea la UI)"""
     try:
-        admin_client.table('log_accesos').insert({
+        obtener_cola().encolar('log_accesos', {
             'usuario_id': usuario_id,
             'accion': accion,
-            'seccion': seccion
-        }).execute()
+            'seccion': seccion,
+            'timestamp': ahora_iso()
+        })
     except Exception:
         pass  # No fallar si no se puede registrar el log
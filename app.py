@@ -102,8 +102,16 @@ from db_competencia import (
     obtener_estadisticas_mercado, obtener_posicion_por_servicio, obtener_ranking_competidores,
     detectar_alertas_competencia, comparar_con_tarifa_david, FACTOR_VEHICULO_NORM,
     guardar_vehiculo_competencia, obtener_vehiculos_competencia, eliminar_vehiculo_competencia,
-    actualizar_vehiculo_competencia, obtener_estadisticas_flota_competencia, obtener_comparativa_flotas, importar_vehiculos_masivo
+    actualizar_vehiculo_competencia, obtener_estadisticas_flota_competencia, obtener_comparativa_flotas, importar_vehiculos_masivo,
+    MatriculaDuplicada
 )
+from invalidacion import iniciar_vigilante
+from cache_geocodificacion import obtener_cache_geocodificacion
+from cliente_geocodificacion import obtener_servicio_geocodificacion, CABECERAS_NOMINATIM
+from rutas import planificar_ruta
+from geometria import simplificar_para_mapa
+from matriz_distancias import obtener_actualizador_matriz
+from autocompletado import obtener_autocompletado
 
 # Configuración de la página
 st.set_page_config(
@@ -113,6 +121,9 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
+# Invalidar cachés cuando otro proceso escribe en Supabase
+iniciar_vigilante()
+
 # ============================================
 # VERIFICACIÓN DE AUTENTICACIÓN
 # ============================================
@@ -528,15 +539,16 @@ st.markdown("""
 # ============================================
 # FUNCIONES DE RUTAS Y MAPAS
 # ============================================
-def geocodificar_direccion(direccion, google_api_key=None):
-    """Convierte una dirección en coordenadas usando Google Places API (si disponible) o Nominatim"""
-    try:
-        # Intentar obtener API key si no se pasa
-        if google_api_key is None:
-            google_api_key = get_google_api_key()
+def _buscar_direccion_en_red(direccion, google_api_key=None):
+    """
+    Consulta Google Places Text Search (si hay API key) y si no Nominatim.
+    Retorna (lat, lon, display_name), None si no hay resultados o lanza excepción si el servicio falla.
+    """
+    servicio = obtener_servicio_geocodificacion()
 
-        # Intentar con Google Places API primero
-        if google_api_key:
+    # Intentar con Google Places API primero
+    if google_api_key:
+        try:
             # Usar Google Places Text Search API
             url = "https://maps.googleapis.com/maps/api/place/textsearch/json"
             params = {
@@ -544,50 +556,117 @@ def geocodificar_direccion(direccion, google_api_key=None):
                 'key': google_api_key,
                 'language': 'es'
             }
-            response = requests.get(url, params=params, timeout=10)
-            if response.status_code == 200:
-                data = response.json()
-                if data.get('status') == 'OK' and data.get('results'):
-                    result = data['results'][0]
-                    lat = result['geometry']['location']['lat']
-                    lon = result['geometry']['location']['lng']
-                    display_name = result.get('formatted_address', result.get('name', direccion))
-                    return (lat, lon, display_name)
-
-        # Fallback a Nominatim si no hay Google API o falla
-        direccion_buscar = direccion
+            data = servicio.consultar(url, params)
+            if data.get('status') == 'OK' and data.get('results'):
+                result = data['results'][0]
+                lat = result['geometry']['location']['lat']
+                lon = result['geometry']['location']['lng']
+                display_name = result.get('formatted_address', result.get('name', direccion))
+                return (lat, lon, display_name)
+        except Exception:
+            pass
 
-        url = "https://nominatim.openstreetmap.org/search"
-        params = {
-            'q': direccion_buscar,
-            'format': 'json',
-            'limit': 1,
-            'addressdetails': 1
-        }
-        headers = {
-            'User-Agent': 'CRM_Autocares_David/1.0'
-        }
+    # Fallback a Nominatim si no hay Google API o falla (cola limitada a 1 petición/s)
+    url = "https://nominatim.openstreetmap.org/search"
+    params = {
+        'q': direccion,
+        'format': 'json',
+        'limit': 1,
+        'addressdetails': 1
+    }
 
-        response = requests.get(url, params=params, headers=headers, timeout=10, verify=False)
-        if response.status_code == 200:
-            data = response.json()
-            if data and len(data) > 0:
-                result = data[0]
-                lat = float(result['lat'])
-                lon = float(result['lon'])
-                display_name = result.get('display_name', direccion)
-                return (lat, lon, display_name)
-        return None
+    data = servicio.consultar(url, params, headers=CABECERAS_NOMINATIM)
+    if data and len(data) > 0:
+        result = data[0]
+        lat = float(result['lat'])
+        lon = float(result['lon'])
+        display_name = result.get('display_name', direccion)
+        return (lat, lon, display_name)
+    return None
+
+
+def geocodificar_direccion(direccion, google_api_key=None):
+    """
+    Convierte una dirección en coordenadas usando Google Places API (si disponible) o Nominatim.
+    Pasa por la caché persistente: las direcciones ya resueltas (o inexistentes) no salen a la red.
+    """
+    try:
+        cache = obtener_cache_geocodificacion()
+        encontrado, resultado = cache.obtener(direccion)
+        if encontrado:
+            return resultado
+
+        # Intentar obtener API key si no se pasa
+        if google_api_key is None:
+            google_api_key = get_google_api_key()
+
+        resultado = _buscar_direccion_en_red(direccion, google_api_key)
+        cache.guardar(direccion, resultado)
+        return resultado
     except Exception as e:
         return None
 
 
-@st.cache_data(ttl=300)
 def buscar_direcciones_sugerencias(texto, limite=8):
     """
     Busca direcciones y devuelve múltiples sugerencias (estilo Google Maps).
-    Retorna lista de dict con lat, lon, display_name, tipo
+    Primero en el índice local (ver autocompletado.py); Nominatim solo si no hay resultados.
+    Retorna lista de dict con lat, lon, display_name, nombre_corto, direccion (la que se
+    geocodifica si no hay coordenadas), tipo y clase
     """
+    def externas(t):
+        return [{'texto': s['nombre_corto'], 'detalle': s['display_name'], 'direccion': s['display_name'],
+                 'lat': s['lat'], 'lon': s['lon'], 'tipo': s['tipo'], 'clase': s['clase']}
+                for s in _sugerencias_nominatim(t, limite)]
+
+    entradas = obtener_autocompletado().sugerir(texto, externas, st.session_state, limite)
+    return [{
+        'lat': e['lat'],
+        'lon': e['lon'],
+        'display_name': e.get('detalle') or e['texto'],
+        'nombre_corto': e['texto'],
+        'direccion': e.get('direccion') or e['texto'],
+        'tipo': e.get('tipo', e.get('origen', '')),
+        'clase': e.get('clase', 'local')
+    } for e in entradas]
+
+
+def elegir_direccion(texto, key):
+    """
+    Resuelve lo escrito en un campo de dirección de la Calculadora.
+    Muestra las sugerencias del autocompletado (índice local primero) en un desplegable;
+    la elegida se usa con sus coordenadas si las trae y, si no, se geocodifica su dirección
+    (nunca el nombre del cliente o del lugar que acompaña a la sugerencia).
+    Sin sugerencias se geocodifica el texto tal cual.
+    Retorna (lat, lon, display_name) o None si aún no se ha elegido o no se encuentra.
+    """
+    sugerencias = buscar_direcciones_sugerencias(texto)
+    if sugerencias:
+        opciones = list(range(len(sugerencias))) + [-1]
+        elegida = st.selectbox(
+            "Sugerencias", opciones, index=None, key=f"sug_{key}_{texto}",
+            placeholder="Elige una sugerencia...", label_visibility="collapsed",
+            format_func=lambda k: f"🔎 Buscar «{texto}»" if k < 0 else (
+                sugerencias[k]['nombre_corto'] if sugerencias[k]['display_name'] == sugerencias[k]['nombre_corto']
+                else f"{sugerencias[k]['nombre_corto']} · {sugerencias[k]['display_name']}")
+        )
+        if elegida is None:
+            return None
+        if elegida >= 0:
+            s = sugerencias[elegida]
+            if s['lat'] is not None and s['lon'] is not None:
+                return (float(s['lat']), float(s['lon']), s['direccion'])
+            texto = s['direccion']
+
+    geo = geocodificar_direccion(texto)
+    if not geo:
+        st.caption("⚠️ No se encontró la dirección")
+    return geo
+
+
+@st.cache_data(ttl=300)
+def _sugerencias_nominatim(texto, limite=8):
+    """Sugerencias de Nominatim: lista de dict con lat, lon, display_name, nombre_corto, tipo, clase."""
     if not texto or len(texto) < 3:
         return []
 
@@ -605,13 +684,9 @@ def buscar_direcciones_sugerencias(texto, limite=8):
             'limit': limite,
             'addressdetails': 1
         }
-        headers = {
-            'User-Agent': 'CRM_Autocares_David/1.0'
-        }
 
-        response = requests.get(url, params=params, headers=headers, timeout=10, verify=False)
-        if response.status_code == 200:
-            data = response.json()
+        data = obtener_servicio_geocodificacion().consultar(url, params, headers=CABECERAS_NOMINATIM)
+        if data is not None:
             sugerencias = []
             for result in data:
                 # Extraer información relevante
@@ -661,9 +736,30 @@ def get_google_api_key():
 
 def google_places_autocomplete(texto, api_key=None):
     """
-    Busca lugares usando Google Places Autocomplete API.
+    Busca lugares: primero en el índice local (ver autocompletado.py) y, si no hay
+    resultados, con Google Places Autocomplete API (de pago por petición).
     Retorna lista de predicciones con place_id, descripcion, etc.
+    Las locales no tienen place_id pero traen lat y lon cuando se conocen.
     """
+    def externas(t):
+        return [{'texto': p['descripcion'], 'detalle': None, 'direccion': p['descripcion'],
+                 'lat': None, 'lon': None, 'prediccion': p}
+                for p in _google_places_autocomplete_api(t, api_key)]
+
+    entradas = obtener_autocompletado().sugerir(texto, externas, st.session_state)
+    return [e['prediccion'] if 'prediccion' in e else {
+        'place_id': None,
+        'descripcion': e['texto'],
+        'texto_principal': e['texto'],
+        'texto_secundario': e.get('detalle') or '',
+        'tipos': [e.get('origen', '')],
+        'lat': e['lat'],
+        'lon': e['lon']
+    } for e in entradas]
+
+
+def _google_places_autocomplete_api(texto, api_key=None):
+    """Predicciones de Google Places Autocomplete API."""
     from database import registrar_uso_api
 
     if not texto or len(texto) < 2:
@@ -874,40 +970,6 @@ def crear_autocomplete_component(key, placeholder, google_api_key):
     return html_code
 
 
-@st.cache_data(ttl=3600)
-def calcular_ruta_osrm(puntos):
-    """
-    Calcula la ruta por carretera usando OSRM (gratuito).
-    puntos: lista de tuplas (lat, lon)
-    Retorna: distancia en km, duracion en minutos, geometria de la ruta
-    """
-    if len(puntos) < 2:
-        return None
-
-    # Formatear coordenadas para OSRM (lon,lat)
-    coords = ";".join([f"{p[1]},{p[0]}" for p in puntos])
-    url = f"http://router.project-osrm.org/route/v1/driving/{coords}?overview=full&geometries=geojson"
-
-    try:
-        response = requests.get(url, timeout=10)
-        if response.status_code == 200:
-            data = response.json()
-            if data['code'] == 'Ok':
-                route = data['routes'][0]
-                distancia_km = route['distance'] / 1000
-                duracion_min = route['duration'] / 60
-                geometria = route['geometry']['coordinates']
-                # Convertir a formato folium (lat, lon)
-                ruta_coords = [(coord[1], coord[0]) for coord in geometria]
-                return {
-                    'distancia_km': round(distancia_km, 1),
-                    'duracion_min': round(duracion_min, 0),
-                    'ruta_coords': ruta_coords
-                }
-    except Exception as e:
-        st.error(f"Error al calcular ruta: {e}")
-    return None
-
 def crear_mapa_ruta(puntos, nombres, ruta_coords=None):
     """Crea un mapa con los puntos y la ruta"""
     if not puntos:
@@ -2364,24 +2426,28 @@ elif pagina == "Analisis Mercado":
                                             if st.form_submit_button("💾 Guardar cambios", type="primary"):
                                                 # Calcular edad
                                                 edad_calc = datetime.now().year - edit_ano + (datetime.now().month / 12)
-                                                actualizar_vehiculo_competencia(
-                                                    veh_edit['id'],
-                                                    matricula=edit_matricula,
-                                                    marca=edit_marca,
-                                                    modelo=edit_modelo,
-                                                    plazas=edit_plazas,
-                                                    ano_matriculacion=edit_ano,
-                                                    edad=round(edad_calc, 1),
-                                                    distintivo_ambiental=edit_distintivo,
-                                                    tipo_vehiculo=edit_tipo,
-                                                    pmr=edit_pmr,
-                                                    wc=edit_wc,
-                                                    wifi=edit_wifi,
-                                                    escolar=edit_escolar,
-                                                    observaciones=edit_obs
-                                                )
-                                                st.success("Vehículo actualizado")
-                                                st.rerun()
+                                                try:
+                                                    actualizar_vehiculo_competencia(
+                                                        veh_edit['id'],
+                                                        matricula=edit_matricula,
+                                                        marca=edit_marca,
+                                                        modelo=edit_modelo,
+                                                        plazas=edit_plazas,
+                                                        ano_matriculacion=edit_ano,
+                                                        edad=round(edad_calc, 1),
+                                                        distintivo_ambiental=edit_distintivo,
+                                                        tipo_vehiculo=edit_tipo,
+                                                        pmr=edit_pmr,
+                                                        wc=edit_wc,
+                                                        wifi=edit_wifi,
+                                                        escolar=edit_escolar,
+                                                        observaciones=edit_obs
+                                                    )
+                                                except MatriculaDuplicada as e:
+                                                    st.error(f"❌ {e}")
+                                                else:
+                                                    st.success("Vehículo actualizado")
+                                                    st.rerun()
                                         with col_btn2:
                                             if st.form_submit_button("🗑️ Eliminar", type="secondary"):
                                                 eliminar_vehiculo_competencia(veh_edit['id'])
@@ -2405,10 +2471,14 @@ elif pagina == "Analisis Mercado":
                         col_conf1, col_conf2 = st.columns(2)
                         with col_conf1:
                             if st.button("✅ Sí, eliminar todo", type="primary", key="btn_confirmar_elim"):
-                                eliminar_competidor(comp_data['id'])
+                                borrado = eliminar_competidor(comp_data['id'])
                                 st.session_state.confirmar_eliminar_comp = None
-                                st.success(f"Competidor '{comp_seleccionado}' eliminado con todos sus datos")
-                                st.rerun()
+                                if borrado['eliminado']:
+                                    st.success(f"Competidor '{comp_seleccionado}' eliminado con {borrado['vehiculos']} vehículos "
+                                               f"y {borrado['cotizaciones']} cotizaciones")
+                                    st.rerun()
+                                else:
+                                    st.error(f"No se pudo eliminar '{comp_seleccionado}'")
                         with col_conf2:
                             if st.button("❌ Cancelar", key="btn_cancelar_elim"):
                                 st.session_state.confirmar_eliminar_comp = None
@@ -2644,19 +2714,22 @@ elif pagina == "Analisis Mercado":
                 st.plotly_chart(fig, use_container_width=True)
 
             with col2:
-                st.markdown("**Rango de precios del mercado**")
+                st.markdown("**Rango de precios del mercado** (mediana y rango intercuartílico)")
                 fig2 = go.Figure()
                 for _, row in df_stats.iterrows():
                     fig2.add_trace(go.Bar(
                         name=f"{row['tipo_servicio']} ({row['tipo_vehiculo']})",
                         x=[f"{row['tipo_servicio']}\n{row['tipo_vehiculo']}"],
-                        y=[row['precio_medio']],
+                        y=[row['precio_mediana']],
                         error_y=dict(
                             type='data',
                             symmetric=False,
-                            array=[row['precio_max'] - row['precio_medio']],
-                            arrayminus=[row['precio_medio'] - row['precio_min']]
-                        )
+                            array=[row['precio_p75'] - row['precio_mediana']],
+                            arrayminus=[row['precio_mediana'] - row['precio_p25']]
+                        ),
+                        customdata=[[row['precio_min'], row['precio_max'], row['num_cotizaciones']]],
+                        hovertemplate="Mediana: %{y:.0f}€<br>Mín: %{customdata[0]:.0f}€ · Máx: %{customdata[1]:.0f}€"
+                                      "<br>%{customdata[2]} cotizaciones<extra></extra>"
                     ))
                 fig2.update_layout(showlegend=False, yaxis_title="Precio (€)")
                 st.plotly_chart(fig2, use_container_width=True)
@@ -2902,7 +2975,8 @@ elif pagina == "Flotas Competencia":
     from db_competencia import (
         obtener_competidores, obtener_vehiculos_competencia,
         guardar_vehiculo_competencia, eliminar_vehiculo_competencia,
-        obtener_comparativa_flotas
+        obtener_comparativa_flotas, importar_vehiculos_masivo, guardar_cambios_flota,
+        actualizar_vehiculo_competencia, MatriculaDuplicada
     )
 
     competidores = obtener_competidores()
@@ -3017,17 +3091,21 @@ elif pagina == "Flotas Competencia":
                         new_marca = st.text_input("Marca")
                         new_modelo = st.text_input("Modelo")
                         if st.form_submit_button("Añadir", type="primary"):
-                            guardar_vehiculo_competencia(
-                                competidor_id=comp_id_editar,
-                                matricula=new_mat,
-                                tipo_vehiculo='AUTOBUS',
-                                marca=new_marca,
-                                modelo=new_modelo,
-                                plazas=new_plazas,
-                                ano_matriculacion=new_ano
-                            )
-                            st.success("Vehículo añadido")
-                            st.rerun()
+                            try:
+                                guardar_vehiculo_competencia(
+                                    competidor_id=comp_id_editar,
+                                    matricula=new_mat,
+                                    tipo_vehiculo='AUTOBUS',
+                                    marca=new_marca,
+                                    modelo=new_modelo,
+                                    plazas=new_plazas,
+                                    ano_matriculacion=new_ano
+                                )
+                            except MatriculaDuplicada as e:
+                                st.error(f"❌ {e}")
+                            else:
+                                st.success("Vehículo añadido")
+                                st.rerun()
 
             if comp_id_editar:
                 vehiculos_comp = obtener_vehiculos_competencia(competidor_id=comp_id_editar, solo_activos=False)
@@ -3069,23 +3147,31 @@ elif pagina == "Flotas Competencia":
                         )
 
                         if st.button("💾 Guardar Cambios", type="primary", key="btn_guardar_flota"):
-                            from supabase_client import get_admin_client
-                            client = get_admin_client()
-                            for _, row in edited_df.iterrows():
-                                ano = row['Año'] or 2020
-                                edad = round(datetime.now().year - ano + (datetime.now().month / 12), 1)
-                                client.table('vehiculos_competencia').update({
-                                    'matricula': row['Matrícula'],
-                                    'marca': row['Marca'],
-                                    'modelo': row['Modelo'],
-                                    'plazas': int(row['Plazas']) if row['Plazas'] else None,
-                                    'ano_matriculacion': int(ano),
-                                    'edad': edad,
-                                    'distintivo_ambiental': row['Distintivo'],
-                                    'activo': bool(row['Activo'])
-                                }).eq('id', row['ID']).execute()
-                            st.success("✅ Cambios guardados")
-                            st.rerun()
+                            columnas_bd = {'ID': 'id', 'Matrícula': 'matricula', 'Marca': 'marca', 'Modelo': 'modelo',
+                                           'Plazas': 'plazas', 'Año': 'ano_matriculacion',
+                                           'Distintivo': 'distintivo_ambiental', 'Activo': 'activo'}
+                            try:
+                                resultado = guardar_cambios_flota(
+                                    comp_id_editar,
+                                    df_edit.rename(columns=columnas_bd).to_dict('records'),
+                                    edited_df.rename(columns=columnas_bd).to_dict('records')
+                                )
+                            except MatriculaDuplicada as e:
+                                st.error(f"❌ {e}")
+                            else:
+                                if resultado['modificados']:
+                                    st.session_state['flota_ultimos_cambios'] = resultado['cambios']
+                                    st.rerun()
+                                else:
+                                    st.info("No hay cambios que guardar")
+
+                        ultimos_cambios = st.session_state.pop('flota_ultimos_cambios', None)
+                        if ultimos_cambios:
+                            st.success(f"✅ {len(ultimos_cambios)} vehículos actualizados")
+                            with st.expander("Ver cambios"):
+                                for cambio in ultimos_cambios:
+                                    detalle = ", ".join(f"{col}: {antes} → {despues}" for col, (antes, despues) in cambio['campos'].items())
+                                    st.caption(f"**{cambio['matricula'] or cambio['id']}** — {detalle}")
                     else:
                         st.info("No hay vehículos")
 
@@ -3117,17 +3203,19 @@ elif pagina == "Flotas Competencia":
                             col_b1, col_b2 = st.columns(2)
                             with col_b1:
                                 if st.form_submit_button("💾 Guardar", type="primary", use_container_width=True):
-                                    from supabase_client import get_admin_client
-                                    client = get_admin_client()
-                                    edad = round(datetime.now().year - edit_ano + (datetime.now().month / 12), 1)
-                                    client.table('vehiculos_competencia').update({
-                                        'matricula': edit_mat, 'marca': edit_marca, 'modelo': edit_modelo,
-                                        'plazas': edit_plazas, 'ano_matriculacion': edit_ano, 'edad': edad,
-                                        'distintivo_ambiental': edit_distintivo, 'activo': edit_activo,
-                                        'pmr': edit_pmr, 'wc': edit_wc, 'wifi': edit_wifi
-                                    }).eq('id', veh_edit['id']).execute()
-                                    st.success("✅ Guardado")
-                                    st.rerun()
+                                    try:
+                                        actualizar_vehiculo_competencia(
+                                            veh_edit['id'],
+                                            matricula=edit_mat, marca=edit_marca, modelo=edit_modelo,
+                                            plazas=edit_plazas, ano_matriculacion=edit_ano,
+                                            distintivo_ambiental=edit_distintivo, activo=edit_activo,
+                                            pmr=edit_pmr, wc=edit_wc, wifi=edit_wifi
+                                        )
+                                    except MatriculaDuplicada as e:
+                                        st.error(f"❌ {e}")
+                                    else:
+                                        st.success("✅ Guardado")
+                                        st.rerun()
                             with col_b2:
                                 if st.form_submit_button("🗑️ Eliminar", type="secondary", use_container_width=True):
                                     eliminar_vehiculo_competencia(veh_edit['id'])
@@ -3145,27 +3233,22 @@ elif pagina == "Flotas Competencia":
                             client = get_admin_client()
 
                             lineas = matriculas_texto.strip().split('\n')
-                            matriculas_activas = [l.strip().split()[0].upper() for l in lineas if l.strip()]
+                            matriculas_activas = [l.strip().split()[0] for l in lineas if l.strip()]
 
                             client.table('vehiculos_competencia').update({'activo': False}).eq('competidor_id', comp_id_editar).execute()
 
-                            existentes = client.table('vehiculos_competencia').select('id, matricula').eq('competidor_id', comp_id_editar).execute().data or []
-                            mat_existentes = {v['matricula'].upper(): v['id'] for v in existentes if v['matricula']}
-
-                            actualizados, creados = 0, 0
-                            for mat in matriculas_activas:
-                                if mat in mat_existentes:
-                                    client.table('vehiculos_competencia').update({'activo': True}).eq('id', mat_existentes[mat]).execute()
-                                    actualizados += 1
-                                else:
-                                    client.table('vehiculos_competencia').insert({
-                                        'competidor_id': comp_id_editar, 'matricula': mat,
-                                        'tipo_vehiculo': 'AUTOBUS', 'activo': True
-                                    }).execute()
-                                    creados += 1
+                            informe = importar_vehiculos_masivo(
+                                comp_id_editar, [{'matricula': mat, 'activo': True} for mat in matriculas_activas]
+                            )
 
-                            st.success(f"✅ {actualizados} actualizados, {creados} nuevos")
-                            st.rerun()
+                            st.success(f"✅ {informe['actualizados']} actualizados, {informe['creados']} nuevos"
+                                       + (f", {informe['duplicados']} repetidas" if informe['duplicados'] else ""))
+                            if informe['errores']:
+                                st.error(f"❌ {informe['errores']} matrículas no se pudieron guardar")
+                                st.dataframe(pd.DataFrame([d for d in informe['detalle'] if d['estado'] == 'error']),
+                                             use_container_width=True, hide_index=True)
+                            else:
+                                st.rerun()
 
         with tab_lista:
             st.subheader("Listado de Vehículos")
@@ -5839,9 +5922,9 @@ elif pagina == "Calculadora":
                 if st.session_state.get('calc_origen_dir'):
                     st.markdown(f"<span style='font-size:11px;color:#888;'>📍 {st.session_state.calc_origen_dir}</span>", unsafe_allow_html=True)
 
-                # Geocodificar cuando hay texto y es diferente al guardado
+                # Resolver (sugerencias o geocodificación) cuando hay texto y es diferente al guardado
                 if origen_txt and origen_txt != origen_guardado:
-                    geo = geocodificar_direccion(origen_txt)
+                    geo = elegir_direccion(origen_txt, "origen")
                     if geo:
                         st.session_state.calc_origen_coords = (geo[0], geo[1])
                         st.session_state.calc_origen_dir = geo[2]
@@ -5860,9 +5943,9 @@ elif pagina == "Calculadora":
                 if st.session_state.get('calc_destino_dir'):
                     st.markdown(f"<span style='font-size:11px;color:#888;'>📍 {st.session_state.calc_destino_dir}</span>", unsafe_allow_html=True)
 
-                # Geocodificar cuando hay texto y es diferente al guardado
+                # Resolver (sugerencias o geocodificación) cuando hay texto y es diferente al guardado
                 if destino_txt and destino_txt != destino_guardado:
-                    geo = geocodificar_direccion(destino_txt)
+                    geo = elegir_direccion(destino_txt, "destino")
                     if geo:
                         st.session_state.calc_destino_coords = (geo[0], geo[1])
                         st.session_state.calc_destino_dir = geo[2]
@@ -5886,7 +5969,7 @@ elif pagina == "Calculadora":
                             st.markdown(f"<span style='font-size:11px;color:#888;'>📍 {parada['dir']}</span>", unsafe_allow_html=True)
                         if nuevo_txt != parada['texto']:
                             if nuevo_txt:
-                                geo = geocodificar_direccion(nuevo_txt)
+                                geo = elegir_direccion(nuevo_txt, f"parada_{i}")
                                 if geo:
                                     st.session_state.calc_paradas[i] = {'texto': nuevo_txt, 'dir': geo[2], 'coords': (geo[0], geo[1])}
                                     st.rerun()
@@ -5910,15 +5993,13 @@ elif pagina == "Calculadora":
                 label_visibility="visible"
             )
 
-            # Geocodificar y añadir automáticamente cuando hay texto
+            # Añadir cuando se elige una sugerencia (o se geocodifica el texto)
             if nueva_parada_txt:
-                geo = geocodificar_direccion(nueva_parada_txt)
+                geo = elegir_direccion(nueva_parada_txt, f"nueva_parada_{st.session_state._parada_counter}")
                 if geo:
                     st.session_state.calc_paradas.append({'texto': nueva_parada_txt, 'dir': geo[2], 'coords': (geo[0], geo[1])})
                     st.session_state._parada_counter += 1  # Incrementar para nueva key vacía
                     st.rerun()
-                else:
-                    st.caption("⚠️ No se encontró la dirección")
 
             st.markdown("---")
 
@@ -5958,6 +6039,12 @@ elif pagina == "Calculadora":
                     guardar_config_calc('tiempo_presentacion', str(nuevo_tiempo_pres))
                     st.success("Configuración guardada")
                     st.rerun()
+                autocompletado = obtener_autocompletado()
+                if autocompletado.estadisticas['consultas']:
+                    st.caption(f"Autocompletado local: {autocompletado.tasa_aciertos:.0%} de aciertos "
+                               f"({autocompletado.estadisticas['consultas']} consultas, "
+                               f"{autocompletado.estadisticas['externas']} al servicio externo, "
+                               f"{len(autocompletado.indice)} direcciones indexadas)")
 
             st.markdown("")
 
@@ -5970,7 +6057,7 @@ elif pagina == "Calculadora":
                     for key in ['calc_origen_coords', 'calc_origen_dir', 'calc_origen_nombre',
                                'calc_destino_coords', 'calc_destino_dir', 'calc_destino_nombre',
                                'calc_paradas', 'calc_km_total', 'calc_resultado', 'calc_ruta_info',
-                               'calc_puntos', 'calc_ruta_coords', 'calc_km_desglose']:
+                               'calc_puntos', 'calc_ruta_polilinea', 'calc_km_desglose']:
                         if key in st.session_state:
                             del st.session_state[key]
                     st.session_state.calc_paradas = []
@@ -5992,62 +6079,38 @@ elif pagina == "Calculadora":
             if estado_actual != estado_anterior:
                 st.session_state._estado_calc = estado_actual
 
-                # Calcular ruta
-                base_geo = None
-                km_pos_ida = 0
-                km_servicio = 0
-                km_pos_vuelta = 0
-                tiempo_pos_ida_min = 0
-                tiempo_servicio_min = 0
-                tiempo_pos_vuelta_min = 0
-                puntos_completos = []
-                ruta_coords_total = []
-
                 indice_pesado = float(obtener_config_calc('indice_vehiculo_pesado') or '1.20')
                 tiempo_presentacion_min = int(obtener_config_calc('tiempo_presentacion') or '15')
 
-                if incluir_pos_ida or incluir_pos_vuelta:
-                    base_geo = geocodificar_direccion(base_direccion)
-
-                # TRAMO 1: Posicionamiento IDA
-                if incluir_pos_ida and base_geo:
-                    tramo_ida = calcular_ruta_osrm([(base_geo[0], base_geo[1]), st.session_state.calc_origen_coords])
-                    if tramo_ida:
-                        km_pos_ida = round(tramo_ida['distancia_km'])
-                        tiempo_pos_ida_min = tramo_ida.get('duracion_min', 0)
-                        ruta_coords_total.extend(tramo_ida.get('ruta_coords', []))
-                    puntos_completos.append((base_geo[0], base_geo[1]))
-
-                # TRAMO 2: Servicio
-                puntos_servicio = [st.session_state.calc_origen_coords]
-                for parada in st.session_state.calc_paradas:
-                    puntos_servicio.append(parada['coords'])
-                puntos_servicio.append(st.session_state.calc_destino_coords)
-
-                if len(puntos_servicio) >= 2:
-                    tramo_servicio = calcular_ruta_osrm(puntos_servicio)
-                    if tramo_servicio:
-                        km_servicio = round(tramo_servicio['distancia_km'])
-                        tiempo_servicio_min = tramo_servicio.get('duracion_min', 0)
-                        ruta_coords_total.extend(tramo_servicio.get('ruta_coords', []))
-
-                puntos_completos.extend(puntos_servicio)
-
-                # TRAMO 3: Posicionamiento VUELTA
-                if incluir_pos_vuelta and base_geo:
-                    tramo_vuelta = calcular_ruta_osrm([st.session_state.calc_destino_coords, (base_geo[0], base_geo[1])])
-                    if tramo_vuelta:
-                        km_pos_vuelta = round(tramo_vuelta['distancia_km'])
-                        tiempo_pos_vuelta_min = tramo_vuelta.get('duracion_min', 0)
-                        ruta_coords_total.extend(tramo_vuelta.get('ruta_coords', []))
-                    puntos_completos.append((base_geo[0], base_geo[1]))
+                # Calcular ruta: los tres tramos en paralelo
+                plan = planificar_ruta(
+                    st.session_state.calc_origen_coords,
+                    st.session_state.calc_destino_coords,
+                    [parada['coords'] for parada in st.session_state.calc_paradas],
+                    base_direccion,
+                    incluir_pos_ida,
+                    incluir_pos_vuelta,
+                    geocodificar=geocodificar_direccion,
+                    consultar_matriz=obtener_actualizador_matriz().consultar
+                )
+                if plan['errores']:
+                    st.warning(f"No se encontró la dirección base ({base_direccion}): se calcula sin posicionamientos")
+                if plan['estimado']:
+                    st.info(f"Servicio de rutas no disponible: km y tiempos estimados para {', '.join(plan['estimado'])}")
+                km_pos_ida = plan['km_desglose']['pos_ida']
+                km_servicio = plan['km_desglose']['servicio']
+                km_pos_vuelta = plan['km_desglose']['pos_vuelta']
+                tiempo_pos_ida_min = plan['minutos_desglose']['pos_ida']
+                tiempo_servicio_min = plan['minutos_desglose']['servicio']
+                tiempo_pos_vuelta_min = plan['minutos_desglose']['pos_vuelta']
+                puntos_completos = plan['puntos']
 
                 km = km_pos_ida + km_servicio + km_pos_vuelta
 
                 if km > 0:
                     st.session_state.calc_km_total = km
                     st.session_state.calc_km_desglose = {'pos_ida': km_pos_ida, 'servicio': km_servicio, 'pos_vuelta': km_pos_vuelta}
-                    st.session_state.calc_ruta_coords = ruta_coords_total
+                    st.session_state.calc_ruta_polilinea = plan['polilinea']
                     st.session_state.calc_puntos = puntos_completos
 
                     from datetime import datetime as dt, timedelta
@@ -6395,7 +6458,7 @@ elif pagina == "Calculadora":
                     """, unsafe_allow_html=True)
 
                 # Mapa de la ruta (debajo del total)
-                if st.session_state.get('calc_puntos') and st.session_state.get('calc_ruta_coords'):
+                if st.session_state.get('calc_puntos') and st.session_state.get('calc_ruta_polilinea'):
                     # Obtener valores de checkboxes desde session_state
                     pos_ida = st.session_state.get('c_pos_ida', True)
                     pos_vuelta = st.session_state.get('c_pos_vuelta', True)
@@ -6409,12 +6472,18 @@ elif pagina == "Calculadora":
                     if pos_vuelta:
                         nombres.append("Base")
 
+                    # Simplificar la geometría al zoom del mapa antes de mandarla al navegador
+                    ruta_mapa = simplificar_para_mapa(st.session_state.calc_ruta_polilinea, alto_px=250)
                     mapa = crear_mapa_ruta(
                         st.session_state.calc_puntos,
                         nombres,
-                        st.session_state.calc_ruta_coords
+                        ruta_mapa['coords']
                     )
                     st_folium(mapa, width=None, height=250, key="mapa_ruta")
+                    if ruta_mapa['eliminados']:
+                        st.caption(f"Ruta simplificada para zoom {ruta_mapa['zoom']}: "
+                                   f"{len(ruta_mapa['coords'])} de {ruta_mapa['originales']} puntos "
+                                   f"({ruta_mapa['eliminados']} eliminados)")
 
                 # Desglose compacto - calcular totales reales
                 precio_base = res['desglose'].get('precio_base', 0)
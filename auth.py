@@ -4,13 +4,116 @@ Usa Azure AD (Microsoft 365) a través de Supabase
 Con persistencia de sesión mediante cookies seguras
 """
 import streamlit as st
-from supabase_client import get_supabase, get_admin_client
+from supabase_client import get_supabase, get_admin_client, crear_cliente_sesion
+from invalidacion import registrar_invalidacion
+from permisos import permisos_usuario, guardar_permisos_usuario
+from verificacion_jwt import (
+    verificar_token, necesita_refresco, crear_obtener_clave_jwks,
+    TokenExpirado, VerificacionNoDisponible, MARGEN_REFRESCO
+)
 from datetime import datetime, timedelta
+import base64
+import hashlib
+import json
+import threading
 import time
 import extra_streamlit_components as stx
 
 COOKIE_EXPIRY_DAYS = 7  # Días de validez de la cookie
 
+# Segundos que se da por buena una sesión verificada si el token no trae 'exp'
+TTL_SESION_SIN_EXP = 300
+
+# Minutos mínimos entre dos escrituras de ultimo_acceso del mismo usuario
+INTERVALO_ULTIMO_ACCESO = 5
+
+
+def _payload_token(token: str) -> dict:
+    """Decodifica (sin verificar) el payload de un JWT."""
+    try:
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        return json.loads(base64.urlsafe_b64decode(payload))
+    except (IndexError, ValueError, AttributeError):
+        return {}
+
+
+class CacheSesiones:
+    """
+    Sesiones ya verificadas, compartidas por todas las pestañas del proceso.
+    Clave: hash del access token. Valor: fila de usuarios, hasta que el token expira
+    o la sesión se invalida (logout, desactivación o cambio en la tabla usuarios).
+    Los permisos se sirven desde permisos.py.
+    """
+
+    def __init__(self, ttl_sin_exp: float = TTL_SESION_SIN_EXP,
+                 intervalo_ultimo_acceso: float = INTERVALO_ULTIMO_ACCESO * 60):
+        self.ttl_sin_exp = ttl_sin_exp
+        self.intervalo_ultimo_acceso = intervalo_ultimo_acceso
+        self._sesiones = {}       # hash token -> {'usuario', 'expira'}
+        self._ultimo_acceso = {}  # usuario_id -> time.monotonic() de la última escritura
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _clave(token: str) -> str:
+        return hashlib.sha256(token.encode()).hexdigest()
+
+    def obtener(self, token: str) -> dict:
+        """Sesión verificada para el token, o None si no está o ha expirado."""
+        clave = self._clave(token)
+        with self._lock:
+            sesion = self._sesiones.get(clave)
+            if sesion and sesion['expira'] > time.time():
+                return sesion
+            self._sesiones.pop(clave, None)
+            return None
+
+    def guardar(self, token: str, usuario: dict):
+        """Guarda una sesión recién verificada hasta la expiración del token."""
+        exp = _payload_token(token).get('exp')
+        # Caduca antes que el token para que se renueve a tiempo (ver _verificar_sesion)
+        expira = exp - MARGEN_REFRESCO if exp else time.time() + self.ttl_sin_exp
+        with self._lock:
+            self._sesiones[self._clave(token)] = {'usuario': usuario, 'expira': expira}
+
+    def invalidar_token(self, token: str):
+        with self._lock:
+            self._sesiones.pop(self._clave(token), None)
+
+    def invalidar_usuario(self, usuario_id: str):
+        """Olvida todas las sesiones de un usuario (desactivado o con el rol cambiado)."""
+        with self._lock:
+            self._sesiones = {k: v for k, v in self._sesiones.items() if v['usuario']['id'] != usuario_id}
+
+    def limpiar(self):
+        with self._lock:
+            self._sesiones.clear()
+
+    def toca_ultimo_acceso(self, usuario_id: str) -> bool:
+        """True si hay que escribir ultimo_acceso (como mucho una vez por intervalo y usuario)."""
+        ahora = time.monotonic()
+        with self._lock:
+            ultimo = self._ultimo_acceso.get(usuario_id)
+            if ultimo is not None and ahora - ultimo < self.intervalo_ultimo_acceso:
+                return False
+            self._ultimo_acceso[usuario_id] = ahora
+            return True
+
+
+@st.cache_resource
+def obtener_cache_sesiones() -> CacheSesiones:
+    """Caché de sesiones compartida por todas las sesiones del proceso."""
+    return CacheSesiones()
+
+
+def invalidar_sesiones_usuario(usuario_id: str):
+    """Obliga a reverificar al usuario en su próxima interacción (p.ej. tras desactivarlo)."""
+    obtener_cache_sesiones().invalidar_usuario(usuario_id)
+
+
+# Un cambio en usuarios hecho desde otro proceso (activar, desactivar, rol) invalida las sesiones
+registrar_invalidacion('usuarios', lambda: obtener_cache_sesiones().limpiar())
+
 def get_cookie_manager():
     """Obtiene el cookie manager (sin cache porque usa widgets)"""
     if 'cookie_manager' not in st.session_state:
@@ -92,21 +195,7 @@ def _handle_auth_code(code: str):
         response = supabase.auth.exchange_code_for_session({"auth_code": code})
 
         if response.session:
-            # Guardar tokens en session_state
-            st.session_state.access_token = response.session.access_token
-            st.session_state.refresh_token = response.session.refresh_token
-
-            # Guardar tokens en cookies seguras (persisten al refrescar)
-            cookie_manager.set(
-                "crm_access_token",
-                response.session.access_token,
-                expires_at=datetime.now() + timedelta(days=COOKIE_EXPIRY_DAYS)
-            )
-            cookie_manager.set(
-                "crm_refresh_token",
-                response.session.refresh_token,
-                expires_at=datetime.now() + timedelta(days=COOKIE_EXPIRY_DAYS)
-            )
+            _guardar_tokens(response.session, cookie_manager)
 
             # Registrar usuario si es nuevo
             registrar_usuario_si_nuevo(response.user)
@@ -136,6 +225,24 @@ def _handle_auth_code(code: str):
         st.rerun()
 
 
+def _guardar_tokens(session, cookie_manager):
+    """Guarda los tokens de una sesión en session_state y en cookies seguras"""
+    st.session_state.access_token = session.access_token
+    st.session_state.refresh_token = session.refresh_token
+
+    # Guardar tokens en cookies seguras (persisten al refrescar)
+    cookie_manager.set(
+        "crm_access_token",
+        session.access_token,
+        expires_at=datetime.now() + timedelta(days=COOKIE_EXPIRY_DAYS)
+    )
+    cookie_manager.set(
+        "crm_refresh_token",
+        session.refresh_token,
+        expires_at=datetime.now() + timedelta(days=COOKIE_EXPIRY_DAYS)
+    )
+
+
 def registrar_usuario_si_nuevo(user):
     """Registra un nuevo usuario en la tabla usuarios si no existe"""
     if not user:
@@ -191,10 +298,6 @@ def crear_permisos_usuario(usuario_id: str, rol: str, permisos_json: str = None)
     Si permisos_json está definido, usa esos permisos.
     Si no, usa permisos por defecto según el rol.
     """
-    import json
-
-    admin_client = get_admin_client()
-
     secciones = [
         'Dashboard', 'Tiempo Anticipacion', 'Seguimiento Presupuestos',
         'Clientes', 'Campanas Segmentadas', 'Analisis Conversion',
@@ -209,6 +312,7 @@ def crear_permisos_usuario(usuario_id: str, rol: str, permisos_json: str = None)
         except (json.JSONDecodeError, TypeError):
             permisos_personalizados = None
 
+    permisos = {}
     for seccion in secciones:
         if permisos_personalizados and seccion in permisos_personalizados:
             # Usar permisos de la invitación
@@ -219,12 +323,10 @@ def crear_permisos_usuario(usuario_id: str, rol: str, permisos_json: str = None)
             puede_ver = True
             puede_editar = rol == 'admin'
 
-        admin_client.table('permisos_seccion').insert({
-            'usuario_id': usuario_id,
-            'seccion': seccion,
-            'puede_ver': puede_ver,
-            'puede_editar': puede_editar
-        }).execute()
+        permisos[seccion] = {'ver': puede_ver, 'editar': puede_editar}
+
+    # Todas las secciones en una sola escritura
+    guardar_permisos_usuario(usuario_id, permisos)
 
 
 def check_auth():
@@ -233,7 +335,6 @@ def check_auth():
     Retorna los datos del usuario si está autenticado, None si no.
     Primero intenta recuperar tokens de cookies si no están en session_state.
     """
-    supabase = get_supabase()
     cookie_manager = get_cookie_manager()
 
     # Si no hay tokens en session_state, intentar recuperar de cookies
@@ -247,24 +348,23 @@ def check_auth():
         else:
             return None
 
-    try:
-        # Verificar sesión con Supabase
-        supabase.auth.set_session(
-            st.session_state.access_token,
-            st.session_state.refresh_token
-        )
+    # Sesión ya verificada en este proceso: sin llamadas a Supabase
+    cache = obtener_cache_sesiones()
+    sesion = cache.obtener(st.session_state.access_token)
+    if sesion:
+        _actualizar_ultimo_acceso(sesion['usuario']['id'])
+        return sesion['usuario']
 
-        user_response = supabase.auth.get_user()
+    try:
+        usuario_id = _verificar_sesion(cookie_manager)
 
-        if not user_response or not user_response.user:
+        if not usuario_id:
             _clear_auth_data(cookie_manager)
             return None
 
-        user = user_response.user
-
         # Verificar si está en lista de usuarios autorizados y activo
         admin_client = get_admin_client()
-        result = admin_client.table('usuarios').select('*').eq('id', user.id).single().execute()
+        result = admin_client.table('usuarios').select('*').eq('id', usuario_id).single().execute()
 
         if not result.data:
             return None
@@ -272,10 +372,8 @@ def check_auth():
         if not result.data['activo']:
             return {'error': 'inactive', 'user': result.data}
 
-        # Actualizar último acceso
-        admin_client.table('usuarios').update({
-            'ultimo_acceso': datetime.now().isoformat()
-        }).eq('id', user.id).execute()
+        cache.guardar(st.session_state.access_token, result.data)
+        _actualizar_ultimo_acceso(usuario_id)
 
         return result.data
 
@@ -285,9 +383,70 @@ def check_auth():
         return None
 
 
+@st.cache_resource
+def _obtener_clave_jwks():
+    """Función kid -> clave pública del JWKS del proyecto (None si PyJWT no está instalado)."""
+    return crear_obtener_clave_jwks(f"{st.secrets['SUPABASE_URL']}/auth/v1/.well-known/jwks.json")
+
+
+def _verificar_token_local(token: str) -> dict:
+    """Verifica firma, expiración y audiencia del access token sin llamar a Supabase."""
+    return verificar_token(
+        token,
+        secreto=st.secrets.get("SUPABASE_JWT_SECRET"),
+        obtener_clave_publica=_obtener_clave_jwks()
+    )
+
+
+def _verificar_sesion(cookie_manager) -> str:
+    """
+    Comprueba el access token y retorna el id del usuario (None si no es válido).
+    En local si hay secreto o JWKS; si no, con el servidor de autenticación.
+    Solo se pide un token nuevo cuando el actual está a punto de expirar.
+    Las llamadas con tokens usan un cliente propio de la petición: los tokens nuevos
+    quedan solo en session_state y cookies, nunca en el cliente compartido.
+    """
+    try:
+        claims = _verificar_token_local(st.session_state.access_token)
+        if not necesita_refresco(claims):
+            return claims['sub']
+    except TokenExpirado:
+        pass
+    except VerificacionNoDisponible:
+        # Sin JWT secret ni PyJWT: validar con Supabase como siempre
+        supabase = crear_cliente_sesion()
+        supabase.auth.set_session(
+            st.session_state.access_token,
+            st.session_state.refresh_token
+        )
+        user_response = supabase.auth.get_user()
+        return user_response.user.id if user_response and user_response.user else None
+
+    # Expirado o a punto de expirar: renovar con el refresh token
+    obtener_cache_sesiones().invalidar_token(st.session_state.access_token)
+    response = crear_cliente_sesion().auth.refresh_session(st.session_state.refresh_token)
+    if not response or not response.session:
+        return None
+    _guardar_tokens(response.session, cookie_manager)
+    return _verificar_token_local(st.session_state.access_token)['sub']
+
+
+def _actualizar_ultimo_acceso(usuario_id: str):
+    """Actualiza ultimo_acceso como mucho una vez cada INTERVALO_ULTIMO_ACCESO minutos."""
+    if not obtener_cache_sesiones().toca_ultimo_acceso(usuario_id):
+        return
+    try:
+        get_admin_client().table('usuarios').update({
+            'ultimo_acceso': datetime.now().isoformat()
+        }).eq('id', usuario_id).execute()
+    except Exception as e:
+        print(f"Error actualizando ultimo_acceso: {e}")
+
+
 def _clear_auth_data(cookie_manager=None):
     """Limpia tokens de session_state y cookies"""
     if 'access_token' in st.session_state:
+        obtener_cache_sesiones().invalidar_token(st.session_state.access_token)
         del st.session_state.access_token
     if 'refresh_token' in st.session_state:
         del st.session_state.refresh_token
@@ -309,26 +468,22 @@ def get_user_permissions(user_id: str) -> dict:
         ...
     }
     """
-    admin_client = get_admin_client()
-    result = admin_client.table('permisos_seccion').select('*').eq('usuario_id', user_id).execute()
-
-    permisos = {}
-    for p in result.data:
-        permisos[p['seccion']] = {
-            'ver': p['puede_ver'],
-            'editar': p['puede_editar']
-        }
-
-    return permisos
+    return permisos_usuario(user_id)
 
 
 def logout():
     """Cierra sesión del usuario y limpia cookies"""
-    supabase = get_supabase()
     cookie_manager = get_cookie_manager()
 
+    # sign_out revoca la sesión cargada en el cliente: usar uno propio con la de este usuario
     try:
-        supabase.auth.sign_out()
+        if st.session_state.get('access_token') and st.session_state.get('refresh_token'):
+            supabase = crear_cliente_sesion()
+            supabase.auth.set_session(
+                st.session_state.access_token,
+                st.session_state.refresh_token
+            )
+            supabase.auth.sign_out()
     except:
         pass
 
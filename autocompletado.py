@@ -0,0 +1,193 @@
+"""
+Autocompletado local de direcciones
+Índice de prefijos (lista ordenada + bisect) sobre los lugares frecuentes, las direcciones
+ya geocodificadas y los domicilios de Clientes.xlsx. Se busca por el inicio de cualquier
+palabra ('anoeta' encuentra 'Paseo de Anoeta 22'). Solo si el índice no tiene resultados
+se consulta el servicio externo (de pago en el caso de Google), con antirrebote por sesión,
+y lo que devuelve se añade al índice. Se lleva la tasa de aciertos locales.
+"""
+import threading
+import time
+from bisect import bisect_left, insort
+
+import streamlit as st
+
+from cache_geocodificacion import normalizar_direccion
+
+# Caracteres mínimos para sugerir
+LONGITUD_MINIMA = 3
+
+# Palabras iniciales de cada texto a partir de las que se indexa
+MAX_PALABRAS_INDEXADAS = 6
+
+# Segundos mínimos entre consultas al servicio externo de una misma sesión
+ANTIRREBOTE_SEGUNDOS = 0.6
+
+# Segundos entre reconstrucciones completas del índice
+TTL_INDICE = 3600
+
+# Orden de preferencia de las fuentes (menor = antes)
+PRIORIDAD_ORIGEN = {'lugar': 0, 'geocodificada': 1, 'externa': 2, 'cliente': 3}
+
+
+class IndicePrefijos:
+    """
+    Entradas: dicts con 'texto' (lo que se muestra), 'detalle', 'direccion' (lo que se
+    geocodifica si no hay coordenadas), 'lat', 'lon' y 'origen'.
+    Claves: el texto normalizado a partir de cada una de sus primeras palabras.
+    """
+
+    def __init__(self, entradas: list = ()):
+        self.entradas = []
+        self._claves = []          # [(clave, palabra_inicial, indice_entrada)] ordenada
+        self._vistas = set()       # Textos normalizados ya indexados
+        self._lock = threading.Lock()
+        self.agregar(entradas, ordenar=True)
+
+    @staticmethod
+    def _claves_de(entrada: dict) -> list:
+        claves = []
+        for texto in (entrada.get('texto'), entrada.get('detalle')):
+            palabras = normalizar_direccion(texto).split()
+            claves.extend((' '.join(palabras[i:]), i) for i in range(min(len(palabras), MAX_PALABRAS_INDEXADAS)))
+        return claves
+
+    def agregar(self, entradas, ordenar: bool = False) -> int:
+        """Añade entradas nuevas (ignora textos ya indexados). Retorna cuántas se añadieron."""
+        añadidas = 0
+        with self._lock:
+            for entrada in entradas:
+                vista = normalizar_direccion(f"{entrada.get('texto')} {entrada.get('detalle') or ''}")
+                if not vista or vista in self._vistas:
+                    continue
+                self._vistas.add(vista)
+                indice = len(self.entradas)
+                self.entradas.append(entrada)
+                for clave, palabra in self._claves_de(entrada):
+                    if ordenar:
+                        self._claves.append((clave, palabra, indice))
+                    else:
+                        insort(self._claves, (clave, palabra, indice))
+                añadidas += 1
+            if ordenar:
+                self._claves.sort()
+        return añadidas
+
+    def buscar(self, texto: str, limite: int = 8) -> list:
+        """Entradas con alguna palabra que empiece por el texto, lugares frecuentes primero."""
+        prefijo = normalizar_direccion(texto)
+        if not prefijo:
+            return []
+        encontradas = {}   # indice_entrada -> primera palabra en la que coincide
+        with self._lock:
+            claves = self._claves
+            i = bisect_left(claves, (prefijo,))
+            while i < len(claves) and claves[i][0].startswith(prefijo):
+                _, palabra, indice = claves[i]
+                encontradas[indice] = min(encontradas.get(indice, palabra), palabra)
+                i += 1
+        orden = sorted(encontradas, key=lambda k: (
+            PRIORIDAD_ORIGEN.get(self.entradas[k].get('origen'), 9), encontradas[k], len(self.entradas[k]['texto'])
+        ))
+        return [self.entradas[k] for k in orden[:limite]]
+
+    def __len__(self):
+        return len(self.entradas)
+
+
+class Autocompletado:
+    """
+    Índice local con paso al servicio externo solo cuando no hay resultados.
+    estadisticas: consultas, locales (aciertos), externas y frenadas por antirrebote.
+    Una instancia la comparten todas las sesiones: los contadores van con cerrojo y el
+    momento de la última consulta externa se guarda en el estado de cada sesión.
+    """
+
+    CLAVE_ULTIMA_EXTERNA = '_autocompletado_ultima_externa'
+
+    def __init__(self, indice: IndicePrefijos, antirrebote: float = ANTIRREBOTE_SEGUNDOS, reloj=time.monotonic):
+        self.indice = indice
+        self.antirrebote = antirrebote
+        self._reloj = reloj
+        self._lock = threading.Lock()
+        self.estadisticas = {'consultas': 0, 'locales': 0, 'externas': 0, 'antirrebote': 0}
+
+    def _contar(self, *claves):
+        with self._lock:
+            for clave in claves:
+                self.estadisticas[clave] += 1
+
+    @property
+    def tasa_aciertos(self) -> float:
+        """Fracción de consultas resueltas sin salir al servicio externo."""
+        with self._lock:
+            consultas, locales = self.estadisticas['consultas'], self.estadisticas['locales']
+        return locales / consultas if consultas else 0.0
+
+    def sugerir(self, texto: str, buscar_externo, sesion=None, limite: int = 8) -> list:
+        """
+        Sugerencias locales; si no hay, las de buscar_externo(texto) -> [entradas],
+        que se incorporan al índice. sesion: estado de la sesión (st.session_state o
+        un dict) donde se guarda la última consulta externa; si consultó fuera hace
+        menos del antirrebote se retorna lista vacía (la siguiente pulsación volverá
+        a intentarlo). Sin sesion no hay antirrebote.
+        """
+        if not texto or len(texto.strip()) < LONGITUD_MINIMA:
+            return []
+        locales = self.indice.buscar(texto, limite)
+        if locales:
+            self._contar('consultas', 'locales')
+            return locales
+
+        sesion = {} if sesion is None else sesion
+        ahora = self._reloj()
+        if ahora - sesion.get(self.CLAVE_ULTIMA_EXTERNA, float('-inf')) < self.antirrebote:
+            self._contar('consultas', 'antirrebote')
+            return []
+        sesion[self.CLAVE_ULTIMA_EXTERNA] = ahora
+        self._contar('consultas', 'externas')
+        externas = buscar_externo(texto) or []
+        self.indice.agregar([{**e, 'origen': 'externa'} for e in externas])
+        return externas[:limite]
+
+
+def _texto_celda(valor) -> str:
+    """Celda de Excel como texto ('20018.0' -> '20018', NaN -> '')."""
+    if valor is None or valor != valor:
+        return ''
+    if isinstance(valor, float) and valor.is_integer():
+        valor = int(valor)
+    return str(valor).strip()
+
+
+def entradas_locales() -> list:
+    """Lugares frecuentes, direcciones de la caché de geocodificación y domicilios de clientes."""
+    from database import obtener_lugares_frecuentes
+    from cache_geocodificacion import obtener_cache_geocodificacion
+    from data_loader import cargar_clientes
+
+    entradas = [
+        {'texto': l['nombre'], 'detalle': l.get('direccion'), 'direccion': l.get('direccion') or l['nombre'],
+         'lat': l.get('lat'), 'lon': l.get('lng'), 'origen': 'lugar'}
+        for l in obtener_lugares_frecuentes() if l.get('nombre')
+    ]
+    entradas.extend(
+        {'texto': nombre, 'detalle': None, 'direccion': nombre, 'lat': lat, 'lon': lon, 'origen': 'geocodificada'}
+        for nombre, lat, lon in obtener_cache_geocodificacion().direcciones()
+    )
+    try:
+        clientes = cargar_clientes()
+        for _, c in clientes.dropna(subset=['Domicilio']).iterrows():
+            poblacion = ' '.join(_texto_celda(c.get(col)) for col in ('Cod.Postal', 'Población')).strip()
+            texto = ', '.join(p for p in (_texto_celda(c['Domicilio']), poblacion) if p)
+            entradas.append({'texto': texto, 'detalle': _texto_celda(c.get('Nombre_Cliente')) or None,
+                             'direccion': texto, 'lat': None, 'lon': None, 'origen': 'cliente'})
+    except Exception as e:
+        print(f"No se pudieron indexar los domicilios de clientes: {e}")
+    return entradas
+
+
+@st.cache_resource(ttl=TTL_INDICE, show_spinner=False)
+def obtener_autocompletado() -> Autocompletado:
+    """Autocompletado compartido por todas las sesiones; el índice se reconstruye cada hora."""
+    return Autocompletado(IndicePrefijos(entradas_locales()))
@@ -0,0 +1,138 @@
+"""
+Búsqueda de texto completo sobre notas
+Plegado de acentos, ranking por relevancia y paginación por cursor.
+En Supabase la búsqueda la resuelve la RPC buscar_notas_fts (índice GIN);
+IndiceNotasLocal es una aproximación en memoria para pruebas sin red, no un
+equivalente exacto:
+- La RPC usa websearch_to_tsquery('spanish'): reduce cada palabra a su raíz
+  ('autobuses' encuentra 'autobús') y admite comillas, OR y '-'.
+- El índice local solo pliega acentos y compara términos enteros, salvo el último,
+  que se busca por prefijo; no hay raíces ni operadores.
+- El ranking local es tipo BM25 y el de la RPC ts_rank_cd, así que el orden y los
+  valores de rank (y por tanto los cursores) no coinciden entre ambos.
+"""
+import math
+import re
+import unicodedata
+
+# Pesos por campo (equivalentes a setweight 'A' y 'B' en supabase_schema_config.sql)
+PESOS_CAMPOS = {
+    'contenido': 1.0,
+    'cliente': 0.4,
+    'cod_presupuesto': 0.4,
+}
+
+# Palabras vacías más frecuentes en español (no aportan a la relevancia)
+STOPWORDS_ES = {
+    'a', 'al', 'con', 'de', 'del', 'el', 'en', 'es', 'la', 'las', 'lo', 'los',
+    'no', 'o', 'para', 'por', 'que', 'se', 'su', 'un', 'una', 'y',
+}
+
+_RE_TOKEN = re.compile(r'\w+', re.UNICODE)
+
+
+def plegar_acentos(texto: str) -> str:
+    """Pasa a minúsculas y elimina tildes y diéresis ('Camión' -> 'camion')."""
+    if not texto:
+        return ''
+    descompuesto = unicodedata.normalize('NFKD', str(texto))
+    sin_marcas = ''.join(c for c in descompuesto if not unicodedata.combining(c))
+    return sin_marcas.lower()
+
+
+def tokenizar(texto: str) -> list:
+    """Divide un texto en términos plegados, sin palabras vacías."""
+    return [t for t in _RE_TOKEN.findall(plegar_acentos(texto)) if t not in STOPWORDS_ES]
+
+
+class IndiceNotasLocal:
+    """
+    Índice invertido en memoria sobre contenido, cliente y cod_presupuesto.
+    Ranking tipo BM25 ponderado por campo; el último término de la consulta
+    se trata como prefijo para la búsqueda mientras se escribe.
+    """
+
+    K1 = 1.2
+    B = 0.75
+
+    def __init__(self, notas: list = None):
+        self._notas = {}        # id -> nota
+        self._longitudes = {}   # id -> nº de términos ponderados
+        self._postings = {}     # término -> {id: frecuencia ponderada}
+        for nota in notas or []:
+            self.agregar(nota)
+
+    def __len__(self):
+        return len(self._notas)
+
+    def agregar(self, nota: dict):
+        """Indexa (o reindexa) una nota. Requiere la clave 'id'."""
+        nota_id = nota['id']
+        if nota_id in self._notas:
+            self.eliminar(nota_id)
+
+        frecuencias = {}
+        longitud = 0.0
+        for campo, peso in PESOS_CAMPOS.items():
+            for termino in tokenizar(nota.get(campo) or ''):
+                frecuencias[termino] = frecuencias.get(termino, 0.0) + peso
+                longitud += peso
+
+        self._notas[nota_id] = nota
+        self._longitudes[nota_id] = longitud
+        for termino, tf in frecuencias.items():
+            self._postings.setdefault(termino, {})[nota_id] = tf
+
+    def eliminar(self, nota_id):
+        """Quita una nota del índice."""
+        if self._notas.pop(nota_id, None) is None:
+            return
+        self._longitudes.pop(nota_id, None)
+        for termino in list(self._postings):
+            docs = self._postings[termino]
+            docs.pop(nota_id, None)
+            if not docs:
+                del self._postings[termino]
+
+    def _terminos_prefijo(self, prefijo: str) -> list:
+        return [t for t in self._postings if t.startswith(prefijo)]
+
+    def buscar(self, termino: str, limite: int = 50, cursor: tuple = None) -> dict:
+        """
+        Busca notas que contengan todos los términos.
+        cursor: (rank, id) de la última nota de la página anterior.
+        Retorna {'notas': [...], 'cursor': (rank, id) o None si no hay más}.
+        """
+        terminos = tokenizar(termino)
+        if not terminos or not self._notas:
+            return {'notas': [], 'cursor': None}
+
+        n_docs = len(self._notas)
+        longitud_media = (sum(self._longitudes.values()) / n_docs) or 1.0
+
+        puntuaciones = None
+        for i, t in enumerate(terminos):
+            # El último término admite coincidencia por prefijo
+            variantes = self._terminos_prefijo(t) if i == len(terminos) - 1 else [t]
+            parcial = {}
+            for variante in variantes:
+                docs = self._postings.get(variante, {})
+                idf = math.log(1 + (n_docs - len(docs) + 0.5) / (len(docs) + 0.5))
+                for nota_id, tf in docs.items():
+                    norm = self.K1 * (1 - self.B + self.B * self._longitudes[nota_id] / longitud_media)
+                    parcial[nota_id] = parcial.get(nota_id, 0.0) + idf * tf * (self.K1 + 1) / (tf + norm)
+            if puntuaciones is None:
+                puntuaciones = parcial
+            else:
+                puntuaciones = {k: v + parcial[k] for k, v in puntuaciones.items() if k in parcial}
+            if not puntuaciones:
+                return {'notas': [], 'cursor': None}
+
+        ordenados = sorted(((round(p, 6), nid) for nid, p in puntuaciones.items()), reverse=True)
+        if cursor is not None:
+            ordenados = [r for r in ordenados if r < tuple(cursor)]
+
+        pagina = ordenados[:limite]
+        notas = [dict(self._notas[nid], rank=rank) for rank, nid in pagina]
+        siguiente = pagina[-1] if len(ordenados) > limite else None
+        return {'notas': notas, 'cursor': siguiente}
@@ -0,0 +1,178 @@
+"""
+Caché persistente de geocodificación (SQLite)
+Guarda el resultado de cada dirección geocodificada, clave = dirección normalizada,
+en un fichero compartido por todas las sesiones y procesos. También guarda las
+direcciones sin resultado (caché negativa, con TTL corto) para no repetir búsquedas
+que no van a encontrar nada. Los lugares frecuentes se siembran sin caducidad.
+"""
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+import streamlit as st
+
+from busqueda_notas import plegar_acentos
+
+RUTA_CACHE_GEO = Path(__file__).parent / "datos_locales" / "geocodificacion.db"
+
+# Segundos que vale un resultado encontrado (las direcciones apenas cambian)
+TTL_GEOCODIFICACION = 90 * 24 * 3600
+
+# Segundos que vale un "no encontrado" (puede ser un error tecleando o un sitio nuevo)
+TTL_NEGATIVO = 24 * 3600
+
+_RE_SEPARADORES = re.compile(r"[\s,.;:\-/]+")
+
+
+def normalizar_direccion(direccion: str) -> str:
+    """Clave de caché: sin tildes, en minúsculas y con la puntuación y espacios unificados."""
+    return _RE_SEPARADORES.sub(' ', plegar_acentos(direccion)).strip()
+
+
+class CacheGeocodificacion:
+    """
+    Caché dirección -> (lat, lon, display_name) en SQLite.
+    expira NULL = no caduca (lugares frecuentes); lat NULL = sin resultado.
+    """
+
+    def __init__(self, ruta: Path = RUTA_CACHE_GEO, ttl: float = TTL_GEOCODIFICACION,
+                 ttl_negativo: float = TTL_NEGATIVO):
+        self._ruta = Path(ruta)
+        self.ttl = ttl
+        self.ttl_negativo = ttl_negativo
+        self._lock = threading.Lock()
+        self._ruta.parent.mkdir(parents=True, exist_ok=True)
+        self._crear_esquema()
+
+    @contextmanager
+    def _conexion(self):
+        conn = sqlite3.connect(str(self._ruta), timeout=10)
+        try:
+            yield conn
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _crear_esquema(self):
+        with self._conexion() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS geocodificacion (
+                    clave TEXT PRIMARY KEY,
+                    lat REAL,
+                    lon REAL,
+                    display_name TEXT,
+                    origen TEXT,
+                    expira REAL
+                )
+            """)
+
+    def obtener(self, direccion: str, ahora: float = None):
+        """
+        Retorna (encontrado_en_cache, resultado).
+        resultado es (lat, lon, display_name) o None si la dirección se buscó y no existe.
+        """
+        clave = normalizar_direccion(direccion)
+        if not clave:
+            return False, None
+        ahora = time.time() if ahora is None else ahora
+        with self._conexion() as conn:
+            fila = conn.execute(
+                "SELECT lat, lon, display_name, expira FROM geocodificacion WHERE clave = ?", (clave,)
+            ).fetchone()
+        if fila is None or (fila[3] is not None and fila[3] < ahora):
+            return False, None
+        if fila[0] is None:
+            return True, None
+        return True, (fila[0], fila[1], fila[2])
+
+    def guardar(self, direccion: str, resultado, origen: str = 'red', ahora: float = None):
+        """Guarda un resultado (lat, lon, display_name) o None como no encontrado."""
+        clave = normalizar_direccion(direccion)
+        if not clave:
+            return
+        ahora = time.time() if ahora is None else ahora
+        if resultado is None:
+            valores = (clave, None, None, None, origen, ahora + self.ttl_negativo)
+        else:
+            valores = (clave, resultado[0], resultado[1], resultado[2], origen, ahora + self.ttl)
+        with self._lock, self._conexion() as conn:
+            conn.execute("""
+                INSERT INTO geocodificacion (clave, lat, lon, display_name, origen, expira)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(clave) DO UPDATE SET
+                    lat = excluded.lat, lon = excluded.lon, display_name = excluded.display_name,
+                    origen = excluded.origen, expira = excluded.expira
+                WHERE geocodificacion.expira IS NOT NULL
+            """, valores)
+
+    def sembrar(self, lugares: list) -> int:
+        """
+        Carga los lugares frecuentes (nombre, direccion, lat, lng) sin caducidad,
+        indexados tanto por nombre como por dirección. Retorna las claves escritas.
+        """
+        filas = {}
+        for lugar in lugares:
+            if lugar.get('lat') is None or lugar.get('lng') is None:
+                continue
+            display_name = lugar.get('direccion') or lugar.get('nombre')
+            for texto in (lugar.get('nombre'), lugar.get('direccion')):
+                clave = normalizar_direccion(texto)
+                if clave:
+                    filas[clave] = (clave, float(lugar['lat']), float(lugar['lng']), display_name, 'lugar', None)
+        if filas:
+            with self._lock, self._conexion() as conn:
+                conn.executemany("""
+                    INSERT INTO geocodificacion (clave, lat, lon, display_name, origen, expira)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(clave) DO UPDATE SET
+                        lat = excluded.lat, lon = excluded.lon, display_name = excluded.display_name,
+                        origen = excluded.origen, expira = NULL
+                """, list(filas.values()))
+        return len(filas)
+
+    def direcciones(self, ahora: float = None) -> list:
+        """[(display_name, lat, lon)] distintos de los resultados vigentes (para el autocompletado)."""
+        ahora = time.time() if ahora is None else ahora
+        with self._conexion() as conn:
+            return conn.execute(
+                "SELECT display_name, MIN(lat), MIN(lon) FROM geocodificacion "
+                "WHERE lat IS NOT NULL AND display_name IS NOT NULL AND (expira IS NULL OR expira >= ?) "
+                "GROUP BY display_name", (ahora,)
+            ).fetchall()
+
+    def purgar_caducados(self, ahora: float = None) -> int:
+        ahora = time.time() if ahora is None else ahora
+        with self._lock, self._conexion() as conn:
+            return conn.execute(
+                "DELETE FROM geocodificacion WHERE expira IS NOT NULL AND expira < ?", (ahora,)
+            ).rowcount
+
+    def geocodificar(self, direccion: str, buscar):
+        """
+        Resultado cacheado o, si no está, el de buscar(direccion).
+        buscar retorna (lat, lon, display_name), None si no existe, o lanza
+        excepción si el servicio falla (los fallos no se cachean).
+        """
+        encontrado, resultado = self.obtener(direccion)
+        if encontrado:
+            return resultado
+        resultado = buscar(direccion)
+        self.guardar(direccion, resultado)
+        return resultado
+
+
+@st.cache_resource
+def obtener_cache_geocodificacion() -> CacheGeocodificacion:
+    """Caché compartida por todas las sesiones del proceso, sembrada con los lugares frecuentes."""
+    cache = CacheGeocodificacion()
+    try:
+        from database import obtener_lugares_frecuentes
+        cache.sembrar(obtener_lugares_frecuentes())
+        cache.purgar_caducados()
+    except Exception as e:
+        print(f"No se pudo sembrar la caché de geocodificación: {e}")
+    return cache
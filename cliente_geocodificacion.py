@@ -0,0 +1,210 @@
+"""
+Cliente asíncrono de los servicios de geocodificación (Nominatim y Google Places)
+Todas las sesiones del proceso comparten un único bucle asyncio en segundo plano:
+- Limitador de tipo token bucket por host (Nominatim exige como máximo 1 petición/s).
+- Las consultas idénticas en curso se agrupan en una sola petición.
+- Las búsquedas interactivas adelantan a las de fondo (siembra, matrices) en la cola.
+El transporte HTTP es intercambiable; TransporteEnMemoria sirve para pruebas sin red.
+"""
+import asyncio
+import itertools
+import threading
+import time
+from urllib.parse import urlparse
+
+import requests
+import streamlit as st
+
+# Peticiones por segundo (y ráfaga máxima) por host; los hosts no listados no se limitan
+LIMITES_POR_HOST = {
+    'nominatim.openstreetmap.org': (1.0, 1),
+}
+
+PRIORIDAD_INTERACTIVA = 0
+PRIORIDAD_FONDO = 10
+
+# Segundos que espera una llamada síncrona antes de rendirse (la petición sigue en curso)
+TIMEOUT_CONSULTA = 15
+
+CABECERAS_NOMINATIM = {'User-Agent': 'CRM_Autocares_David/1.0'}
+
+
+class LimitadorTokens:
+    """Token bucket: 'tasa' fichas por segundo, como mucho 'capacidad' acumuladas."""
+
+    def __init__(self, tasa: float, capacidad: int = 1, reloj=time.monotonic, dormir=asyncio.sleep):
+        self.tasa = tasa
+        self.capacidad = capacidad
+        self._reloj = reloj
+        self._dormir = dormir
+        self._fichas = float(capacidad)
+        self._ultimo = reloj()
+
+    def _reponer(self):
+        ahora = self._reloj()
+        self._fichas = min(self.capacidad, self._fichas + (ahora - self._ultimo) * self.tasa)
+        self._ultimo = ahora
+
+    async def adquirir(self):
+        """Espera hasta que haya una ficha y la consume."""
+        self._reponer()
+        while self._fichas < 1:
+            await self._dormir((1 - self._fichas) / self.tasa)
+            self._reponer()
+        self._fichas -= 1
+
+
+class TransporteHTTP:
+    """
+    Transporte real: requests en un hilo del ejecutor para no bloquear el bucle.
+    Verifica siempre los certificados salvo en los hosts indicados expresamente
+    (secreto HOSTS_SIN_VERIFICAR_SSL, p. ej. tras un proxy corporativo que los intercepta).
+    """
+
+    def __init__(self, hosts_sin_verificar_ssl=()):
+        self.hosts_sin_verificar_ssl = set(hosts_sin_verificar_ssl)
+        if self.hosts_sin_verificar_ssl:
+            print(f"Geocodificación sin verificar SSL para: {', '.join(sorted(self.hosts_sin_verificar_ssl))}")
+
+    async def obtener_json(self, url: str, params: dict, headers: dict = None, timeout: float = 10):
+        verify = urlparse(url).hostname not in self.hosts_sin_verificar_ssl
+
+        def _get():
+            response = requests.get(url, params=params, headers=headers, timeout=timeout, verify=verify)
+            response.raise_for_status()
+            return response.json()
+        return await asyncio.to_thread(_get)
+
+
+class TransporteEnMemoria:
+    """
+    Transporte simulado para pruebas.
+    respuestas: función (url, params) -> json, o dict {consulta: json} mirando params['q'|'query'|'input'].
+    Registra cada llamada en self.llamadas.
+    """
+
+    def __init__(self, respuestas, retardo: float = 0.0):
+        self.respuestas = respuestas
+        self.retardo = retardo
+        self.llamadas = []
+
+    async def obtener_json(self, url: str, params: dict, headers: dict = None, timeout: float = 10):
+        self.llamadas.append((url, dict(params)))
+        if self.retardo:
+            await asyncio.sleep(self.retardo)
+        if callable(self.respuestas):
+            return self.respuestas(url, params)
+        consulta = params.get('q') or params.get('query') or params.get('input')
+        return self.respuestas.get(consulta, [])
+
+
+class ServicioGeocodificacion:
+    """
+    Cola de peticiones con prioridad, limitación por host y agrupación de consultas repetidas.
+    Se usa desde código asíncrono con consultar_async o desde Streamlit con consultar.
+    """
+
+    def __init__(self, transporte=None, limites: dict = None, reloj=time.monotonic):
+        self.transporte = transporte or TransporteHTTP()
+        self.limites = LIMITES_POR_HOST if limites is None else limites
+        self._reloj = reloj
+        self._en_curso = {}        # clave -> Future compartido por las consultas idénticas
+        self._prioridades = {}     # clave -> mejor prioridad encolada
+        self._colas = {}           # host -> PriorityQueue
+        self._limitadores = {}     # host -> LimitadorTokens
+        self._tareas = set()       # Referencias a las tareas lanzadas (el bucle solo guarda referencias débiles)
+        self._secuencia = itertools.count()
+        self._bucle = None
+        self._lock = threading.Lock()
+        self.estadisticas = {'peticiones': 0, 'agrupadas': 0, 'errores': 0}
+
+    @staticmethod
+    def _clave(url: str, params: dict):
+        return url, tuple(sorted((k, str(v)) for k, v in params.items()))
+
+    async def consultar_async(self, url: str, params: dict, headers: dict = None,
+                              prioridad: int = PRIORIDAD_INTERACTIVA, timeout: float = 10):
+        """JSON de la respuesta. Lanza la excepción del transporte si la petición falla."""
+        clave = self._clave(url, params)
+        futuro = self._en_curso.get(clave)
+        nuevo = futuro is None
+        if nuevo:
+            futuro = asyncio.get_running_loop().create_future()
+            self._en_curso[clave] = futuro
+            self._prioridades[clave] = prioridad
+            futuro.add_done_callback(lambda _: (self._en_curso.pop(clave, None),
+                                                self._prioridades.pop(clave, None)))
+        else:
+            self.estadisticas['agrupadas'] += 1
+
+        host = urlparse(url).hostname
+        if host in self.limites:
+            # Si un usuario pide una consulta que ya estaba en cola como tarea de fondo,
+            # se encola otra entrada con más prioridad; el trabajador descarta la que llegue tarde
+            if nuevo or prioridad < self._prioridades.get(clave, prioridad):
+                self._prioridades[clave] = prioridad
+                cola = self._obtener_cola(host)
+                cola.put_nowait((prioridad, next(self._secuencia), url, params, headers, timeout, futuro))
+        elif nuevo:
+            self._lanzar(self._ejecutar(url, params, headers, timeout, futuro))
+        return await asyncio.shield(futuro)
+
+    def _obtener_cola(self, host: str) -> asyncio.PriorityQueue:
+        if host not in self._colas:
+            tasa, capacidad = self.limites[host]
+            self._colas[host] = asyncio.PriorityQueue()
+            self._limitadores[host] = LimitadorTokens(tasa, capacidad, reloj=self._reloj)
+            self._lanzar(self._trabajador(host))
+        return self._colas[host]
+
+    def _lanzar(self, corrutina):
+        tarea = asyncio.ensure_future(corrutina)
+        self._tareas.add(tarea)
+        tarea.add_done_callback(self._tareas.discard)
+
+    async def _trabajador(self, host: str):
+        cola, limitador = self._colas[host], self._limitadores[host]
+        while True:
+            _, _, url, params, headers, timeout, futuro = await cola.get()
+            if futuro.done():
+                continue
+            await limitador.adquirir()
+            await self._ejecutar(url, params, headers, timeout, futuro)
+
+    async def _ejecutar(self, url, params, headers, timeout, futuro):
+        self.estadisticas['peticiones'] += 1
+        try:
+            resultado = await self.transporte.obtener_json(url, params, headers, timeout)
+        except Exception as e:
+            self.estadisticas['errores'] += 1
+            if not futuro.done():
+                futuro.set_exception(e)
+            return
+        if not futuro.done():
+            futuro.set_result(resultado)
+
+    # ---------- Uso desde código síncrono (Streamlit) ----------
+
+    def _obtener_bucle(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._bucle is None:
+                self._bucle = asyncio.new_event_loop()
+                threading.Thread(target=self._bucle.run_forever, daemon=True,
+                                 name="geocodificacion").start()
+            return self._bucle
+
+    def consultar(self, url: str, params: dict, headers: dict = None,
+                  prioridad: int = PRIORIDAD_INTERACTIVA, timeout: float = 10,
+                  espera_maxima: float = TIMEOUT_CONSULTA):
+        """Versión bloqueante de consultar_async; lanza TimeoutError si la cola no llega a tiempo."""
+        futuro = asyncio.run_coroutine_threadsafe(
+            self.consultar_async(url, params, headers, prioridad, timeout), self._obtener_bucle()
+        )
+        return futuro.result(espera_maxima)
+
+
+@st.cache_resource
+def obtener_servicio_geocodificacion() -> ServicioGeocodificacion:
+    """Servicio compartido por todas las sesiones del proceso."""
+    hosts = st.secrets.get("HOSTS_SIN_VERIFICAR_SSL", [])
+    return ServicioGeocodificacion(TransporteHTTP(hosts_sin_verificar_ssl=hosts))
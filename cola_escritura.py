@@ -0,0 +1,384 @@
+"""
+Cola de escritura diferida (write-behind) para notas y eventos de auditoría
+Las inserciones se encolan al instante y un hilo en segundo plano las envía
+a Supabase por lotes, con reintentos y un fichero local que sobrevive a reinicios.
+Cada proceso de Streamlit tiene su propio fichero y mantiene bloqueado (flock) el
+.lock que lo acompaña mientras vive; las filas de un proceso solo las adopta otro
+cuando ese bloqueo queda libre, es decir, cuando el dueño ha terminado.
+"""
+import json
+import os
+import random
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from pathlib import Path
+
+import streamlit as st
+
+try:
+    import fcntl
+except ImportError:  # Windows: solo hay exclusión entre hilos del proceso
+    fcntl = None
+
+DIRECTORIO_LOCAL = Path(__file__).parent / "datos_locales"
+
+# Base de los nombres de fichero: cada proceso escribe en cola_escritura.proceso-<pid>-<id>.jsonl.
+# Un cola_escritura.jsonl compartido de versiones anteriores se adopta y se borra.
+RUTA_SPOOL = DIRECTORIO_LOCAL / "cola_escritura.jsonl"
+
+# Columna con el identificador único de cada escritura: permite reintentar
+# un lote sin duplicar filas (ver supabase_schema_config.sql)
+COLUMNA_ID_ESCRITURA = 'id_escritura'
+
+# Segundos que espera vaciar() por defecto
+TIMEOUT_VACIAR = 30
+
+# Segundos entre búsquedas de ficheros de procesos que ya no existen
+INTERVALO_ADOPCION = 60
+
+# Filas enviadas tras las que se reescribe el fichero sin ellas (mientras, se anotan al final)
+COMPACTAR_CADA = 500
+
+# Errores de red de httpx (cliente de supabase-py) y requests, por nombre de clase
+_ERRORES_RED = {
+    'TransportError', 'NetworkError', 'ConnectError', 'ReadError', 'WriteError', 'CloseError',
+    'RemoteProtocolError', 'TimeoutException', 'ConnectTimeout', 'ReadTimeout', 'WriteTimeout',
+    'PoolTimeout', 'ConnectionError', 'Timeout',
+}
+
+
+def es_error_transitorio(error: Exception) -> bool:
+    """
+    True si el fallo es de red o del servidor (5xx, 429): se reintenta más tarde.
+    False si Supabase rechaza los datos (4xx, errores de PostgreSQL): reintentar no sirve.
+    """
+    if isinstance(error, (ConnectionError, TimeoutError)):
+        return True
+    if any(clase.__name__ in _ERRORES_RED for clase in type(error).__mro__):
+        return True
+    respuesta = getattr(error, 'response', None)
+    estado = getattr(error, 'status_code', None) or getattr(respuesta, 'status_code', None)
+    if estado is None:
+        # postgrest.APIError: 'code' es el código HTTP o el de PostgreSQL/PostgREST ('23505', 'PGRST204')
+        codigo = str(getattr(error, 'code', '') or '')
+        if codigo.isdigit() and len(codigo) == 3:
+            estado = int(codigo)
+        elif codigo:
+            return False
+    if estado is not None:
+        return int(estado) >= 500 or int(estado) == 429
+    # Excepción desconocida: mejor esperar que descartar datos
+    return True
+
+
+def _escribir_lote_supabase(tabla: str, filas: list):
+    """Inserta un lote en Supabase ignorando filas ya escritas en un intento anterior."""
+    from supabase_client import get_admin_client
+    get_admin_client().table(tabla).upsert(
+        filas, on_conflict=COLUMNA_ID_ESCRITURA, ignore_duplicates=True
+    ).execute()
+
+
+class ColaEscritura:
+    """
+    Cola de inserciones con envío por lotes en un hilo propio.
+
+    escribir_lote(tabla, filas): función que persiste un lote (lanza excepción si falla).
+    ruta_spool: base de los ficheros JSONL de filas pendientes. El de este proceso solo
+    crece: las filas enviadas se anotan en una línea {"enviadas": [ids]} y cada
+    COMPACTAR_CADA enviadas (o al quedar la cola vacía) se reescribe con las pendientes.
+    """
+
+    def __init__(self, escribir_lote=_escribir_lote_supabase, ruta_spool: Path = RUTA_SPOOL,
+                 tamano_lote: int = 50, intervalo: float = 1.0, max_reintentos: int = 5,
+                 espera_base: float = 0.5, espera_max: float = 30.0):
+        self._escribir_lote = escribir_lote
+        base = Path(ruta_spool)
+        self._ruta_compartida = base
+        self._patron_spool = f"{base.stem}.proceso-*{base.suffix}"
+        self._ruta_spool = base.with_name(f"{base.stem}.proceso-{os.getpid()}-{uuid.uuid4().hex[:8]}{base.suffix}")
+        self._ruta_fallidos = base.with_suffix('.fallidos.jsonl')
+        self.tamano_lote = tamano_lote
+        self.intervalo = intervalo
+        self.max_reintentos = max_reintentos
+        self.espera_base = espera_base
+        self.espera_max = espera_max
+
+        self._pendientes = []   # [{'tabla': ..., 'fila': {...}}] en orden de llegada
+        self._ultima_adopcion = time.monotonic()
+        self._enviadas_sin_compactar = 0
+        self._callbacks = {}    # tabla -> [funciones a llamar tras escribir]
+        self._lock = threading.Lock()
+        self._hay_trabajo = threading.Event()
+        self._vacia = threading.Event()
+        self._vacia.set()
+        self._metricas = {
+            'encoladas': 0,
+            'escritas': 0,
+            'lotes': 0,
+            'reintentos': 0,
+            'fallidas': 0,
+            'ultimo_error': None,
+            'ultima_escritura': None,
+        }
+
+        self._ruta_spool.parent.mkdir(parents=True, exist_ok=True)
+        # Bloqueo de por vida: mientras esté tomado nadie adopta el fichero de este proceso
+        self._fichero_bloqueo = open(self._ruta_spool.with_suffix('.lock'), 'a')
+        if fcntl:
+            fcntl.flock(self._fichero_bloqueo, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self._adoptar_huerfanos(al_arrancar=True)
+
+        self._hilo = threading.Thread(target=self._bucle, name="cola-escritura", daemon=True)
+        self._hilo.start()
+
+    # ---------- API pública ----------
+
+    def encolar(self, tabla: str, fila: dict) -> str:
+        """Encola una inserción y retorna su id de escritura. No bloquea por red."""
+        fila = dict(fila)
+        fila.setdefault(COLUMNA_ID_ESCRITURA, str(uuid.uuid4()))
+        entrada = {'tabla': tabla, 'fila': fila}
+        with self._lock:
+            self._anotar([entrada])
+            self._pendientes.append(entrada)
+            self._metricas['encoladas'] += 1
+            self._vacia.clear()
+        self._hay_trabajo.set()
+        return fila[COLUMNA_ID_ESCRITURA]
+
+    def al_escribir(self, tabla: str, funcion):
+        """Registra una función a llamar cuando se escribe un lote de la tabla (p.ej. limpiar caché)."""
+        with self._lock:
+            funciones = self._callbacks.setdefault(tabla, [])
+            if funcion not in funciones:
+                funciones.append(funcion)
+
+    def pendientes(self, tabla: str = None) -> list:
+        """Filas aún no escritas (para mostrar al usuario lo que acaba de guardar)."""
+        with self._lock:
+            return [dict(e['fila']) for e in self._pendientes if tabla is None or e['tabla'] == tabla]
+
+    def vaciar(self, timeout: float = TIMEOUT_VACIAR) -> bool:
+        """Fuerza el envío inmediato y espera a que la cola quede vacía. Retorna False si expira."""
+        self._hay_trabajo.set()
+        return self._vacia.wait(timeout)
+
+    def metricas(self) -> dict:
+        """Contadores de la cola (encoladas, escritas, lotes, reintentos, fallidas, pendientes...)."""
+        with self._lock:
+            datos = dict(self._metricas)
+            datos['pendientes'] = len(self._pendientes)
+        return datos
+
+    # ---------- Funcionamiento interno ----------
+
+    @staticmethod
+    def _leer_spool(ruta: Path) -> list:
+        """Entradas pendientes de un fichero: las que no aparecen en una línea de enviadas."""
+        if not ruta.exists():
+            return []
+        entradas, enviadas = [], set()
+        with open(ruta, 'r', encoding='utf-8') as f:
+            for linea in f:
+                linea = linea.strip()
+                if not linea:
+                    continue
+                try:
+                    dato = json.loads(linea)
+                except json.JSONDecodeError:
+                    continue  # Línea truncada por un cierre brusco
+                if 'enviadas' in dato:
+                    enviadas.update(dato['enviadas'])
+                else:
+                    entradas.append(dato)
+        return [e for e in entradas if e['fila'].get(COLUMNA_ID_ESCRITURA) not in enviadas]
+
+    def _anotar(self, entradas: list = None, enviadas: list = None):
+        """Añade al fichero propio filas nuevas o ids enviados (llamar con self._lock tomado)."""
+        with open(self._ruta_spool, 'a', encoding='utf-8') as f:
+            for entrada in entradas or []:
+                f.write(json.dumps(entrada, default=str) + '\n')
+            if enviadas:
+                f.write(json.dumps({'enviadas': enviadas}) + '\n')
+
+    def _compactar(self):
+        """Reescribe el fichero propio solo con las pendientes (llamar con self._lock tomado)."""
+        temporal = self._ruta_spool.with_suffix('.tmp')
+        with open(temporal, 'w', encoding='utf-8') as f:
+            for entrada in self._pendientes:
+                f.write(json.dumps(entrada, default=str) + '\n')
+        temporal.replace(self._ruta_spool)
+        self._enviadas_sin_compactar = 0
+
+    def _incorporar(self, entradas: list):
+        """Pasa a este proceso filas adoptadas: a memoria y a su fichero."""
+        with self._lock:
+            en_memoria = {e['fila'].get(COLUMNA_ID_ESCRITURA) for e in self._pendientes}
+            nuevas = [e for e in entradas if e['fila'].get(COLUMNA_ID_ESCRITURA) not in en_memoria]
+            if nuevas:
+                self._anotar(nuevas)
+                self._pendientes.extend(nuevas)
+                self._vacia.clear()
+        if nuevas:
+            self._hay_trabajo.set()
+
+    def _adoptar_huerfanos(self, al_arrancar: bool = False):
+        """
+        Adopta los ficheros de procesos terminados (su .lock se puede bloquear) y el
+        fichero compartido de versiones anteriores. Los de procesos vivos no se tocan.
+        Sin fcntl no se sabe si el dueño vive: solo se adopta al arrancar.
+        """
+        if not fcntl and not al_arrancar:
+            return
+        candidatos = [r for r in self._ruta_spool.parent.glob(self._patron_spool) if r != self._ruta_spool]
+        if self._ruta_compartida.exists():
+            candidatos.append(self._ruta_compartida)
+        for ruta in candidatos:
+            ruta_bloqueo = ruta.with_suffix('.lock')
+            with open(ruta_bloqueo, 'a') as f:
+                if fcntl:
+                    # El fichero compartido antiguo solo se bloqueaba al escribir: se espera
+                    bandera = fcntl.LOCK_EX if ruta == self._ruta_compartida else fcntl.LOCK_EX | fcntl.LOCK_NB
+                    try:
+                        fcntl.flock(f, bandera)
+                    except OSError:
+                        continue  # Dueño vivo
+                try:
+                    self._incorporar(self._leer_spool(ruta))
+                    ruta.unlink(missing_ok=True)
+                    if ruta != self._ruta_compartida:
+                        ruta_bloqueo.unlink(missing_ok=True)
+                finally:
+                    if fcntl:
+                        fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _siguiente_lote(self):
+        """
+        Primer bloque de filas consecutivas de la misma tabla, hasta tamano_lote.
+        Si no hay ninguna marca la cola como vacía en el mismo paso (bajo self._lock),
+        para que un encolar concurrente no quede tapado por ese aviso.
+        """
+        with self._lock:
+            if not self._pendientes:
+                self._vacia.set()
+                return None, []
+            tabla = self._pendientes[0]['tabla']
+            lote = []
+            for entrada in self._pendientes:
+                if entrada['tabla'] != tabla or len(lote) >= self.tamano_lote:
+                    break
+                lote.append(entrada)
+            return tabla, lote
+
+    def _espera(self, intento: int) -> float:
+        """Backoff exponencial con jitter."""
+        return min(self.espera_max, self.espera_base * (2 ** intento)) * random.uniform(0.5, 1.0)
+
+    def _enviar(self, tabla: str, filas: list, intentos: int = None):
+        """Retorna None si se escribe, o la última excepción. Solo reintenta los errores transitorios."""
+        intentos = intentos or self.max_reintentos
+        for intento in range(intentos):
+            try:
+                self._escribir_lote(tabla, filas)
+                return None
+            except Exception as e:
+                error = e
+                with self._lock:
+                    self._metricas['reintentos'] += 1
+                    self._metricas['ultimo_error'] = f"{tabla}: {e}"
+                if not es_error_transitorio(e):
+                    return e
+                if intento < intentos - 1:
+                    time.sleep(self._espera(intento))
+        return error
+
+    def _guardar_fallidas(self, entradas: list):
+        with open(self._ruta_fallidos, 'a', encoding='utf-8') as f:
+            for entrada in entradas:
+                f.write(json.dumps(entrada, default=str) + '\n')
+
+    def _procesar_lote(self, tabla: str, lote: list):
+        """
+        Envía un lote. Si Supabase no está disponible (red, 5xx) retorna False y el lote
+        sigue pendiente. Si rechaza los datos, se envía fila a fila y las que fallan solas
+        pasan a cuarentena (.fallidos.jsonl) para no bloquear las escrituras siguientes.
+        """
+        filas = [e['fila'] for e in lote]
+        fallidas = []
+        error = self._enviar(tabla, filas)
+        if error is not None:
+            if es_error_transitorio(error):
+                # Supabase caído: se reintenta más tarde sin perder nada
+                return False
+            if len(filas) == 1:
+                fallidas = lote
+            else:
+                # Aislar las filas que fallan (id_escritura hace inocuo reenviar las que ya entraron)
+                for entrada in lote:
+                    error = self._enviar(tabla, [entrada['fila']])
+                    if error is None:
+                        continue
+                    if es_error_transitorio(error):
+                        return False
+                    fallidas.append(entrada)
+
+        with self._lock:
+            escritas = set(id(e) for e in lote)
+            self._pendientes = [e for e in self._pendientes if id(e) not in escritas]
+            if fallidas:
+                self._guardar_fallidas(fallidas)
+            self._enviadas_sin_compactar += len(lote)
+            if not self._pendientes or self._enviadas_sin_compactar >= COMPACTAR_CADA:
+                self._compactar()
+            else:
+                self._anotar(enviadas=[e['fila'].get(COLUMNA_ID_ESCRITURA) for e in lote])
+            self._metricas['lotes'] += 1
+            self._metricas['escritas'] += len(lote) - len(fallidas)
+            self._metricas['fallidas'] += len(fallidas)
+            self._metricas['ultima_escritura'] = datetime.now(timezone.utc).isoformat()
+            callbacks = list(self._callbacks.get(tabla, []))
+
+        for funcion in callbacks:
+            try:
+                funcion()
+            except Exception as e:
+                print(f"Error en callback de cola_escritura ({tabla}): {e}")
+        return True
+
+    def _bucle(self):
+        intento_fallido = 0
+        while True:
+            self._hay_trabajo.wait(self.intervalo)
+            self._hay_trabajo.clear()
+
+            if time.monotonic() - self._ultima_adopcion >= INTERVALO_ADOPCION:
+                self._ultima_adopcion = time.monotonic()
+                try:
+                    self._adoptar_huerfanos()
+                except Exception as e:
+                    print(f"Error adoptando ficheros de cola_escritura: {e}")
+
+            while True:
+                tabla, lote = self._siguiente_lote()
+                if not lote:
+                    break
+                if self._procesar_lote(tabla, lote):
+                    intento_fallido = 0
+                else:
+                    intento_fallido += 1
+                    time.sleep(self._espera(intento_fallido))
+                    break
+
+
+@st.cache_resource
+def obtener_cola() -> ColaEscritura:
+    """Cola compartida por todas las sesiones del proceso."""
+    return ColaEscritura()
+
+
+def ahora_iso() -> str:
+    """Marca de tiempo del momento en que se produce el evento (no el de escritura)."""
+    return datetime.now(timezone.utc).isoformat()
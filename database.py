@@ -4,7 +4,11 @@ Migrado de SQLite local para persistencia en la nube
 """
 import streamlit as st
 from datetime import datetime
-from supabase_client import get_admin_client
+from supabase_client import get_admin_client, paginar_keyset
+from cola_escritura import obtener_cola, ahora_iso
+from espejo_local import obtener_espejo, leer_referencia
+from invalidacion import registrar_invalidacion
+from cache_geocodificacion import obtener_cache_geocodificacion
 
 # ============================================
 # FUNCIONES DE CACHÉ
@@ -12,10 +16,12 @@ from supabase_client import get_admin_client
 
 def limpiar_cache_tipos():
     """Limpia caché de tipos de servicio."""
+    obtener_espejo().marcar_pendiente('tipos_servicio')
     obtener_tipos_servicio_db.clear()
 
 def limpiar_cache_config():
     """Limpia caché de configuración."""
+    obtener_espejo().marcar_pendiente('comisiones_tramos', 'bonus_objetivos', 'puntos_acciones', 'puntos_premios')
     obtener_tramos_comision.clear()
     obtener_bonus_objetivos.clear()
     obtener_puntos_acciones.clear()
@@ -23,55 +29,147 @@ def limpiar_cache_config():
 
 def limpiar_cache_tarifas():
     """Limpia caché de tarifas."""
+    obtener_espejo().marcar_pendiente('temporadas', 'tipos_bus', 'tipos_cliente', 'tarifas_servicio')
     obtener_temporadas.clear()
     obtener_tipos_bus.clear()
     obtener_tipos_cliente.clear()
     obtener_tarifas_servicio.clear()
 
+def limpiar_cache_tarifas_cliente():
+    """Limpia caché de tarifas personalizadas por cliente."""
+    obtener_espejo().marcar_pendiente('tarifas_cliente')
+
+def limpiar_cache_notas():
+    """Limpia caché de conteos de notas."""
+    _contar_notas_cached.clear()
+
 
 # ============================================
 # NOTAS
 # ============================================
 
 def agregar_nota(cod_presupuesto: str, cliente: str, contenido: str, tipo: str, usuario: str = "Sistema"):
-    """Agrega una nota a un cliente o presupuesto."""
-    client = get_admin_client()
-    client.table('notas').insert({
+    """Agrega una nota a un cliente o presupuesto (escritura diferida, no bloquea la UI)."""
+    cola = obtener_cola()
+    cola.al_escribir('notas', limpiar_cache_notas)
+    cola.encolar('notas', {
         'cod_presupuesto': cod_presupuesto,
         'cliente': cliente,
         'contenido': contenido,
         'tipo': tipo,
-        'usuario': usuario
-    }).execute()
+        'usuario': usuario,
+        'fecha': ahora_iso()
+    })
+
+def _con_notas_pendientes(notas: list, campo: str, valor: str) -> list:
+    """Añade las notas aún en cola de escritura para que el usuario vea lo que acaba de guardar."""
+    escritas = {n.get('id_escritura') for n in notas}
+    pendientes = [n for n in obtener_cola().pendientes('notas')
+                  if n.get(campo) == valor and n.get('id_escritura') not in escritas]
+    if not pendientes:
+        return notas
+    return sorted(pendientes + notas, key=lambda n: n.get('fecha') or '', reverse=True)
 
 def obtener_notas_cliente(cliente: str):
     """Obtiene todas las notas de un cliente."""
     client = get_admin_client()
     result = client.table('notas').select('*').eq('cliente', cliente).order('fecha', desc=True).execute()
-    return result.data or []
+    return _con_notas_pendientes(result.data or [], 'cliente', cliente)
 
 def obtener_notas_presupuesto(cod_presupuesto: str):
     """Obtiene todas las notas de un presupuesto."""
     client = get_admin_client()
     result = client.table('notas').select('*').eq('cod_presupuesto', cod_presupuesto).order('fecha', desc=True).execute()
-    return result.data or []
+    return _con_notas_pendientes(result.data or [], 'cod_presupuesto', cod_presupuesto)
 
 def obtener_todas_notas(limite: int = 100):
     """Obtiene las últimas notas."""
+    return obtener_notas_paginado(tamano=limite)['filas']
+
+def obtener_notas_paginado(tamano: int = 50, cursor: tuple = None) -> dict:
+    """Obtiene una página de notas, de más reciente a más antigua (paginación por clave)."""
     client = get_admin_client()
-    result = client.table('notas').select('*').order('fecha', desc=True).limit(limite).execute()
-    return result.data or []
+    return paginar_keyset(lambda: client.table('notas').select('*'), tamano, cursor)
 
-def buscar_notas(termino: str):
-    """Busca notas que contengan el término."""
+def buscar_notas_paginado(termino: str, limite: int = 50, cursor: tuple = None) -> dict:
+    """
+    Búsqueda de texto completo en notas (contenido, cliente y presupuesto).
+    Ordena por relevancia con la RPC buscar_notas_fts. Si la RPC no está desplegada se
+    busca la subcadena solo en el contenido, de más reciente a más antigua.
+    El cursor indica qué búsqueda lo generó: ('fts', (rank, id)) o ('subcadena', (fecha, id)).
+    Si la búsqueda cambia entre páginas se vuelve a la primera y 'reiniciada' es True
+    (quien acumula páginas debe descartar las anteriores).
+    Retorna {'notas': [...], 'cursor': siguiente cursor o None, 'reiniciada': bool}.
+    """
     client = get_admin_client()
-    result = client.table('notas').select('*').ilike('contenido', f'%{termino}%').order('fecha', desc=True).execute()
-    return result.data or []
+    origen, posicion = cursor if cursor else (None, None)
+    try:
+        desde = posicion if origen == 'fts' else None
+        result = client.rpc('buscar_notas_fts', {
+            'p_termino': termino,
+            'p_limite': limite + 1,
+            'p_cursor_rank': desde[0] if desde else None,
+            'p_cursor_id': desde[1] if desde else None
+        }).execute()
+        filas = result.data or []
+        siguiente = ('fts', (filas[limite - 1]['rank'], filas[limite - 1]['id'])) if len(filas) > limite else None
+        return {'notas': filas[:limite], 'cursor': siguiente, 'reiniciada': origen not in (None, 'fts')}
+    except Exception as e:
+        # RPC no desplegada: búsqueda por subcadena, paginada por (fecha, id)
+        print(f"RPC buscar_notas_fts no disponible: {e}")
+        desde = posicion if origen == 'subcadena' else None
+        pagina = paginar_keyset(lambda: client.table('notas').select('*').ilike('contenido', f'%{termino}%'),
+                                limite, desde)
+        return {'notas': pagina['filas'],
+                'cursor': ('subcadena', pagina['cursor']) if pagina['cursor'] else None,
+                'reiniciada': origen not in (None, 'subcadena')}
+
+def buscar_notas(termino: str, limite: int = 50):
+    """Busca notas que contengan el término (primera página, por relevancia)."""
+    return buscar_notas_paginado(termino, limite)['notas']
 
 def eliminar_nota(nota_id: int):
     """Elimina una nota por ID."""
     client = get_admin_client()
     client.table('notas').delete().eq('id', nota_id).execute()
+    limpiar_cache_notas()
+
+def contar_notas_local(notas: list, clientes=None) -> dict:
+    """
+    Equivalente local de la RPC contar_notas_por_cliente.
+    Cuenta las filas de notas por cliente, opcionalmente filtrando por una lista de clientes.
+    """
+    filtro = set(clientes) if clientes else None
+    conteo = {}
+    for nota in notas:
+        cliente = nota.get('cliente')
+        if filtro is not None and cliente not in filtro:
+            continue
+        conteo[cliente] = conteo.get(cliente, 0) + 1
+    return conteo
+
+@st.cache_data(ttl=600)
+def _contar_notas_cached(clientes: tuple = None) -> dict:
+    """Versión cacheada del conteo de notas (agregado en Supabase)."""
+    client = get_admin_client()
+    try:
+        result = client.rpc('contar_notas_por_cliente', {
+            'p_clientes': list(clientes) if clientes else None
+        }).execute()
+        return {r['cliente']: r['total'] for r in (result.data or [])}
+    except Exception as e:
+        # RPC no desplegada todavía: contar en local como antes
+        print(f"RPC contar_notas_por_cliente no disponible: {e}")
+        query = client.table('notas').select('cliente')
+        if clientes:
+            query = query.in_('cliente', list(clientes))
+        result = query.execute()
+        return contar_notas_local(result.data or [], clientes)
+
+def contar_notas_por_cliente(clientes: list = None) -> dict:
+    """Cuenta notas por cliente, opcionalmente solo para los clientes indicados (cacheado)."""
+    clave = tuple(sorted(set(clientes))) if clientes else None
+    return _contar_notas_cached(clave)
 
 
 # ============================================
@@ -90,10 +188,9 @@ def guardar_tipo_servicio(codigo: str, descripcion: str, categoria: str = ""):
 
 @st.cache_data(ttl=600)
 def obtener_tipos_servicio_db():
-    """Obtiene todos los tipos de servicio (cacheado)."""
-    client = get_admin_client()
-    result = client.table('tipos_servicio').select('*').order('codigo').execute()
-    return {t['codigo']: {'descripcion': t['descripcion'], 'categoria': t['categoria']} for t in (result.data or [])}
+    """Obtiene todos los tipos de servicio (cacheado, desde el espejo local)."""
+    tipos = leer_referencia('tipos_servicio', orden=['codigo'])
+    return {t['codigo']: {'descripcion': t['descripcion'], 'categoria': t['categoria']} for t in tipos}
 
 def obtener_descripcion_tipo(codigo: str):
     """Obtiene la descripción de un tipo de servicio."""
@@ -163,10 +260,8 @@ def guardar_tramo_comision(desde: float, hasta: float, porcentaje: float):
 
 @st.cache_data(ttl=600)
 def obtener_tramos_comision():
-    """Obtiene todos los tramos de comisión (cacheado)."""
-    client = get_admin_client()
-    result = client.table('comisiones_tramos').select('*').eq('activo', True).order('desde').execute()
-    return result.data or []
+    """Obtiene todos los tramos de comisión (cacheado, desde el espejo local)."""
+    return leer_referencia('comisiones_tramos', {'activo': True}, orden=['desde'])
 
 def eliminar_tramo_comision(tramo_id: int):
     """Elimina un tramo de comisión."""
@@ -199,10 +294,8 @@ def guardar_bonus(nombre: str, tipo: str, condicion: str, valor_objetivo: float,
 
 @st.cache_data(ttl=600)
 def obtener_bonus_objetivos():
-    """Obtiene todos los bonus activos (cacheado)."""
-    client = get_admin_client()
-    result = client.table('bonus_objetivos').select('*').eq('activo', True).execute()
-    return result.data or []
+    """Obtiene todos los bonus activos (cacheado, desde el espejo local)."""
+    return leer_referencia('bonus_objetivos', {'activo': True}, orden=['id'])
 
 def eliminar_bonus(bonus_id: int):
     """Elimina un bonus."""
@@ -233,10 +326,8 @@ def guardar_puntos_accion(nombre: str, accion: str, puntos: int):
 
 @st.cache_data(ttl=600)
 def obtener_puntos_acciones():
-    """Obtiene todas las acciones con puntos (cacheado)."""
-    client = get_admin_client()
-    result = client.table('puntos_acciones').select('*').eq('activo', True).execute()
-    return result.data or []
+    """Obtiene todas las acciones con puntos (cacheado, desde el espejo local)."""
+    return leer_referencia('puntos_acciones', {'activo': True}, orden=['id'])
 
 def eliminar_puntos_accion(accion_id: int):
     """Elimina una acción de puntos."""
@@ -267,10 +358,8 @@ def guardar_premio(nombre: str, puntos_requeridos: int, descripcion: str = ""):
 
 @st.cache_data(ttl=600)
 def obtener_premios():
-    """Obtiene todos los premios activos (cacheado)."""
-    client = get_admin_client()
-    result = client.table('puntos_premios').select('*').eq('activo', True).order('puntos_requeridos').execute()
-    return result.data or []
+    """Obtiene todos los premios activos (cacheado, desde el espejo local)."""
+    return leer_referencia('puntos_premios', {'activo': True}, orden=['puntos_requeridos'])
 
 def eliminar_premio(premio_id: int):
     """Elimina un premio."""
@@ -382,10 +471,8 @@ def guardar_temporada(codigo: str, nombre: str, fecha_inicio: str, fecha_fin: st
 
 @st.cache_data(ttl=600)
 def obtener_temporadas():
-    """Obtiene todas las temporadas activas (cacheado)."""
-    client = get_admin_client()
-    result = client.table('temporadas').select('*').eq('activo', True).order('fecha_inicio').execute()
-    return result.data or []
+    """Obtiene todas las temporadas activas (cacheado, desde el espejo local)."""
+    return leer_referencia('temporadas', {'activo': True}, orden=['fecha_inicio'])
 
 def eliminar_temporada(codigo: str):
     """Elimina una temporada."""
@@ -437,10 +524,8 @@ def guardar_tipo_bus(codigo: str, nombre: str, capacidad: int, precio_base_hora:
 
 @st.cache_data(ttl=600)
 def obtener_tipos_bus():
-    """Obtiene todos los tipos de bus activos (cacheado)."""
-    client = get_admin_client()
-    result = client.table('tipos_bus').select('*').eq('activo', True).order('capacidad').execute()
-    return result.data or []
+    """Obtiene todos los tipos de bus activos (cacheado, desde el espejo local)."""
+    return leer_referencia('tipos_bus', {'activo': True}, orden=['capacidad'])
 
 def eliminar_tipo_bus(codigo: str):
     """Elimina un tipo de bus."""
@@ -562,10 +647,8 @@ def guardar_tipo_cliente(codigo: str, nombre: str, multiplicador: float = 1.0):
 
 @st.cache_data(ttl=600)
 def obtener_tipos_cliente():
-    """Obtiene todos los tipos de cliente activos (cacheado)."""
-    client = get_admin_client()
-    result = client.table('tipos_cliente').select('*').eq('activo', True).order('nombre').execute()
-    return result.data or []
+    """Obtiene todos los tipos de cliente activos (cacheado, desde el espejo local)."""
+    return leer_referencia('tipos_cliente', {'activo': True}, orden=['nombre'])
 
 def eliminar_tipo_cliente(codigo: str):
     """Elimina un tipo de cliente."""
@@ -602,10 +685,8 @@ def guardar_tarifa_servicio(tipo_servicio: str, tipo_bus: str, precio_hora: floa
 
 @st.cache_data(ttl=600)
 def obtener_tarifas_servicio():
-    """Obtiene todas las tarifas por servicio (cacheado)."""
-    client = get_admin_client()
-    result = client.table('tarifas_servicio').select('*').eq('activo', True).order('tipo_servicio').execute()
-    return result.data or []
+    """Obtiene todas las tarifas por servicio (cacheado, desde el espejo local)."""
+    return leer_referencia('tarifas_servicio', {'activo': True}, orden=['tipo_servicio'])
 
 def obtener_tarifa_servicio(tipo_servicio: str, tipo_bus: str):
     """Obtiene la tarifa para un tipo de servicio y bus específico."""
@@ -639,46 +720,31 @@ def guardar_tarifa_cliente(cliente: str, tipo_bus: str = None, tipo_servicio: st
         'tipo_servicio': tipo_servicio,
         'precio_hora': precio_hora,
         'precio_km': precio_km,
-        'notas': notas,
-        'fecha_actualizacion': datetime.now().isoformat()
+        'notas': notas
     }
 
     if existe.data:
         client.table('tarifas_cliente').update(datos).eq('id', existe.data[0]['id']).execute()
     else:
         client.table('tarifas_cliente').insert(datos).execute()
+    limpiar_cache_tarifas_cliente()
 
 def obtener_tarifas_cliente(cliente: str = None):
-    """Obtiene las tarifas personalizadas de un cliente o todas."""
-    client = get_admin_client()
-    query = client.table('tarifas_cliente').select('*').eq('activo', True)
+    """Obtiene las tarifas personalizadas de un cliente o todas (desde el espejo local)."""
+    filtros = {'activo': True}
     if cliente:
-        query = query.eq('cliente', cliente)
-    result = query.order('cliente').execute()
-    return result.data or []
+        filtros['cliente'] = cliente
+    return leer_referencia('tarifas_cliente', filtros, orden=['cliente'])
 
 def obtener_tarifa_cliente_especifica(cliente: str, tipo_bus: str, tipo_servicio: str):
     """Obtiene la tarifa específica de un cliente."""
-    client = get_admin_client()
-    # Buscar tarifa exacta
-    result = client.table('tarifas_cliente').select('*').eq('cliente', cliente).eq('tipo_bus', tipo_bus).eq('tipo_servicio', tipo_servicio).eq('activo', True).execute()
-    if result.data:
-        return result.data[0]
-
-    # Buscar con comodín en tipo_servicio
-    result = client.table('tarifas_cliente').select('*').eq('cliente', cliente).eq('tipo_bus', tipo_bus).eq('tipo_servicio', '*').eq('activo', True).execute()
-    if result.data:
-        return result.data[0]
+    tarifas = obtener_tarifas_cliente(cliente)
 
-    # Buscar con comodín en tipo_bus
-    result = client.table('tarifas_cliente').select('*').eq('cliente', cliente).eq('tipo_bus', '*').eq('tipo_servicio', tipo_servicio).eq('activo', True).execute()
-    if result.data:
-        return result.data[0]
-
-    # Buscar con ambos comodines
-    result = client.table('tarifas_cliente').select('*').eq('cliente', cliente).eq('tipo_bus', '*').eq('tipo_servicio', '*').eq('activo', True).execute()
-    if result.data:
-        return result.data[0]
+    # Exacta, comodín en tipo_servicio, comodín en tipo_bus y ambos comodines
+    for bus, servicio in [(tipo_bus, tipo_servicio), (tipo_bus, '*'), ('*', tipo_servicio), ('*', '*')]:
+        tarifa = next((t for t in tarifas if t['tipo_bus'] == bus and t['tipo_servicio'] == servicio), None)
+        if tarifa:
+            return tarifa
 
     return None
 
@@ -686,6 +752,7 @@ def eliminar_tarifa_cliente(cliente: str, tipo_bus: str, tipo_servicio: str):
     """Elimina una tarifa de cliente."""
     client = get_admin_client()
     client.table('tarifas_cliente').delete().eq('cliente', cliente).eq('tipo_bus', tipo_bus).eq('tipo_servicio', tipo_servicio).execute()
+    limpiar_cache_tarifas_cliente()
 
 
 # ============================================
@@ -763,16 +830,6 @@ def init_incentivos_db():
     """Función de compatibilidad - no hace nada con Supabase."""
     pass
 
-def contar_notas_por_cliente():
-    """Cuenta notas por cliente."""
-    client = get_admin_client()
-    result = client.table('notas').select('cliente').execute()
-    conteo = {}
-    for nota in (result.data or []):
-        cliente = nota['cliente']
-        conteo[cliente] = conteo.get(cliente, 0) + 1
-    return conteo
-
 
 # ============================================
 # LUGARES FRECUENTES (Calculadora)
@@ -800,6 +857,7 @@ def guardar_lugar_frecuente(nombre: str, direccion: str, lat: float, lng: float,
             'lng': lng,
             'tipo': tipo
         }).execute()
+    obtener_cache_geocodificacion().sembrar([{'nombre': nombre, 'direccion': direccion, 'lat': lat, 'lng': lng}])
 
 def obtener_lugares_frecuentes(limite: int = None):
     """Obtiene los lugares frecuentes."""
@@ -935,3 +993,29 @@ def esta_cliente_desactivado(cliente: str) -> bool:
     """Verifica si un cliente está desactivado."""
     desactivados = obtener_clientes_desactivados()
     return cliente in desactivados
+
+
+# ============================================
+# INVALIDACIÓN ENTRE PROCESOS
+# ============================================
+
+def _marcar_espejo(tabla: str):
+    """Callable que fuerza la sincronización de la tabla en el espejo local."""
+    return lambda: obtener_espejo().marcar_pendiente(tabla)
+
+# Cuando otro proceso escribe en una tabla se limpian solo estas cachés
+for _tabla, _funciones in {
+    'tipos_servicio': [obtener_tipos_servicio_db],
+    'comisiones_tramos': [obtener_tramos_comision],
+    'bonus_objetivos': [obtener_bonus_objetivos],
+    'puntos_acciones': [obtener_puntos_acciones],
+    'puntos_premios': [obtener_premios],
+    'temporadas': [obtener_temporadas],
+    'tipos_bus': [obtener_tipos_bus],
+    'tipos_cliente': [obtener_tipos_cliente],
+    'tarifas_servicio': [obtener_tarifas_servicio],
+    'tarifas_cliente': [],
+}.items():
+    registrar_invalidacion(_tabla, _marcar_espejo(_tabla), *_funciones)
+
+registrar_invalidacion('notas', _contar_notas_cached)
@@ -5,6 +5,9 @@ Con caché para mejor rendimiento
 """
 import streamlit as st
 from supabase_client import get_admin_client
+from espejo_local import obtener_espejo, leer_referencia
+from invalidacion import registrar_invalidacion
+from estadisticas_mercado import MotorMercado
 from datetime import datetime
 
 # Factor de normalización para comparar precios entre tipos de vehículo
@@ -21,27 +24,49 @@ FACTOR_VEHICULO_NORM = {
 # FUNCIONES DE CACHÉ
 # ============================================
 
+# Las dependencias entre tablas y cachés se declaran al final del módulo
+# (_CACHES_POR_TABLA y _CACHES_DERIVADAS), una vez definidas las funciones.
+
+def invalidar_competencia(*tablas) -> list:
+    """
+    Limpia solo las cachés de competencia que dependen de las tablas indicadas,
+    directamente o a través de otra caché derivada. Retorna los nombres limpiados.
+    """
+    cachés = []
+    for tabla in tablas:
+        for cache in _CACHES_POR_TABLA.get(tabla, []):
+            if cache not in cachés:
+                cachés.append(cache)
+
+    # Cierre transitivo: una caché calculada a partir de otra también queda obsoleta
+    i = 0
+    while i < len(cachés):
+        for derivada in _CACHES_DERIVADAS.get(cachés[i], []):
+            if derivada not in cachés:
+                cachés.append(derivada)
+        i += 1
+
+    if 'competidores' in tablas:
+        obtener_espejo().marcar_pendiente('competidores')
+    for cache in cachés:
+        cache.clear()
+    return [getattr(c, '__name__', str(c)) for c in cachés]
+
 def limpiar_cache_competencia():
-    """Limpia todo el caché de competencia."""
-    st.cache_data.clear()
+    """Limpia todas las cachés de competencia (sin tocar las del resto de la app)."""
+    invalidar_competencia(*_CACHES_POR_TABLA)
 
 def limpiar_cache_competidores():
     """Limpia caché de competidores."""
-    _obtener_competidores_cached.clear()
-    _obtener_estadisticas_flota_cached.clear()
-    _obtener_comparativa_flotas_cached.clear()
+    invalidar_competencia('competidores')
 
 def limpiar_cache_vehiculos():
     """Limpia caché de vehículos."""
-    _obtener_vehiculos_cached.clear()
-    _obtener_estadisticas_flota_cached.clear()
-    _obtener_comparativa_flotas_cached.clear()
+    invalidar_competencia('vehiculos_competencia')
 
 def limpiar_cache_cotizaciones():
     """Limpia caché de cotizaciones."""
-    _obtener_cotizaciones_cached.clear()
-    _obtener_estadisticas_mercado_cached.clear()
-    _obtener_ranking_cached.clear()
+    invalidar_competencia('cotizaciones_competencia')
 
 
 # ============================================
@@ -50,13 +75,8 @@ def limpiar_cache_cotizaciones():
 
 @st.cache_data(ttl=300, show_spinner="Cargando competidores...")
 def _obtener_competidores_cached(solo_activos: bool = True) -> list:
-    """Versión cacheada de obtener competidores."""
-    client = get_admin_client()
-    query = client.table('competidores').select('*')
-    if solo_activos:
-        query = query.eq('activo', True)
-    result = query.order('nombre').execute()
-    return result.data or []
+    """Versión cacheada de obtener competidores (desde el espejo local)."""
+    return leer_referencia('competidores', {'activo': True} if solo_activos else None, orden=['nombre'])
 
 def obtener_competidores(solo_activos: bool = True) -> list:
     """Obtiene la lista de competidores (cacheado)."""
@@ -76,8 +96,7 @@ def guardar_competidor(nombre: str, segmento: str = 'estandar', zona_operacion:
             'flota_estimada': flota_estimada,
             'fortalezas': fortalezas,
             'debilidades': debilidades,
-            'notas': notas,
-            'fecha_actualizacion': datetime.now().isoformat()
+            'notas': notas
         }).eq('nombre', nombre).execute()
         limpiar_cache_competidores()
         return existe.data[0]['id']
@@ -99,16 +118,57 @@ def obtener_competidor_por_id(competidor_id: int) -> dict:
     competidores = obtener_competidores()
     return next((c for c in competidores if c['id'] == competidor_id), None)
 
-def eliminar_competidor(competidor_id: int) -> bool:
-    """Elimina un competidor y sus datos relacionados."""
+def eliminar_competidor(competidor_id: int) -> dict:
+    """
+    Elimina un competidor y sus datos relacionados en una sola transacción.
+    Retorna {'eliminado': bool, 'cotizaciones': n, 'vehiculos': n} con los dependientes borrados.
+    """
     client = get_admin_client()
-    client.table('cotizaciones_competencia').delete().eq('competidor_id', competidor_id).execute()
-    client.table('vehiculos_competencia').delete().eq('competidor_id', competidor_id).execute()
-    result = client.table('competidores').delete().eq('id', competidor_id).execute()
-    limpiar_cache_competidores()
-    limpiar_cache_vehiculos()
-    limpiar_cache_cotizaciones()
-    return len(result.data) > 0 if result.data else False
+    try:
+        result = client.rpc('eliminar_competidor', {'p_competidor_id': competidor_id}).execute()
+        fila = (result.data or [{}])[0]
+        resumen = {
+            'eliminado': bool(fila.get('eliminado')),
+            'cotizaciones': fila.get('cotizaciones', 0),
+            'vehiculos': fila.get('vehiculos', 0)
+        }
+    except Exception as e:
+        # RPC no desplegada todavía: un único DELETE y el ON DELETE CASCADE borra el resto
+        print(f"RPC eliminar_competidor no disponible: {e}")
+        conteo = client.table('competidores').select(
+            'id, cotizaciones_competencia(count), vehiculos_competencia(count)'
+        ).eq('id', competidor_id).execute().data or []
+        result = client.table('competidores').delete().eq('id', competidor_id).execute()
+        eliminado = bool(result.data)
+        fila = conteo[0] if conteo and eliminado else {}
+        resumen = {
+            'eliminado': eliminado,
+            'cotizaciones': (fila.get('cotizaciones_competencia') or [{}])[0].get('count', 0),
+            'vehiculos': (fila.get('vehiculos_competencia') or [{}])[0].get('count', 0)
+        }
+
+    invalidar_competencia('competidores', 'vehiculos_competencia', 'cotizaciones_competencia')
+    return resumen
+
+def eliminar_competidor_en_memoria(tablas: dict, competidor_id: int) -> dict:
+    """
+    Equivalente local de eliminar_competidor para pruebas sin Supabase.
+    tablas: {'competidores': [...], 'vehiculos_competencia': [...], 'cotizaciones_competencia': [...]}
+    Las listas se sustituyen a la vez al final: o se borra todo o no se borra nada.
+    """
+    competidores = [c for c in tablas.get('competidores', []) if c['id'] != competidor_id]
+    if len(competidores) == len(tablas.get('competidores', [])):
+        return {'eliminado': False, 'cotizaciones': 0, 'vehiculos': 0}
+
+    nuevas = {'competidores': competidores}
+    resumen = {'eliminado': True}
+    for tabla, clave in (('cotizaciones_competencia', 'cotizaciones'), ('vehiculos_competencia', 'vehiculos')):
+        filas = tablas.get(tabla, [])
+        nuevas[tabla] = [f for f in filas if f.get('competidor_id') != competidor_id]
+        resumen[clave] = len(filas) - len(nuevas[tabla])
+
+    tablas.update(nuevas)
+    return resumen
 
 
 # ============================================
@@ -177,6 +237,21 @@ def eliminar_cotizacion_competencia(cotizacion_id: int) -> bool:
 # VEHÍCULOS (con caché)
 # ============================================
 
+class MatriculaDuplicada(ValueError):
+    """La matrícula ya existe para ese competidor (índice único competidor_id, matricula)."""
+
+
+def _es_matricula_duplicada(error: Exception) -> bool:
+    """True si Supabase rechazó la escritura por el índice único de matrícula (23505)."""
+    return str(getattr(error, 'code', '')) == '23505' or 'idx_vehiculos_competidor_matricula' in str(error)
+
+
+def normalizar_matricula(matricula) -> str:
+    """Matrícula en mayúsculas y sin espacios ni guiones ('2903 kgp' -> '2903KGP')."""
+    if not matricula:
+        return None
+    return ''.join(str(matricula).split()).replace('-', '').upper() or None
+
 @st.cache_data(ttl=300, show_spinner="Cargando vehículos...")
 def _obtener_vehiculos_cached(competidor_id: int = None, solo_activos: bool = True) -> list:
     """Versión cacheada de obtener vehículos."""
@@ -205,35 +280,41 @@ def guardar_vehiculo_competencia(competidor_id: int, matricula: str = None, tipo
                                  ano_matriculacion: int = None, distintivo_ambiental: str = '',
                                  pmr: bool = False, wc: bool = False, wifi: bool = False,
                                  escolar: bool = False, observaciones: str = '') -> int:
-    """Guarda un vehículo de competidor."""
+    """Guarda un vehículo de competidor. Lanza MatriculaDuplicada si el competidor ya la tiene."""
     client = get_admin_client()
 
     edad = None
     if ano_matriculacion:
         edad = round(datetime.now().year - ano_matriculacion + (datetime.now().month / 12), 1)
 
-    result = client.table('vehiculos_competencia').insert({
-        'competidor_id': competidor_id,
-        'matricula': matricula,
-        'tipo_vehiculo': tipo_vehiculo,
-        'marca': marca,
-        'modelo': modelo,
-        'plazas': plazas,
-        'ano_matriculacion': ano_matriculacion,
-        'edad': edad,
-        'distintivo_ambiental': distintivo_ambiental,
-        'pmr': pmr,
-        'wc': wc,
-        'wifi': wifi,
-        'escolar': escolar,
-        'observaciones': observaciones
-    }).execute()
+    matricula = normalizar_matricula(matricula)
+    try:
+        result = client.table('vehiculos_competencia').insert({
+            'competidor_id': competidor_id,
+            'matricula': matricula,
+            'tipo_vehiculo': tipo_vehiculo,
+            'marca': marca,
+            'modelo': modelo,
+            'plazas': plazas,
+            'ano_matriculacion': ano_matriculacion,
+            'edad': edad,
+            'distintivo_ambiental': distintivo_ambiental,
+            'pmr': pmr,
+            'wc': wc,
+            'wifi': wifi,
+            'escolar': escolar,
+            'observaciones': observaciones
+        }).execute()
+    except Exception as e:
+        if _es_matricula_duplicada(e):
+            raise MatriculaDuplicada(f"La matrícula {matricula} ya existe") from e
+        raise
 
     limpiar_cache_vehiculos()
     return result.data[0]['id'] if result.data else None
 
 def actualizar_vehiculo_competencia(vehiculo_id: int, **kwargs) -> bool:
-    """Actualiza un vehículo de la competencia."""
+    """Actualiza un vehículo de la competencia. Lanza MatriculaDuplicada si choca con otro."""
     client = get_admin_client()
 
     if not kwargs:
@@ -241,115 +322,280 @@ def actualizar_vehiculo_competencia(vehiculo_id: int, **kwargs) -> bool:
 
     if 'ano_matriculacion' in kwargs and kwargs['ano_matriculacion']:
         kwargs['edad'] = round(datetime.now().year - kwargs['ano_matriculacion'] + (datetime.now().month / 12), 1)
+    if 'matricula' in kwargs:
+        kwargs['matricula'] = normalizar_matricula(kwargs['matricula'])
+
+    try:
+        result = client.table('vehiculos_competencia').update(kwargs).eq('id', vehiculo_id).execute()
+    except Exception as e:
+        if _es_matricula_duplicada(e):
+            raise MatriculaDuplicada(f"La matrícula {kwargs.get('matricula')} ya existe") from e
+        raise
+    limpiar_cache_vehiculos()
+    return len(result.data) > 0 if result.data else False
 
-    kwargs['fecha_actualizacion'] = datetime.now().isoformat()
+# Columnas que se pueden modificar desde la tabla editable de Flotas
+COLUMNAS_EDITABLES_FLOTA = ('matricula', 'marca', 'modelo', 'plazas', 'ano_matriculacion',
+                            'distintivo_ambiental', 'activo')
+
+def _valor_editor(valor):
+    """Normaliza un valor venido de un DataFrame (NaN -> None, tipos numpy -> Python)."""
+    if hasattr(valor, 'item'):
+        valor = valor.item()
+    if isinstance(valor, float):
+        if valor != valor:
+            return None
+        if valor.is_integer():
+            return int(valor)
+    if valor == '':
+        return None
+    return valor
+
+def calcular_cambios_flota(originales: list, editados: list) -> list:
+    """
+    Compara las filas originales con las editadas (dicts con 'id' y columnas editables).
+    Retorna [{'id', 'matricula', 'campos': {columna: (antes, después)}}] solo de las filas modificadas.
+    """
+    por_id = {fila['id']: fila for fila in originales}
+    cambios = []
+    for fila in editados:
+        original = por_id.get(fila['id'])
+        if original is None:
+            continue
+        campos = {}
+        for col in COLUMNAS_EDITABLES_FLOTA:
+            if col not in fila:
+                continue
+            antes, despues = _valor_editor(original.get(col)), _valor_editor(fila.get(col))
+            if col == 'matricula':
+                antes, despues = normalizar_matricula(antes), normalizar_matricula(despues)
+            if antes != despues:
+                campos[col] = (antes, despues)
+        if campos:
+            cambios.append({'id': fila['id'], 'matricula': _valor_editor(fila.get('matricula')), 'campos': campos})
+    return cambios
+
+def guardar_cambios_flota(competidor_id: int, originales: list, editados: list) -> dict:
+    """
+    Guarda las ediciones de la tabla de Flotas en una sola petición.
+    Solo se envían las filas que han cambiado, con upsert sobre 'id'.
+    Retorna {'modificados': n, 'cambios': [...]} (ver calcular_cambios_flota).
+    Lanza MatriculaDuplicada si alguna matrícula editada ya la tiene otro vehículo.
+    """
+    cambios = calcular_cambios_flota(originales, editados)
+    if not cambios:
+        return {'modificados': 0, 'cambios': []}
+
+    editados_por_id = {fila['id']: fila for fila in editados}
+    ahora = datetime.now()
+    filas = []
+    for cambio in cambios:
+        fila = editados_por_id[cambio['id']]
+        # Todas las filas llevan las mismas columnas para que el upsert no ponga ninguna a NULL
+        registro = {col: _valor_editor(fila.get(col)) for col in COLUMNAS_EDITABLES_FLOTA}
+        registro['matricula'] = normalizar_matricula(registro['matricula'])
+        registro['activo'] = bool(registro['activo'])
+        ano = registro['ano_matriculacion']
+        registro['edad'] = round(ahora.year - ano + (ahora.month / 12), 1) if ano else None
+        registro.update({'id': cambio['id'], 'competidor_id': competidor_id})
+        filas.append(registro)
 
-    result = client.table('vehiculos_competencia').update(kwargs).eq('id', vehiculo_id).execute()
+    client = get_admin_client()
+    try:
+        client.table('vehiculos_competencia').upsert(filas, on_conflict='id').execute()
+    except Exception as e:
+        if _es_matricula_duplicada(e):
+            editadas = ', '.join(c['campos']['matricula'][1] or '' for c in cambios if 'matricula' in c['campos'])
+            raise MatriculaDuplicada(f"La matrícula ya existe en otro vehículo ({editadas})") from e
+        raise
     limpiar_cache_vehiculos()
-    return len(result.data) > 0 if result.data else False
+    return {'modificados': len(cambios), 'cambios': cambios}
 
 def eliminar_vehiculo_competencia(vehiculo_id: int) -> bool:
     """Elimina un vehículo (soft delete)."""
     client = get_admin_client()
     result = client.table('vehiculos_competencia').update({
-        'activo': False,
-        'fecha_actualizacion': datetime.now().isoformat()
+        'activo': False
     }).eq('id', vehiculo_id).execute()
     limpiar_cache_vehiculos()
     return len(result.data) > 0 if result.data else False
 
-def importar_vehiculos_masivo(competidor_id: int, vehiculos: list) -> int:
-    """Importa múltiples vehículos para un competidor."""
-    count = 0
-    for v in vehiculos:
-        try:
-            guardar_vehiculo_competencia(
-                competidor_id=competidor_id,
-                matricula=v.get('matricula'),
-                tipo_vehiculo=v.get('tipo_vehiculo', 'AUTOBUS'),
-                marca=v.get('marca', ''),
-                modelo=v.get('modelo', ''),
-                plazas=v.get('plazas'),
-                ano_matriculacion=v.get('ano_matriculacion'),
-                distintivo_ambiental=v.get('distintivo_ambiental', ''),
-                pmr=v.get('pmr', False),
-                wc=v.get('wc', False),
-                wifi=v.get('wifi', False),
-                escolar=v.get('escolar', False),
-                observaciones=v.get('observaciones', '')
-            )
-            count += 1
-        except Exception as e:
-            print(f"Error importando vehículo: {e}")
-    return count
+# Columnas que acepta la importación masiva
+_COLUMNAS_IMPORTACION = ('matricula', 'tipo_vehiculo', 'marca', 'modelo', 'plazas', 'ano_matriculacion',
+                         'distintivo_ambiental', 'pmr', 'wc', 'wifi', 'escolar', 'activo', 'observaciones')
+
+def importar_vehiculos_masivo(competidor_id: int, vehiculos: list, tamano_lote: int = 200) -> dict:
+    """
+    Importa (o actualiza) vehículos de un competidor por lotes.
+
+    Los vehículos con matrícula se insertan con upsert sobre (competidor_id, matricula),
+    así que reimportar la misma lista no duplica nada. Solo se escriben las columnas
+    presentes en los datos; las matrículas repetidas en la lista se importan una vez.
+
+    Retorna {'total', 'creados', 'actualizados', 'duplicados', 'errores',
+             'detalle': [{'fila', 'matricula', 'estado', 'mensaje'}]}.
+    """
+    client = get_admin_client()
+    detalle = []
+    con_matricula = {}   # matrícula -> (fila, registro)
+    sin_matricula = []   # [(fila, registro)]
+
+    for i, v in enumerate(vehiculos, start=1):
+        registro = {k: v[k] for k in _COLUMNAS_IMPORTACION if k in v}
+        registro['competidor_id'] = competidor_id
+        registro['matricula'] = normalizar_matricula(v.get('matricula'))
+        if registro.get('ano_matriculacion'):
+            registro['edad'] = round(datetime.now().year - int(registro['ano_matriculacion']) + (datetime.now().month / 12), 1)
+
+        mat = registro['matricula']
+        if mat is None:
+            sin_matricula.append((i, registro))
+        elif mat in con_matricula:
+            detalle.append({'fila': i, 'matricula': mat, 'estado': 'duplicado',
+                            'mensaje': f"Repetida en la fila {con_matricula[mat][0]}"})
+        else:
+            con_matricula[mat] = (i, registro)
+
+    # Una sola consulta para saber qué matrículas ya existían
+    existentes = set()
+    if con_matricula:
+        result = client.table('vehiculos_competencia').select('matricula').eq('competidor_id', competidor_id).execute()
+        existentes = {normalizar_matricula(r['matricula']) for r in result.data or [] if r.get('matricula')}
+
+    def escribir(filas: list, upsert: bool):
+        registros = [r for _, r in filas]
+        if upsert:
+            client.table('vehiculos_competencia').upsert(registros, on_conflict='competidor_id,matricula').execute()
+        else:
+            client.table('vehiculos_competencia').insert(registros).execute()
+
+    def lotes(filas: list):
+        # Cada lote lleva las mismas columnas: una fila sin 'marca' no debe poner a NULL la existente
+        grupos = {}
+        for fila in filas:
+            grupos.setdefault(tuple(sorted(fila[1])), []).append(fila)
+        for grupo in grupos.values():
+            for inicio in range(0, len(grupo), tamano_lote):
+                yield grupo[inicio:inicio + tamano_lote]
+
+    def procesar(filas: list, upsert: bool):
+        for lote in lotes(filas):
+            try:
+                escribir(lote, upsert)
+                resultados = [(fila, None) for fila in lote]
+            except Exception as e:
+                # Aislar las filas que fallan para no perder el resto del lote
+                print(f"Error importando lote de vehículos: {e}")
+                if len(lote) == 1:
+                    resultados = [(lote[0], str(e))]
+                    lote = []
+                else:
+                    resultados = []
+                for fila in lote:
+                    try:
+                        escribir([fila], upsert)
+                        resultados.append((fila, None))
+                    except Exception as e_fila:
+                        resultados.append((fila, str(e_fila)))
+
+            for (num, registro), error in resultados:
+                mat = registro['matricula']
+                if error:
+                    estado = 'error'
+                else:
+                    estado = 'actualizado' if mat in existentes else 'creado'
+                detalle.append({'fila': num, 'matricula': mat, 'estado': estado, 'mensaje': error or ''})
+
+    procesar(list(con_matricula.values()), upsert=True)
+    procesar(sin_matricula, upsert=False)
+
+    if any(d['estado'] in ('creado', 'actualizado') for d in detalle):
+        limpiar_cache_vehiculos()
+
+    detalle.sort(key=lambda d: d['fila'])
+    return {
+        'total': len(vehiculos),
+        'creados': sum(1 for d in detalle if d['estado'] == 'creado'),
+        'actualizados': sum(1 for d in detalle if d['estado'] == 'actualizado'),
+        'duplicados': sum(1 for d in detalle if d['estado'] == 'duplicado'),
+        'errores': sum(1 for d in detalle if d['estado'] == 'error'),
+        'detalle': detalle
+    }
 
 
 # ============================================
 # ESTADÍSTICAS (con caché)
 # ============================================
 
+def calcular_estadisticas_flota(competidores: list, vehiculos: list) -> list:
+    """
+    Equivalente local de la vista v_estadisticas_flota.
+    competidores: filas con id y nombre; vehiculos: filas activas de vehiculos_competencia.
+    """
+    stats = {c['id']: {
+        'competidor_id': c['id'],
+        'competidor': c['nombre'],
+        'total_vehiculos': 0,
+        'buses_grandes': 0,
+        'buses_medianos': 0,
+        'microbuses': 0,
+        'edad_media': None,
+        'capacidad_total': 0,
+        'con_pmr': 0,
+        'con_wc': 0,
+        'con_wifi': 0,
+        'escolares': 0
+    } for c in competidores}
+    edades = {cid: [] for cid in stats}
+
+    # Una sola pasada por la flota
+    for v in vehiculos:
+        s = stats.get(v['competidor_id'])
+        if s is None:
+            continue
+        plazas = v.get('plazas') or 0
+        s['total_vehiculos'] += 1
+        if plazas >= 50:
+            s['buses_grandes'] += 1
+        elif plazas >= 30:
+            s['buses_medianos'] += 1
+        else:
+            s['microbuses'] += 1
+        s['capacidad_total'] += plazas
+        s['con_pmr'] += 1 if v.get('pmr') else 0
+        s['con_wc'] += 1 if v.get('wc') else 0
+        s['con_wifi'] += 1 if v.get('wifi') else 0
+        s['escolares'] += 1 if v.get('escolar') else 0
+        if v.get('edad'):
+            edades[v['competidor_id']].append(float(v['edad']))
+
+    for cid, lista in edades.items():
+        if lista:
+            stats[cid]['edad_media'] = round(sum(lista) / len(lista), 1)
+
+    resultado = list(stats.values())
+    resultado.sort(key=lambda x: x['total_vehiculos'], reverse=True)
+    return resultado
+
 @st.cache_data(ttl=300, show_spinner="Calculando estadísticas...")
 def _obtener_estadisticas_flota_cached() -> list:
-    """Versión cacheada de estadísticas de flota."""
+    """Versión cacheada de estadísticas de flota (una fila resumen por competidor)."""
     client = get_admin_client()
 
-    competidores = client.table('competidores').select('id, nombre').eq('activo', True).execute().data or []
-    vehiculos_todos = client.table('vehiculos_competencia').select('*').eq('activo', True).execute().data or []
-
-    # Agrupar vehículos por competidor
-    vehiculos_por_comp = {}
-    for v in vehiculos_todos:
-        cid = v['competidor_id']
-        if cid not in vehiculos_por_comp:
-            vehiculos_por_comp[cid] = []
-        vehiculos_por_comp[cid].append(v)
-
-    stats = []
-    for comp in competidores:
-        vehiculos = vehiculos_por_comp.get(comp['id'], [])
-        total = len(vehiculos)
-
-        if total == 0:
-            stats.append({
-                'competidor_id': comp['id'],
-                'competidor': comp['nombre'],
-                'total_vehiculos': 0,
-                'buses_grandes': 0,
-                'buses_medianos': 0,
-                'microbuses': 0,
-                'edad_media': None,
-                'capacidad_total': 0,
-                'con_pmr': 0,
-                'con_wc': 0,
-                'con_wifi': 0,
-                'escolares': 0
-            })
-            continue
-
-        buses_grandes = sum(1 for v in vehiculos if (v.get('plazas') or 0) >= 50)
-        buses_medianos = sum(1 for v in vehiculos if 30 <= (v.get('plazas') or 0) < 50)
-        microbuses = sum(1 for v in vehiculos if (v.get('plazas') or 0) < 30)
-
-        edades = [v.get('edad') for v in vehiculos if v.get('edad')]
-        edad_media = round(sum(edades) / len(edades), 1) if edades else None
-
-        stats.append({
-            'competidor_id': comp['id'],
-            'competidor': comp['nombre'],
-            'total_vehiculos': total,
-            'buses_grandes': buses_grandes,
-            'buses_medianos': buses_medianos,
-            'microbuses': microbuses,
-            'edad_media': edad_media,
-            'capacidad_total': sum(v.get('plazas') or 0 for v in vehiculos),
-            'con_pmr': sum(1 for v in vehiculos if v.get('pmr')),
-            'con_wc': sum(1 for v in vehiculos if v.get('wc')),
-            'con_wifi': sum(1 for v in vehiculos if v.get('wifi')),
-            'escolares': sum(1 for v in vehiculos if v.get('escolar'))
-        })
-
-    stats.sort(key=lambda x: x['total_vehiculos'], reverse=True)
-    return stats
+    try:
+        result = client.table('v_estadisticas_flota').select('*').order('total_vehiculos', desc=True).execute()
+        stats = result.data or []
+        for s in stats:
+            if s.get('edad_media') is not None:
+                s['edad_media'] = float(s['edad_media'])
+        return stats
+    except Exception as e:
+        # Vista no desplegada: descargar la flota y agregar en local
+        print(f"Vista v_estadisticas_flota no disponible: {e}")
+        competidores = client.table('competidores').select('id, nombre').eq('activo', True).execute().data or []
+        vehiculos = client.table('vehiculos_competencia')\
+            .select('competidor_id, plazas, edad, pmr, wc, wifi, escolar').eq('activo', True).execute().data or []
+        return calcular_estadisticas_flota(competidores, vehiculos)
 
 def obtener_estadisticas_flota_competencia(competidor_id: int = None) -> list:
     """Obtiene estadísticas de la flota de competidores (cacheado)."""
@@ -398,75 +644,43 @@ def obtener_comparativa_flotas() -> dict:
     return _obtener_comparativa_flotas_cached()
 
 @st.cache_data(ttl=300, show_spinner="Analizando mercado...")
-def _obtener_estadisticas_mercado_cached(tipo_servicio: str = None) -> list:
-    """Versión cacheada de estadísticas de mercado."""
+def _obtener_motor_mercado_cached() -> MotorMercado:
+    """
+    Motor de estadísticas de mercado (cacheado).
+    Una sola lectura de cotizaciones por versión de datos; ranking, posiciones
+    y estadísticas de mercado se derivan de él.
+    """
     client = get_admin_client()
 
-    query = client.table('cotizaciones_competencia').select('tipo_servicio, tipo_vehiculo, precio')
-    if tipo_servicio:
-        query = query.eq('tipo_servicio', tipo_servicio)
-
-    result = query.execute().data or []
+    result = client.table('cotizaciones_competencia').select(
+        'competidor_id, tipo_servicio, tipo_vehiculo, precio, competidores(nombre, segmento)'
+    ).execute()
 
-    if not result:
-        return []
-
-    from collections import defaultdict
-    grupos = defaultdict(list)
-    for row in result:
-        key = (row['tipo_servicio'], row['tipo_vehiculo'])
-        grupos[key].append(float(row['precio']))
+    filas = []
+    for row in result.data or []:
+        comp = row.pop('competidores', None) or {}
+        row['competidor_nombre'] = comp.get('nombre', '')
+        row['competidor_segmento'] = comp.get('segmento', '')
+        filas.append(row)
 
-    stats = []
-    for (tipo_serv, tipo_veh), precios in grupos.items():
-        stats.append({
-            'tipo_servicio': tipo_serv,
-            'tipo_vehiculo': tipo_veh,
-            'precio_medio': round(sum(precios) / len(precios), 2),
-            'precio_min': min(precios),
-            'precio_max': max(precios),
-            'num_cotizaciones': len(precios)
-        })
+    return MotorMercado(filas)
 
-    return stats
+@st.cache_data(ttl=300, show_spinner="Analizando mercado...")
+def _obtener_estadisticas_mercado_cached(tipo_servicio: str = None) -> list:
+    """Versión cacheada de estadísticas de mercado."""
+    return _obtener_motor_mercado_cached().estadisticas_mercado(tipo_servicio)
 
 def obtener_estadisticas_mercado(tipo_servicio: str = None) -> list:
-    """Obtiene estadísticas agregadas del mercado (cacheado)."""
+    """
+    Obtiene estadísticas agregadas del mercado (cacheado).
+    Por (tipo_servicio, tipo_vehiculo): media, mediana, cuartiles, media recortada, mínimo y máximo.
+    """
     return _obtener_estadisticas_mercado_cached(tipo_servicio)
 
 @st.cache_data(ttl=300, show_spinner="Calculando ranking...")
 def _obtener_ranking_cached() -> list:
     """Versión cacheada de ranking de competidores."""
-    client = get_admin_client()
-
-    result = client.table('cotizaciones_competencia').select('competidor_id, precio, competidores(nombre, segmento)').execute()
-
-    if not result.data:
-        return []
-
-    from collections import defaultdict
-    grupos = defaultdict(lambda: {'precios': [], 'nombre': '', 'segmento': ''})
-
-    for row in result.data:
-        comp_id = row['competidor_id']
-        grupos[comp_id]['precios'].append(float(row['precio']))
-        if row.get('competidores'):
-            grupos[comp_id]['nombre'] = row['competidores'].get('nombre', '')
-            grupos[comp_id]['segmento'] = row['competidores'].get('segmento', '')
-
-    ranking = []
-    for comp_id, data in grupos.items():
-        if data['precios']:
-            ranking.append({
-                'competidor_id': comp_id,
-                'nombre': data['nombre'],
-                'segmento': data['segmento'],
-                'precio_medio': round(sum(data['precios']) / len(data['precios']), 2),
-                'num_cotizaciones': len(data['precios'])
-            })
-
-    ranking.sort(key=lambda x: x['precio_medio'])
-    return ranking
+    return _obtener_motor_mercado_cached().ranking()
 
 def obtener_ranking_competidores() -> list:
     """Obtiene ranking de competidores por precio medio (cacheado)."""
@@ -474,41 +688,30 @@ def obtener_ranking_competidores() -> list:
 
 def obtener_posicion_por_servicio(tipo_servicio: str, tipo_vehiculo: str = None) -> dict:
     """Obtiene la posición de precios para un tipo de servicio."""
-    cotizaciones = obtener_cotizaciones_competencia(tipo_servicio=tipo_servicio)
-
-    if tipo_vehiculo:
-        cotizaciones = [c for c in cotizaciones if c.get('tipo_vehiculo') == tipo_vehiculo]
-
-    if not cotizaciones:
-        return {'posiciones': [], 'precio_medio': 0, 'precio_min': 0, 'precio_max': 0}
+    return _obtener_motor_mercado_cached().posicion(tipo_servicio, tipo_vehiculo)
 
-    from collections import defaultdict
-    grupos = defaultdict(lambda: {'precios': [], 'nombre': ''})
-
-    for row in cotizaciones:
-        comp_id = row['competidor_id']
-        grupos[comp_id]['precios'].append(float(row['precio']))
-        grupos[comp_id]['nombre'] = row.get('competidor_nombre', '')
-
-    posiciones = []
-    for comp_id, data in grupos.items():
-        if data['precios']:
-            posiciones.append({
-                'competidor_id': comp_id,
-                'nombre': data['nombre'],
-                'precio_medio': round(sum(data['precios']) / len(data['precios']), 2)
-            })
+# ============================================
+# DEPENDENCIAS DE CACHÉ
+# ============================================
 
-    posiciones.sort(key=lambda x: x['precio_medio'])
+# Tabla -> cachés que leen de ella (incluye las que solo usan el nombre del competidor)
+_CACHES_POR_TABLA = {
+    'competidores': [_obtener_competidores_cached, _obtener_cotizaciones_cached,
+                     _obtener_vehiculos_cached, _obtener_estadisticas_flota_cached,
+                     _obtener_motor_mercado_cached],
+    'vehiculos_competencia': [_obtener_vehiculos_cached, _obtener_estadisticas_flota_cached],
+    'cotizaciones_competencia': [_obtener_cotizaciones_cached, _obtener_motor_mercado_cached],
+}
 
-    todos_precios = [float(c['precio']) for c in cotizaciones]
+# Caché -> cachés calculadas a partir de ella
+_CACHES_DERIVADAS = {
+    _obtener_estadisticas_flota_cached: [_obtener_comparativa_flotas_cached],
+    _obtener_motor_mercado_cached: [_obtener_estadisticas_mercado_cached, _obtener_ranking_cached],
+}
 
-    return {
-        'posiciones': posiciones,
-        'precio_medio': round(sum(todos_precios) / len(todos_precios), 2),
-        'precio_min': min(todos_precios),
-        'precio_max': max(todos_precios)
-    }
+# Cuando otro proceso escribe en una tabla se limpian solo sus cachés dependientes
+for _tabla in _CACHES_POR_TABLA:
+    registrar_invalidacion(_tabla, lambda t=_tabla: invalidar_competencia(t))
 
 def detectar_alertas_competencia(umbral_diferencia: float = 15) -> list:
     """Detecta alertas cuando los precios de David difieren significativamente del mercado."""
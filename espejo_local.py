@@ -0,0 +1,235 @@
+"""
+Espejo local (SQLite) de las tablas de referencia de Supabase
+Tablas pequeñas y que cambian poco: tipos, temporadas, tarifas, comisiones, puntos y competidores.
+Las lecturas se sirven desde disco; la sincronización es incremental usando
+versiones_tablas y fecha_actualizacion (ver supabase_schema_sync.sql).
+Si Supabase no responde se siguen sirviendo los últimos datos sincronizados.
+"""
+import json
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import streamlit as st
+
+RUTA_ESPEJO = Path(__file__).parent / "datos_locales" / "espejo_referencia.db"
+
+# Tabla -> columna de clave primaria
+TABLAS_REFERENCIA = {
+    'tipos_servicio': 'codigo',
+    'tipos_bus': 'codigo',
+    'tipos_cliente': 'codigo',
+    'temporadas': 'codigo',
+    'tarifas_servicio': 'id',
+    'tarifas_cliente': 'id',
+    'comisiones_tramos': 'id',
+    'bonus_objetivos': 'id',
+    'puntos_acciones': 'id',
+    'puntos_premios': 'id',
+    'competidores': 'id',
+}
+
+# Segundos entre comprobaciones de versión contra Supabase
+INTERVALO_SYNC = 60
+
+# Margen para no perder filas confirmadas fuera de orden respecto a fecha_actualizacion
+MARGEN_DELTA = timedelta(minutes=5)
+
+
+def _clave_orden(valor):
+    """Orden ascendente con nulos al final, igual que PostgreSQL."""
+    return (valor is None, valor if valor is not None else 0)
+
+
+class EspejoLocal:
+    """
+    Réplica local de lectura de las tablas de referencia.
+
+    obtener_cliente: función que retorna un cliente Supabase (se llama solo al sincronizar).
+    """
+
+    def __init__(self, obtener_cliente=None, ruta: Path = RUTA_ESPEJO,
+                 tablas: dict = None, intervalo_sync: float = INTERVALO_SYNC):
+        self._obtener_cliente = obtener_cliente
+        self._ruta = Path(ruta)
+        self.tablas = tablas or TABLAS_REFERENCIA
+        self.intervalo_sync = intervalo_sync
+        self._ultima_comprobacion = 0.0
+        self._ultimo_fallo = None     # Tras un fallo no se reintenta hasta pasado el intervalo
+        self._pendientes = set()   # Tablas a sincronizar sí o sí en la próxima lectura
+        self._lock = threading.Lock()
+        self._ruta.parent.mkdir(parents=True, exist_ok=True)
+        self._crear_esquema()
+
+    @contextmanager
+    def _conexion(self):
+        conn = sqlite3.connect(str(self._ruta), timeout=10)
+        try:
+            yield conn
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _crear_esquema(self):
+        with self._conexion() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS filas (
+                    tabla TEXT NOT NULL,
+                    pk TEXT NOT NULL,
+                    datos TEXT NOT NULL,
+                    PRIMARY KEY (tabla, pk)
+                )
+            """)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS estado_sync (
+                    tabla TEXT PRIMARY KEY,
+                    version INTEGER,
+                    marca TEXT,
+                    fecha_sync TEXT
+                )
+            """)
+
+    # ---------- Lectura ----------
+
+    def leer(self, tabla: str, filtros: dict = None, orden: list = None, desc: bool = False) -> list:
+        """
+        Lee filas de una tabla espejada.
+        filtros: {columna: valor} por igualdad. orden: columnas de ordenación.
+        """
+        self.sincronizar_si_toca()
+        with self._conexion() as conn:
+            filas = [json.loads(r[0]) for r in conn.execute(
+                "SELECT datos FROM filas WHERE tabla = ?", (tabla,)
+            )]
+
+        if filtros:
+            filas = [f for f in filas if all(f.get(c) == v for c, v in filtros.items())]
+        if orden:
+            filas.sort(key=lambda f: tuple(_clave_orden(f.get(c)) for c in orden), reverse=desc)
+        return filas
+
+    def marcar_pendiente(self, *tablas):
+        """Fuerza la sincronización de las tablas en la próxima lectura (tras una escritura)."""
+        with self._lock:
+            self._pendientes.update(tablas or self.tablas)
+
+    # ---------- Sincronización ----------
+
+    def sincronizar_si_toca(self):
+        """Sincroniza si ha pasado el intervalo o hay tablas marcadas como pendientes."""
+        with self._lock:
+            ahora = time.monotonic()
+            if self._ultimo_fallo is not None and ahora - self._ultimo_fallo < self.intervalo_sync:
+                return
+            toca = self._pendientes or ahora - self._ultima_comprobacion >= self.intervalo_sync
+        if toca:
+            self.sincronizar()
+
+    def _estado_local(self) -> dict:
+        with self._conexion() as conn:
+            return {r[0]: {'version': r[1], 'marca': r[2]}
+                    for r in conn.execute("SELECT tabla, version, marca FROM estado_sync")}
+
+    def sincronizar(self) -> dict:
+        """
+        Trae de Supabase solo lo que ha cambiado desde la última sincronización.
+        Retorna {tabla: nº de filas recibidas}; vacío si no había cambios o Supabase no responde.
+        """
+        with self._lock:
+            pendientes = set(self._pendientes)
+            self._pendientes.clear()
+            self._ultima_comprobacion = time.monotonic()
+
+        if self._obtener_cliente is None:
+            return {}
+
+        try:
+            client = self._obtener_cliente()
+            estado = self._estado_local()
+            try:
+                versiones = {r['tabla']: r['version'] for r in (
+                    client.table('versiones_tablas').select('tabla, version')
+                    .in_('tabla', list(self.tablas)).execute().data or []
+                )}
+            except Exception:
+                versiones = None  # Esquema de sincronización no desplegado: recarga completa
+
+            resumen = {}
+            for tabla in self.tablas:
+                local = estado.get(tabla)
+                if versiones is None:
+                    if local and tabla not in pendientes:
+                        continue
+                    resumen[tabla] = self._recargar_tabla(client, tabla)
+                elif local is None or tabla in pendientes or versiones.get(tabla) != local['version']:
+                    resumen[tabla] = self._sincronizar_tabla(client, tabla, versiones.get(tabla), local)
+            self._ultimo_fallo = None
+            return resumen
+        except Exception as e:
+            # Sin conexión: seguimos sirviendo lo último sincronizado
+            with self._lock:
+                self._pendientes.update(pendientes)
+                self._ultimo_fallo = time.monotonic()
+            print(f"Espejo local sin sincronizar ({e}); se usan datos locales")
+            return {}
+
+    def _sincronizar_tabla(self, client, tabla: str, version, local) -> int:
+        pk = self.tablas[tabla]
+        query = client.table(tabla).select('*')
+        if local and local.get('marca'):
+            desde = datetime.fromisoformat(local['marca']) - MARGEN_DELTA
+            query = query.gte('fecha_actualizacion', desde.isoformat())
+        cambiadas = query.execute().data or []
+
+        # Para detectar borrados basta con la lista de claves (tablas pequeñas)
+        claves = {str(r[pk]) for r in (client.table(tabla).select(pk).execute().data or [])}
+
+        marcas = [r['fecha_actualizacion'] for r in cambiadas if r.get('fecha_actualizacion')]
+        marca = max(marcas) if marcas else (local or {}).get('marca')
+
+        with self._conexion() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO filas (tabla, pk, datos) VALUES (?, ?, ?)",
+                [(tabla, str(r[pk]), json.dumps(r, default=str)) for r in cambiadas]
+            )
+            locales = {r[0] for r in conn.execute("SELECT pk FROM filas WHERE tabla = ?", (tabla,))}
+            borradas = locales - claves
+            conn.executemany("DELETE FROM filas WHERE tabla = ? AND pk = ?",
+                             [(tabla, c) for c in borradas])
+            self._guardar_estado(conn, tabla, version, marca)
+        return len(cambiadas)
+
+    def _recargar_tabla(self, client, tabla: str) -> int:
+        pk = self.tablas[tabla]
+        filas = client.table(tabla).select('*').execute().data or []
+        with self._conexion() as conn:
+            conn.execute("DELETE FROM filas WHERE tabla = ?", (tabla,))
+            conn.executemany(
+                "INSERT INTO filas (tabla, pk, datos) VALUES (?, ?, ?)",
+                [(tabla, str(r[pk]), json.dumps(r, default=str)) for r in filas]
+            )
+            self._guardar_estado(conn, tabla, None, None)
+        return len(filas)
+
+    @staticmethod
+    def _guardar_estado(conn, tabla, version, marca):
+        conn.execute(
+            "INSERT OR REPLACE INTO estado_sync (tabla, version, marca, fecha_sync) VALUES (?, ?, ?, ?)",
+            (tabla, version, marca, datetime.now().isoformat())
+        )
+
+
+@st.cache_resource
+def obtener_espejo() -> EspejoLocal:
+    """Espejo compartido por todas las sesiones del proceso."""
+    from supabase_client import get_admin_client
+    return EspejoLocal(get_admin_client)
+
+
+def leer_referencia(tabla: str, filtros: dict = None, orden: list = None, desc: bool = False) -> list:
+    """Atajo para leer una tabla de referencia desde el espejo local."""
+    return obtener_espejo().leer(tabla, filtros, orden, desc)
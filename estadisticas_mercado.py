@@ -0,0 +1,139 @@
+"""
+Motor de estadísticas de precios de la competencia
+Agregados robustos (mediana, cuartiles, media recortada) por tipo de servicio,
+tipo de vehículo y competidor, calculados con NumPy una sola vez por versión de datos.
+"""
+import numpy as np
+
+# Fracción que se descarta en cada extremo para la media recortada
+PROPORCION_RECORTE = 0.1
+
+# Niveles de agregación que se precalculan
+NIVELES = {
+    'servicio': ('tipo_servicio',),
+    'servicio_vehiculo': ('tipo_servicio', 'tipo_vehiculo'),
+    'competidor': ('competidor_id',),
+    'servicio_competidor': ('tipo_servicio', 'competidor_id'),
+    'servicio_vehiculo_competidor': ('tipo_servicio', 'tipo_vehiculo', 'competidor_id'),
+}
+
+
+def _codificar(valores: list) -> tuple:
+    """Convierte una columna en códigos enteros y la lista de valores distintos."""
+    indice = {}
+    codigos = np.fromiter((indice.setdefault(v, len(indice)) for v in valores), dtype=np.int64, count=len(valores))
+    return codigos, list(indice)
+
+
+def _resumen(precios: np.ndarray, proporcion_recorte: float) -> dict:
+    """Estadísticos de un grupo de precios ya ordenado."""
+    n = len(precios)
+    k = int(n * proporcion_recorte)
+    recortados = precios[k:n - k] if n - 2 * k > 0 else precios
+    p25, mediana, p75 = np.quantile(precios, [0.25, 0.5, 0.75])
+    return {
+        'precio_medio': round(float(precios.mean()), 2),
+        'precio_mediana': round(float(mediana), 2),
+        'precio_p25': round(float(p25), 2),
+        'precio_p75': round(float(p75), 2),
+        'precio_media_recortada': round(float(recortados.mean()), 2),
+        'precio_min': float(precios[0]),
+        'precio_max': float(precios[-1]),
+        'num_cotizaciones': n,
+    }
+
+
+def agrupar_precios(columnas: dict, precios: np.ndarray, claves: tuple,
+                    proporcion_recorte: float = PROPORCION_RECORTE) -> dict:
+    """
+    Agrupa precios por las columnas indicadas.
+    columnas: {nombre: lista de valores}, alineadas con precios.
+    Retorna {tupla de claves: estadísticos}.
+    """
+    if len(precios) == 0:
+        return {}
+
+    codigos = []
+    valores = []
+    for clave in claves:
+        c, v = _codificar(columnas[clave])
+        codigos.append(c)
+        valores.append(v)
+
+    grupo = np.ravel_multi_index(codigos, [len(v) for v in valores]) if len(claves) > 1 else codigos[0]
+
+    # Ordenar por grupo y, dentro de cada grupo, por precio
+    orden = np.lexsort((precios, grupo))
+    grupo_ord = grupo[orden]
+    precios_ord = precios[orden]
+    cortes = np.flatnonzero(np.diff(grupo_ord)) + 1
+    inicios = np.concatenate(([0], cortes))
+    finales = np.concatenate((cortes, [len(precios_ord)]))
+
+    resultado = {}
+    for inicio, fin in zip(inicios, finales):
+        indices = np.unravel_index(grupo_ord[inicio], [len(v) for v in valores]) if len(claves) > 1 else (grupo_ord[inicio],)
+        clave = tuple(valores[i][int(j)] for i, j in enumerate(indices))
+        resultado[clave] = _resumen(precios_ord[inicio:fin], proporcion_recorte)
+    return resultado
+
+
+class MotorMercado:
+    """
+    Estadísticas de mercado sobre las cotizaciones de la competencia.
+    filas: dicts con competidor_id, tipo_servicio, tipo_vehiculo, precio y,
+    opcionalmente, competidor_nombre y competidor_segmento.
+    """
+
+    def __init__(self, filas: list, proporcion_recorte: float = PROPORCION_RECORTE):
+        filas = [f for f in filas if f.get('precio') is not None]
+        self.num_cotizaciones = len(filas)
+        self.competidores = {}
+        for f in filas:
+            self.competidores.setdefault(f['competidor_id'], {
+                'nombre': f.get('competidor_nombre', ''),
+                'segmento': f.get('competidor_segmento', '')
+            })
+
+        precios = np.array([float(f['precio']) for f in filas], dtype=np.float64)
+        columnas = {c: [f.get(c) for f in filas] for c in ('tipo_servicio', 'tipo_vehiculo', 'competidor_id')}
+        self.niveles = {nombre: agrupar_precios(columnas, precios, claves, proporcion_recorte)
+                        for nombre, claves in NIVELES.items()}
+
+    def estadisticas_mercado(self, tipo_servicio: str = None) -> list:
+        """Estadísticos por (tipo_servicio, tipo_vehiculo)."""
+        return [
+            {'tipo_servicio': serv, 'tipo_vehiculo': veh, **stats}
+            for (serv, veh), stats in self.niveles['servicio_vehiculo'].items()
+            if not tipo_servicio or serv == tipo_servicio
+        ]
+
+    def ranking(self) -> list:
+        """Competidores ordenados por precio medio."""
+        ranking = [
+            {'competidor_id': cid, **self.competidores.get(cid, {}), **stats}
+            for (cid,), stats in self.niveles['competidor'].items()
+        ]
+        ranking.sort(key=lambda x: x['precio_medio'])
+        return ranking
+
+    def posicion(self, tipo_servicio: str, tipo_vehiculo: str = None) -> dict:
+        """Posición de cada competidor en un servicio (y vehículo) más el resumen del mercado."""
+        if tipo_vehiculo:
+            por_comp = {k[2]: v for k, v in self.niveles['servicio_vehiculo_competidor'].items()
+                        if k[0] == tipo_servicio and k[1] == tipo_vehiculo}
+            mercado = self.niveles['servicio_vehiculo'].get((tipo_servicio, tipo_vehiculo))
+        else:
+            por_comp = {k[1]: v for k, v in self.niveles['servicio_competidor'].items()
+                        if k[0] == tipo_servicio}
+            mercado = self.niveles['servicio'].get((tipo_servicio,))
+
+        if not mercado:
+            return {'posiciones': [], 'precio_medio': 0, 'precio_min': 0, 'precio_max': 0}
+
+        posiciones = [
+            {'competidor_id': cid, 'nombre': self.competidores.get(cid, {}).get('nombre', ''), **stats}
+            for cid, stats in por_comp.items()
+        ]
+        posiciones.sort(key=lambda x: x['precio_medio'])
+        return {'posiciones': posiciones, **mercado}
@@ -0,0 +1,108 @@
+"""
+Estimación de rutas sin servicio de rutas
+Distancia = línea recta (haversine) × factor de rodeo aprendido por región;
+duración = distancia / velocidad media ajustada por tramo de distancia.
+Ambos se calibran con las rutas reales de la caché en disco (ver rutas.CacheRutas),
+sin red. Los resultados se marcan como 'estimado' para que la Calculadora lo avise.
+"""
+from bisect import bisect_right
+from statistics import median
+
+from geometria import codificar_polilinea, haversine_km
+
+# Tamaño de región en grados para el factor de rodeo (0.5° ≈ 55 km)
+REJILLA_REGION = 0.5
+
+# Valores sin datos de calibración
+FACTOR_RODEO_DEFECTO = 1.3
+
+# Límites (km) de los tramos de distancia y velocidad por defecto (km/h) de cada uno
+LIMITES_TRAMOS_KM = (10, 30, 80)
+VELOCIDADES_DEFECTO = (35.0, 50.0, 70.0, 85.0)
+
+# Muestras que pesa el valor global al combinarlo con el de una región con pocos datos
+PESO_PREVIO = 5
+
+# Rutas con línea recta menor que esto no se usan (el factor se dispara en trayectos urbanos muy cortos)
+MINIMO_KM_CALIBRACION = 1.0
+
+# Factores fuera de este rango se consideran datos erróneos
+RANGO_FACTOR = (1.0, 3.0)
+
+
+def distancia_recta_km(puntos) -> float:
+    """Suma de las distancias en línea recta entre puntos consecutivos."""
+    return sum(haversine_km(*a, *b) for a, b in zip(puntos, puntos[1:]))
+
+
+def region(puntos, rejilla: float = REJILLA_REGION) -> tuple:
+    """Celda de la rejilla que contiene el punto medio entre el primer y el último punto."""
+    lat = (puntos[0][0] + puntos[-1][0]) / 2
+    lon = (puntos[0][1] + puntos[-1][1]) / 2
+    return int(lat // rejilla), int(lon // rejilla)
+
+
+def _tramo(km: float) -> int:
+    return bisect_right(LIMITES_TRAMOS_KM, km)
+
+
+class EstimadorRutas:
+    """Estimador calibrado. Sin calibrar usa FACTOR_RODEO_DEFECTO y VELOCIDADES_DEFECTO."""
+
+    def __init__(self, rejilla: float = REJILLA_REGION):
+        self.rejilla = rejilla
+        self.factor_global = FACTOR_RODEO_DEFECTO
+        self.factores_region = {}      # region -> (factor, num_muestras)
+        self.velocidades = list(VELOCIDADES_DEFECTO)
+        self.muestras = 0
+
+    def calibrar(self, muestras) -> 'EstimadorRutas':
+        """
+        muestras: iterable de (puntos, distancia_km, duracion_min) de rutas reales.
+        Factor de rodeo: mediana por región (robusta frente a rutas raras).
+        Velocidad: km totales / horas totales de cada tramo de distancia.
+        """
+        por_region = {}
+        todos = []
+        km_tramo = [0.0] * len(VELOCIDADES_DEFECTO)
+        horas_tramo = [0.0] * len(VELOCIDADES_DEFECTO)
+        for puntos, distancia_km, duracion_min in muestras:
+            if len(puntos) < 2 or not distancia_km or not duracion_min:
+                continue
+            recta = distancia_recta_km(puntos)
+            if recta < MINIMO_KM_CALIBRACION:
+                continue
+            factor = distancia_km / recta
+            if not RANGO_FACTOR[0] <= factor <= RANGO_FACTOR[1]:
+                continue
+            todos.append(factor)
+            por_region.setdefault(region(puntos, self.rejilla), []).append(factor)
+            t = _tramo(distancia_km)
+            km_tramo[t] += distancia_km
+            horas_tramo[t] += duracion_min / 60
+
+        self.muestras = len(todos)
+        if todos:
+            self.factor_global = median(todos)
+        self.factores_region = {r: (median(f), len(f)) for r, f in por_region.items()}
+        self.velocidades = [km / horas if horas > 0 else defecto
+                            for km, horas, defecto in zip(km_tramo, horas_tramo, VELOCIDADES_DEFECTO)]
+        return self
+
+    def factor_rodeo(self, puntos) -> float:
+        """Factor de la región, acercado al global cuanto menos muestras tenga."""
+        factor, n = self.factores_region.get(region(puntos, self.rejilla), (self.factor_global, 0))
+        return (factor * n + self.factor_global * PESO_PREVIO) / (n + PESO_PREVIO)
+
+    def estimar(self, puntos) -> dict:
+        """Ruta estimada con el mismo formato que calcular_ruta_osrm y 'estimado': True."""
+        if len(puntos) < 2:
+            return None
+        distancia_km = distancia_recta_km(puntos) * self.factor_rodeo(puntos)
+        velocidad = self.velocidades[_tramo(distancia_km)]
+        return {
+            'distancia_km': round(distancia_km, 1),
+            'duracion_min': round(distancia_km / velocidad * 60, 0),
+            'polilinea': codificar_polilinea(puntos),
+            'estimado': True
+        }
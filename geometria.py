@@ -0,0 +1,156 @@
+"""
+Geometría de rutas
+Codificación compacta de polilíneas (formato Google, precisión 1e-5) y simplificación
+Douglas–Peucker con tolerancia según el zoom al que se va a dibujar el mapa.
+"""
+import math
+
+RADIO_TIERRA_M = 6371008.8
+
+# Metros por píxel en el ecuador a zoom 0 (teselas de 256 px)
+METROS_PIXEL_Z0 = 156543.03392
+
+# Tamaño aproximado del mapa de la Calculadora en píxeles
+ANCHO_MAPA_PX = 700
+ALTO_MAPA_PX = 250
+
+# Zoom máximo que se considera al simplificar (calles)
+ZOOM_MAXIMO = 18
+
+
+def codificar_polilinea(puntos, precision: int = 5) -> str:
+    """[(lat, lon)] -> cadena de polilínea codificada."""
+    factor = 10 ** precision
+    salida = []
+    prev_lat = prev_lon = 0
+    for lat, lon in puntos:
+        ilat, ilon = int(round(lat * factor)), int(round(lon * factor))
+        for delta in (ilat - prev_lat, ilon - prev_lon):
+            valor = ~(delta << 1) if delta < 0 else delta << 1
+            while valor >= 0x20:
+                salida.append(chr((0x20 | (valor & 0x1f)) + 63))
+                valor >>= 5
+            salida.append(chr(valor + 63))
+        prev_lat, prev_lon = ilat, ilon
+    return ''.join(salida)
+
+
+def decodificar_polilinea(cadena: str, precision: int = 5) -> list:
+    """Cadena de polilínea codificada -> [(lat, lon)]."""
+    factor = 10 ** precision
+    puntos = []
+    indice = lat = lon = 0
+    coordenadas = [0, 0]
+    longitud = len(cadena or '')
+    while indice < longitud:
+        for i in range(2):
+            resultado = desplazamiento = 0
+            while True:
+                b = ord(cadena[indice]) - 63
+                indice += 1
+                resultado |= (b & 0x1f) << desplazamiento
+                desplazamiento += 5
+                if b < 0x20:
+                    break
+            coordenadas[i] = ~(resultado >> 1) if resultado & 1 else resultado >> 1
+        lat += coordenadas[0]
+        lon += coordenadas[1]
+        puntos.append((lat / factor, lon / factor))
+    return puntos
+
+
+def haversine_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """Distancia ortodrómica en km."""
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    dp, dl = p2 - p1, math.radians(lon2 - lon1)
+    a = math.sin(dp / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(dl / 2) ** 2
+    return 2 * RADIO_TIERRA_M * math.asin(math.sqrt(a)) / 1000
+
+
+def douglas_peucker(puntos: list, tolerancia_m: float) -> list:
+    """
+    Simplifica [(lat, lon)] conservando los puntos que se desvían más de tolerancia_m
+    de la recta entre los que se conservan. Iterativo (las rutas largas desbordarían la recursión).
+    """
+    n = len(puntos)
+    if n < 3 or tolerancia_m <= 0:
+        return list(puntos)
+
+    # Proyección equirectangular en metros alrededor de la latitud media (suficiente a escala de ruta)
+    lat_media = math.radians(sum(p[0] for p in puntos) / n)
+    kx = math.cos(lat_media) * math.pi * RADIO_TIERRA_M / 180
+    ky = math.pi * RADIO_TIERRA_M / 180
+    xs = [p[1] * kx for p in puntos]
+    ys = [p[0] * ky for p in puntos]
+
+    conservar = [False] * n
+    conservar[0] = conservar[-1] = True
+    tolerancia2 = tolerancia_m * tolerancia_m
+    pila = [(0, n - 1)]
+    while pila:
+        inicio, fin = pila.pop()
+        x0, y0 = xs[inicio], ys[inicio]
+        dx, dy = xs[fin] - x0, ys[fin] - y0
+        largo2 = dx * dx + dy * dy
+        max_d2, max_i = -1.0, -1
+        for i in range(inicio + 1, fin):
+            px, py = xs[i] - x0, ys[i] - y0
+            if largo2 == 0:
+                d2 = px * px + py * py
+            else:
+                t = max(0.0, min(1.0, (px * dx + py * dy) / largo2))
+                ex, ey = px - t * dx, py - t * dy
+                d2 = ex * ex + ey * ey
+            if d2 > max_d2:
+                max_d2, max_i = d2, i
+        if max_d2 > tolerancia2:
+            conservar[max_i] = True
+            pila.append((inicio, max_i))
+            pila.append((max_i, fin))
+    return [p for p, c in zip(puntos, conservar) if c]
+
+
+def zoom_para_limites(puntos: list, ancho_px: int = ANCHO_MAPA_PX, alto_px: int = ALTO_MAPA_PX) -> int:
+    """Zoom (entero) con el que fit_bounds mostraría todos los puntos en un mapa de ese tamaño."""
+    if len(puntos) < 2:
+        return ZOOM_MAXIMO
+    lats = [p[0] for p in puntos]
+    lons = [p[1] for p in puntos]
+
+    def _y(lat):
+        s = math.sin(math.radians(max(-85.0, min(85.0, lat))))
+        return math.log((1 + s) / (1 - s)) / 2
+
+    fraccion_lon = (max(lons) - min(lons)) / 360
+    fraccion_lat = (_y(max(lats)) - _y(min(lats))) / (2 * math.pi)
+    zooms = [ZOOM_MAXIMO]
+    if fraccion_lon > 0:
+        zooms.append(math.log2(ancho_px / 256 / fraccion_lon))
+    if fraccion_lat > 0:
+        zooms.append(math.log2(alto_px / 256 / fraccion_lat))
+    return max(0, int(math.floor(min(zooms))))
+
+
+def metros_por_pixel(zoom: int, lat: float) -> float:
+    return METROS_PIXEL_Z0 * math.cos(math.radians(lat)) / (2 ** zoom)
+
+
+def simplificar_para_mapa(polilinea: str, ancho_px: int = ANCHO_MAPA_PX, alto_px: int = ALTO_MAPA_PX,
+                          pixeles: float = 1.0) -> dict:
+    """
+    Decodifica una polilínea y la simplifica para el zoom al que se verá entera:
+    se descartan los puntos que se desvían menos de 'pixeles' píxeles en pantalla.
+    Retorna {'coords', 'zoom', 'originales', 'eliminados'}.
+    """
+    coords = decodificar_polilinea(polilinea)
+    if len(coords) < 3:
+        return {'coords': coords, 'zoom': ZOOM_MAXIMO, 'originales': len(coords), 'eliminados': 0}
+    zoom = zoom_para_limites(coords, ancho_px, alto_px)
+    lat_media = sum(p[0] for p in coords) / len(coords)
+    simplificada = douglas_peucker(coords, metros_por_pixel(zoom, lat_media) * pixeles)
+    return {
+        'coords': simplificada,
+        'zoom': zoom,
+        'originales': len(coords),
+        'eliminados': len(coords) - len(simplificada)
+    }
@@ -0,0 +1,123 @@
+"""
+Invalidación de cachés entre procesos
+Cada proceso de Streamlit consulta periódicamente la tabla versiones_tablas
+(una fila por tabla, incrementada por trigger en cada escritura) y limpia
+solo las funciones cacheadas que dependen de las tablas que han cambiado.
+"""
+import threading
+
+import streamlit as st
+
+# Segundos entre consultas de versiones
+INTERVALO_POLL = 10
+
+# Tabla -> funciones a invalidar (funciones @st.cache_data o callables sin argumentos)
+_REGISTRO = {}
+_REGISTRO_LOCK = threading.Lock()
+
+
+def registrar_invalidacion(tabla: str, *funciones):
+    """Declara que estas funciones cacheadas dependen de la tabla."""
+    with _REGISTRO_LOCK:
+        lista = _REGISTRO.setdefault(tabla, [])
+        for funcion in funciones:
+            if funcion not in lista:
+                lista.append(funcion)
+
+
+def invalidar_tablas(*tablas) -> int:
+    """Limpia las funciones registradas para las tablas indicadas. Retorna cuántas se limpiaron."""
+    with _REGISTRO_LOCK:
+        funciones = []
+        for tabla in tablas:
+            for funcion in _REGISTRO.get(tabla, []):
+                if funcion not in funciones:
+                    funciones.append(funcion)
+
+    for funcion in funciones:
+        try:
+            getattr(funcion, 'clear', funcion)()
+        except Exception as e:
+            print(f"Error invalidando caché {getattr(funcion, '__name__', funcion)}: {e}")
+    return len(funciones)
+
+
+def leer_versiones_supabase() -> dict:
+    """Lee {tabla: version} de Supabase en una única consulta."""
+    from supabase_client import get_admin_client
+    result = get_admin_client().table('versiones_tablas').select('tabla, version').execute()
+    return {r['tabla']: r['version'] for r in (result.data or [])}
+
+
+class VersionesEnMemoria:
+    """Sustituto local de versiones_tablas para pruebas sin Supabase."""
+
+    def __init__(self):
+        self._versiones = {}
+        self._lock = threading.Lock()
+
+    def incrementar(self, tabla: str):
+        with self._lock:
+            self._versiones[tabla] = self._versiones.get(tabla, 0) + 1
+
+    def leer(self) -> dict:
+        with self._lock:
+            return dict(self._versiones)
+
+
+class VigilanteVersiones:
+    """
+    Compara las versiones de las tablas con las vistas la última vez e
+    invalida las cachés de las que han cambiado.
+
+    leer_versiones: función que retorna {tabla: version}.
+    """
+
+    def __init__(self, leer_versiones=leer_versiones_supabase, intervalo: float = INTERVALO_POLL):
+        self._leer_versiones = leer_versiones
+        self.intervalo = intervalo
+        self._vistas = None
+        self._parar = threading.Event()
+        self._hilo = None
+        self.invalidaciones = 0
+
+    def comprobar(self) -> list:
+        """Una ronda de comprobación. Retorna las tablas que han cambiado."""
+        actuales = self._leer_versiones()
+        if self._vistas is None:
+            # Primera lectura: solo se toma la referencia
+            self._vistas = actuales
+            return []
+
+        cambiadas = [t for t, v in actuales.items() if self._vistas.get(t) != v]
+        self._vistas = actuales
+        if cambiadas:
+            self.invalidaciones += invalidar_tablas(*cambiadas)
+        return cambiadas
+
+    def iniciar(self):
+        """Arranca la comprobación periódica en un hilo en segundo plano."""
+        if self._hilo and self._hilo.is_alive():
+            return
+        self._parar.clear()
+        self._hilo = threading.Thread(target=self._bucle, name="vigilante-versiones", daemon=True)
+        self._hilo.start()
+
+    def detener(self):
+        self._parar.set()
+
+    def _bucle(self):
+        while not self._parar.is_set():
+            try:
+                self.comprobar()
+            except Exception as e:
+                print(f"Vigilante de versiones: {e}")
+            self._parar.wait(self.intervalo)
+
+
+@st.cache_resource
+def iniciar_vigilante() -> VigilanteVersiones:
+    """Arranca (una vez por proceso) la invalidación de cachés entre procesos."""
+    vigilante = VigilanteVersiones()
+    vigilante.iniciar()
+    return vigilante
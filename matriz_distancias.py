@@ -0,0 +1,243 @@
+"""
+Matriz de distancias y tiempos entre lugares frecuentes y la base
+Un hilo en segundo plano mantiene una matriz N×N (NumPy, float32) con el servicio
+table de OSRM y la guarda en datos_locales/matriz_distancias.npz. Cuando se añade un
+lugar solo se calculan sus filas y columnas. La Calculadora resuelve los
+posicionamientos (base -> origen, destino -> base) con una consulta a la matriz.
+"""
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+import requests
+import streamlit as st
+
+from geometria import haversine_km
+from rutas import cuantizar
+
+RUTA_MATRIZ = Path(__file__).parent / "datos_locales" / "matriz_distancias.npz"
+
+URL_OSRM_TABLA = "http://router.project-osrm.org/table/v1/driving"
+
+# Coordenadas por petición al servicio table (el servidor público admite 100)
+MAX_COORDS_TABLA = 100
+
+# Metros máximos entre un punto y un lugar de la matriz para considerarlos el mismo
+RADIO_COINCIDENCIA_M = 300
+
+# Segundos entre comprobaciones de cambios en los lugares frecuentes
+INTERVALO_ACTUALIZACION = 600
+
+# Segundos tras los que la matriz se recalcula entera (cambios en la red de carreteras)
+EDAD_MAXIMA = 30 * 24 * 3600
+
+BASE_POR_DEFECTO = 'Paseo de Anoeta 22, San Sebastian'
+
+# Parámetros de la tabla local aproximada (sin servicio de rutas)
+FACTOR_RODEO_LOCAL = 1.3
+VELOCIDAD_LOCAL_KMH = 70
+
+
+class MatrizDistancias:
+    """
+    coords: array (N, 2) de (lat, lon) cuantizados; distancias_km y duraciones_min: (N, N) float32.
+    NaN = par sin calcular.
+    """
+
+    def __init__(self, coords, distancias_km, duraciones_min, fecha: float = None):
+        self.coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+        self.distancias_km = np.asarray(distancias_km, dtype=np.float32)
+        self.duraciones_min = np.asarray(duraciones_min, dtype=np.float32)
+        self.fecha = time.time() if fecha is None else fecha
+
+    def __len__(self):
+        return len(self.coords)
+
+    def indice(self, lat: float, lon: float, radio_m: float = RADIO_COINCIDENCIA_M):
+        """Índice del lugar más cercano al punto si está dentro del radio, si no None."""
+        if not len(self.coords):
+            return None
+        dy = (self.coords[:, 0] - lat) * 111195.0
+        dx = (self.coords[:, 1] - lon) * 111195.0 * np.cos(np.radians(lat))
+        d2 = dx * dx + dy * dy
+        i = int(np.argmin(d2))
+        return i if d2[i] <= radio_m * radio_m else None
+
+    def consultar(self, origen, destino):
+        """{'distancia_km', 'duracion_min'} entre dos puntos de la matriz o None."""
+        i, j = self.indice(*origen), self.indice(*destino)
+        if i is None or j is None or np.isnan(self.distancias_km[i, j]):
+            return None
+        return {'distancia_km': round(float(self.distancias_km[i, j]), 1),
+                'duracion_min': round(float(self.duraciones_min[i, j]), 0)}
+
+    def guardar(self, ruta: Path = RUTA_MATRIZ):
+        ruta = Path(ruta)
+        ruta.parent.mkdir(parents=True, exist_ok=True)
+        temporal = ruta.with_suffix('.tmp.npz')
+        np.savez_compressed(temporal, coords=self.coords, distancias_km=self.distancias_km,
+                            duraciones_min=self.duraciones_min, fecha=np.float64(self.fecha))
+        temporal.replace(ruta)
+
+    @classmethod
+    def cargar(cls, ruta: Path = RUTA_MATRIZ):
+        """Matriz guardada o None si no existe o no se puede leer."""
+        try:
+            with np.load(Path(ruta)) as datos:
+                return cls(datos['coords'], datos['distancias_km'], datos['duraciones_min'], float(datos['fecha']))
+        except (OSError, KeyError, ValueError):
+            return None
+
+
+def tabla_osrm(coords, fuentes, destinos):
+    """Submatriz (distancias_km, duraciones_min) de fuentes × destinos con el servicio table de OSRM."""
+    mitad = MAX_COORDS_TABLA // 2
+    distancias = np.full((len(fuentes), len(destinos)), np.nan, dtype=np.float32)
+    duraciones = np.full_like(distancias, np.nan)
+    for fi in range(0, len(fuentes), mitad):
+        bloque_f = fuentes[fi:fi + mitad]
+        for di in range(0, len(destinos), mitad):
+            bloque_d = destinos[di:di + mitad]
+            puntos = [coords[k] for k in bloque_f] + [coords[k] for k in bloque_d]
+            texto = ";".join(f"{lon},{lat}" for lat, lon in puntos)
+            response = requests.get(f"{URL_OSRM_TABLA}/{texto}", params={
+                'sources': ';'.join(str(k) for k in range(len(bloque_f))),
+                'destinations': ';'.join(str(len(bloque_f) + k) for k in range(len(bloque_d))),
+                'annotations': 'distance,duration'
+            }, timeout=30)
+            response.raise_for_status()
+            data = response.json()
+            if data.get('code') != 'Ok':
+                raise ValueError(f"OSRM respondió {data.get('code')}")
+            # null (sin ruta) -> NaN
+            bloque_dist = np.array(data['distances'], dtype=np.float64)
+            bloque_dur = np.array(data['durations'], dtype=np.float64)
+            distancias[fi:fi + len(bloque_f), di:di + len(bloque_d)] = bloque_dist / 1000
+            duraciones[fi:fi + len(bloque_f), di:di + len(bloque_d)] = bloque_dur / 60
+    return distancias, duraciones
+
+
+def tabla_local(coords, fuentes, destinos):
+    """Sustituto sin red: distancia en línea recta por un factor de rodeo y velocidad media fija."""
+    distancias = np.array([[haversine_km(*coords[f], *coords[d]) * FACTOR_RODEO_LOCAL for d in destinos]
+                           for f in fuentes], dtype=np.float32).reshape(len(fuentes), len(destinos))
+    return distancias, distancias / VELOCIDAD_LOCAL_KMH * 60
+
+
+def actualizar_matriz(anterior, coords, calcular_tabla=tabla_osrm) -> MatrizDistancias:
+    """
+    Matriz para los lugares 'coords'. Reutiliza los pares ya calculados en 'anterior'
+    (mismo punto cuantizado) y solo pide las filas y columnas de los lugares nuevos.
+    """
+    coords = np.asarray(cuantizar(coords), dtype=np.float64).reshape(-1, 2)
+    n = len(coords)
+    distancias = np.full((n, n), np.nan, dtype=np.float32)
+    duraciones = np.full_like(distancias, np.nan)
+    np.fill_diagonal(distancias, 0)
+    np.fill_diagonal(duraciones, 0)
+
+    viejos = np.full(n, -1)
+    if anterior is not None and len(anterior):
+        posiciones = {tuple(c): k for k, c in enumerate(anterior.coords.tolist())}
+        viejos = np.array([posiciones.get(tuple(c), -1) for c in coords.tolist()], dtype=np.int64)
+        conocidos = np.flatnonzero(viejos >= 0)
+        distancias[np.ix_(conocidos, conocidos)] = anterior.distancias_km[np.ix_(viejos[conocidos], viejos[conocidos])]
+        duraciones[np.ix_(conocidos, conocidos)] = anterior.duraciones_min[np.ix_(viejos[conocidos], viejos[conocidos])]
+
+    nuevos = np.flatnonzero(viejos < 0).tolist()
+    if nuevos:
+        lista = coords.tolist()
+        todos = list(range(n))
+        # Filas de los nuevos (hacia todos) y columnas de los nuevos (desde los ya conocidos)
+        d, t = calcular_tabla(lista, nuevos, todos)
+        distancias[nuevos, :] = d
+        duraciones[nuevos, :] = t
+        antiguos = np.flatnonzero(viejos >= 0).tolist()
+        if antiguos:
+            d, t = calcular_tabla(lista, antiguos, nuevos)
+            distancias[np.ix_(antiguos, nuevos)] = d
+            duraciones[np.ix_(antiguos, nuevos)] = t
+        np.fill_diagonal(distancias, 0)
+        np.fill_diagonal(duraciones, 0)
+    fecha = anterior.fecha if anterior is not None and not nuevos else None
+    return MatrizDistancias(coords, distancias, duraciones, fecha)
+
+
+def nodos_frecuentes() -> list:
+    """(lat, lon) de los lugares frecuentes y de la base (si ya está en la caché de geocodificación)."""
+    from database import obtener_lugares_frecuentes, obtener_config_calc
+    from cache_geocodificacion import obtener_cache_geocodificacion
+
+    nodos = [(float(l['lat']), float(l['lng'])) for l in obtener_lugares_frecuentes()
+             if l.get('lat') is not None and l.get('lng') is not None]
+    base_direccion = obtener_config_calc('base_direccion', BASE_POR_DEFECTO)
+    _, base_geo = obtener_cache_geocodificacion().obtener(base_direccion)
+    if base_geo:
+        nodos.append((base_geo[0], base_geo[1]))
+    # Sin duplicados tras cuantizar, conservando el orden
+    return list(dict.fromkeys(cuantizar(nodos)))
+
+
+class ActualizadorMatriz:
+    """
+    Mantiene la matriz al día en un hilo en segundo plano.
+
+    obtener_nodos: función que retorna la lista de (lat, lon) que debe cubrir la matriz.
+    calcular_tabla: tabla_osrm o tabla_local.
+    """
+
+    def __init__(self, obtener_nodos=nodos_frecuentes, calcular_tabla=tabla_osrm,
+                 ruta: Path = RUTA_MATRIZ, intervalo: float = INTERVALO_ACTUALIZACION):
+        self._obtener_nodos = obtener_nodos
+        self._calcular_tabla = calcular_tabla
+        self._ruta = ruta
+        self.intervalo = intervalo
+        self.matriz = MatrizDistancias.cargar(ruta) if ruta else None
+        self._parar = threading.Event()
+        self._hilo = None
+
+    def comprobar(self, ahora: float = None) -> bool:
+        """Una ronda: recalcula si cambian los lugares o la matriz es vieja. Retorna si ha cambiado."""
+        ahora = time.time() if ahora is None else ahora
+        nodos = cuantizar(self._obtener_nodos())
+        actual = self.matriz
+        caducada = actual is None or actual.fecha + EDAD_MAXIMA < ahora
+        if not caducada and [tuple(c) for c in actual.coords.tolist()] == list(nodos):
+            return False
+        nueva = actualizar_matriz(None if caducada else actual, nodos, self._calcular_tabla)
+        if self._ruta:
+            nueva.guardar(self._ruta)
+        self.matriz = nueva
+        return True
+
+    def consultar(self, origen, destino):
+        """Distancia y duración entre dos puntos frecuentes, o None si alguno no está en la matriz."""
+        matriz = self.matriz
+        return matriz.consultar(origen, destino) if matriz is not None else None
+
+    def iniciar(self):
+        if self._hilo and self._hilo.is_alive():
+            return
+        self._parar.clear()
+        self._hilo = threading.Thread(target=self._bucle, name="matriz-distancias", daemon=True)
+        self._hilo.start()
+
+    def detener(self):
+        self._parar.set()
+
+    def _bucle(self):
+        while not self._parar.is_set():
+            try:
+                self.comprobar()
+            except Exception as e:
+                print(f"Matriz de distancias: {e}")
+            self._parar.wait(self.intervalo)
+
+
+@st.cache_resource
+def obtener_actualizador_matriz() -> ActualizadorMatriz:
+    """Arranca (una vez por proceso) el mantenimiento de la matriz de lugares frecuentes."""
+    actualizador = ActualizadorMatriz()
+    actualizador.iniciar()
+    return actualizador
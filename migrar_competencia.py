@@ -1,14 +1,37 @@
 """
-Script para migrar datos de competencia de SQLite local a Supabase
-Ejecutar una sola vez después de crear las tablas en Supabase
+Script para migrar datos de SQLite local (crm_notas.db) a Supabase
+Lee por lotes, escribe con upsert sobre claves naturales y guarda un punto de
+control tras cada lote: si se corta la conexión basta con volver a ejecutarlo.
+
+Uso:
+    python migrar_competencia.py                 # competidores, vehículos y cotizaciones
+    python migrar_competencia.py notas           # notas
+    python migrar_competencia.py competencia --reiniciar   # ignora el punto de control
 """
+import json
 import sqlite3
+import sys
+import time
 from pathlib import Path
 from supabase import create_client
-import os
+
+from cola_escritura import es_error_transitorio
 
 # Configuración - ajustar según necesidad
 SQLITE_PATH = Path(__file__).parent / "crm_notas.db"
+DIRECTORIO_CHECKPOINTS = Path(__file__).parent / "datos_locales"
+
+# Filas por lote (lectura de SQLite y upsert en Supabase)
+TAMANO_LOTE = 500
+
+# Reintentos de un lote ante errores de red o del servidor antes de parar la migración
+# (se reanuda desde el último lote escrito). Los datos rechazados no se reintentan:
+# el lote se escribe fila a fila y las rechazadas se anotan en el punto de control.
+MAX_REINTENTOS = 4
+
+# Columna con la clave de origen ('tabla:id') en las tablas sin clave natural
+# (ver supabase_schema_competencia.sql y supabase_schema_config.sql)
+COLUMNA_CLAVE_MIGRACION = 'clave_migracion'
 
 # Leer credenciales de Supabase desde archivo .streamlit/secrets.toml
 def get_supabase_creds():
@@ -24,139 +47,338 @@ def get_supabase_creds():
                     creds[key] = value
     return creds
 
-def migrar():
-    print("=== Migración de Competencia a Supabase ===\n")
 
-    # Conectar a SQLite local
-    if not SQLITE_PATH.exists():
-        print(f"ERROR: No se encuentra la base de datos local en {SQLITE_PATH}")
-        return
+# ============================================
+# ESPECIFICACIONES DE MIGRACIÓN
+# ============================================
+# origen: tabla SQLite. destino: tabla Supabase. filtro: condición SQL opcional.
+# conflicto: clave natural para el upsert (columnas separadas por comas).
+# clave_migracion: si la fila no tiene la clave natural completa se usa 'origen:id'
+#   (solo en esas filas: cada fila lleva únicamente la columna única por la que se resuelve).
+# referencias: {columna: tabla de origen} claves ajenas a traducir a ids de Supabase.
+# guardar_ids: recordar id origen -> id destino para las tablas que la referencian.
+# transformar: fila SQLite (dict) -> fila Supabase (dict).
 
-    conn = sqlite3.connect(str(SQLITE_PATH))
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
+COMPETIDORES = {
+    'origen': 'competidores',
+    'destino': 'competidores',
+    'filtro': 'activo = 1',
+    'conflicto': 'nombre',
+    'guardar_ids': True,
+    'transformar': lambda r: {
+        'nombre': r['nombre'],
+        'segmento': r.get('segmento') or 'estandar',
+        'zona_operacion': r.get('zona_operacion') or '',
+        'flota_estimada': r.get('flota_estimada'),
+        'fortalezas': r.get('fortalezas') or '',
+        'debilidades': r.get('debilidades') or '',
+        'notas': r.get('notas') or '',
+        'activo': True
+    }
+}
 
-    # Conectar a Supabase
-    creds = get_supabase_creds()
-    if not creds.get('SUPABASE_URL') or not creds.get('SUPABASE_SERVICE_ROLE_KEY'):
-        print("ERROR: No se encontraron las credenciales de Supabase en .streamlit/secrets.toml")
-        return
+VEHICULOS = {
+    'origen': 'vehiculos_competencia',
+    'destino': 'vehiculos_competencia',
+    'filtro': 'activo = 1',
+    'conflicto': 'competidor_id,matricula',
+    'clave_migracion': True,
+    'referencias': {'competidor_id': 'competidores'},
+    'transformar': lambda r: {
+        'competidor_id': r['competidor_id'],
+        'matricula': ''.join(str(r['matricula']).split()).replace('-', '').upper() if r.get('matricula') else None,
+        'tipo_vehiculo': r.get('tipo_vehiculo') or 'AUTOBUS',
+        'marca': r.get('marca') or '',
+        'modelo': r.get('modelo') or '',
+        'plazas': r.get('plazas'),
+        'ano_matriculacion': r.get('ano_matriculacion'),
+        'edad': r.get('edad'),
+        'distintivo_ambiental': r.get('distintivo_ambiental') or '',
+        'pmr': bool(r.get('pmr')),
+        'wc': bool(r.get('wc')),
+        'wifi': bool(r.get('wifi')),
+        'escolar': bool(r.get('escolar')),
+        'observaciones': r.get('observaciones') or '',
+        'activo': True
+    }
+}
 
-    supabase = create_client(creds['SUPABASE_URL'], creds['SUPABASE_SERVICE_ROLE_KEY'])
+COTIZACIONES = {
+    'origen': 'cotizaciones_competencia',
+    'destino': 'cotizaciones_competencia',
+    'conflicto': COLUMNA_CLAVE_MIGRACION,
+    'clave_migracion': True,
+    'referencias': {'competidor_id': 'competidores'},
+    'transformar': lambda r: {
+        'competidor_id': r['competidor_id'],
+        'tipo_servicio': r.get('tipo_servicio'),
+        'precio': r.get('precio'),
+        'tipo_vehiculo': r.get('tipo_vehiculo') or 'STD',
+        'km_estimados': r.get('km_estimados'),
+        'duracion_horas': r.get('duracion_horas'),
+        'origen': r.get('origen') or '',
+        'destino': r.get('destino') or '',
+        'fecha_captura': r.get('fecha_captura'),
+        'fuente': r.get('fuente') or '',
+        'notas': r.get('notas') or ''
+    }
+}
 
-    # 1. Migrar competidores
-    print("1. Migrando competidores...")
-    cursor.execute("SELECT * FROM competidores WHERE activo = 1")
-    competidores = [dict(row) for row in cursor.fetchall()]
+NOTAS = {
+    'origen': 'notas',
+    'destino': 'notas',
+    'conflicto': COLUMNA_CLAVE_MIGRACION,
+    'clave_migracion': True,
+    'transformar': lambda r: {
+        'cod_presupuesto': r.get('cod_presupuesto'),
+        'cliente': r.get('cliente'),
+        'fecha': r.get('fecha'),
+        'usuario': r.get('usuario') or 'Sistema',
+        'contenido': r.get('contenido'),
+        'tipo': r.get('tipo')
+    }
+}
 
-    mapa_ids = {}  # SQLite ID -> Supabase ID
+MIGRACIONES = {
+    'competencia': [COMPETIDORES, VEHICULOS, COTIZACIONES],
+    'notas': [NOTAS],
+}
 
-    for comp in competidores:
-        try:
-            # Verificar si ya existe
-            existe = supabase.table('competidores').select('id').eq('nombre', comp['nombre']).execute()
-            if existe.data:
-                mapa_ids[comp['id']] = existe.data[0]['id']
-                print(f"   - {comp['nombre']}: ya existe (id={existe.data[0]['id']})")
-                continue
 
-            result = supabase.table('competidores').insert({
-                'nombre': comp['nombre'],
-                'segmento': comp.get('segmento', 'estandar'),
-                'zona_operacion': comp.get('zona_operacion', ''),
-                'flota_estimada': comp.get('flota_estimada'),
-                'fortalezas': comp.get('fortalezas', ''),
-                'debilidades': comp.get('debilidades', ''),
-                'notas': comp.get('notas', ''),
-                'activo': True
-            }).execute()
-
-            if result.data:
-                mapa_ids[comp['id']] = result.data[0]['id']
-                print(f"   - {comp['nombre']}: migrado (id={result.data[0]['id']})")
-        except Exception as e:
-            print(f"   - {comp['nombre']}: ERROR - {e}")
+# ============================================
+# MOTOR DE MIGRACIÓN
+# ============================================
 
-    print(f"\n   Total competidores migrados: {len(mapa_ids)}")
+class MigradorSQLite:
+    """
+    Migra tablas de una base SQLite a Supabase por lotes, de forma reanudable e idempotente.
 
-    # 2. Migrar vehículos
-    print("\n2. Migrando vehículos...")
-    cursor.execute("SELECT * FROM vehiculos_competencia WHERE activo = 1")
-    vehiculos = [dict(row) for row in cursor.fetchall()]
+    Las filas ya existentes en destino (misma clave natural o misma clave de migración)
+    no se sobrescriben. El punto de control guarda, por tabla, el último rowid escrito,
+    la traducción de ids que necesitan las tablas dependientes y las filas rechazadas
+    por Supabase (id de origen y error), que cuentan como saltadas.
+    """
 
-    count_vehiculos = 0
-    for veh in vehiculos:
-        try:
-            nuevo_comp_id = mapa_ids.get(veh['competidor_id'])
-            if not nuevo_comp_id:
-                print(f"   - Saltando vehículo {veh.get('matricula')}: competidor no migrado")
+    def __init__(self, ruta_sqlite: Path, cliente, nombre: str, tamano_lote: int = TAMANO_LOTE,
+                 ruta_checkpoint: Path = None):
+        self.ruta_sqlite = Path(ruta_sqlite)
+        self.cliente = cliente
+        self.tamano_lote = tamano_lote
+        self.ruta_checkpoint = Path(ruta_checkpoint or DIRECTORIO_CHECKPOINTS / f"migracion_{nombre}.json")
+        self.checkpoint = self._cargar_checkpoint()
+
+    # ---------- Punto de control ----------
+
+    def _cargar_checkpoint(self) -> dict:
+        if self.ruta_checkpoint.exists():
+            with open(self.ruta_checkpoint, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        return {'tablas': {}}
+
+    def _guardar_checkpoint(self):
+        self.ruta_checkpoint.parent.mkdir(parents=True, exist_ok=True)
+        temporal = self.ruta_checkpoint.with_suffix('.tmp')
+        with open(temporal, 'w', encoding='utf-8') as f:
+            json.dump(self.checkpoint, f, indent=1)
+        temporal.replace(self.ruta_checkpoint)
+
+    def reiniciar(self):
+        """Olvida el punto de control (la siguiente ejecución empieza desde el principio)."""
+        self.checkpoint = {'tablas': {}}
+        if self.ruta_checkpoint.exists():
+            self.ruta_checkpoint.unlink()
+
+    def _estado(self, origen: str) -> dict:
+        return self.checkpoint['tablas'].setdefault(origen, {
+            'ultimo_rowid': 0, 'completada': False, 'ids': {}, 'rechazadas': [],
+            'leidas': 0, 'escritas': 0, 'saltadas': 0
+        })
+
+    # ---------- Lectura ----------
+
+    def _leer_lotes(self, conn, spec: dict, desde_rowid: int):
+        """Recorre la tabla de origen por rowid, tamano_lote filas cada vez."""
+        filtro = f"AND ({spec['filtro']})" if spec.get('filtro') else ''
+        while True:
+            filas = conn.execute(
+                f"SELECT rowid AS _rowid, * FROM {spec['origen']} WHERE rowid > ? {filtro} ORDER BY rowid LIMIT ?",
+                (desde_rowid, self.tamano_lote)
+            ).fetchall()
+            if not filas:
+                return
+            desde_rowid = filas[-1]['_rowid']
+            yield [dict(f) for f in filas]
+
+    # ---------- Escritura ----------
+
+    def _preparar(self, spec: dict, filas: list) -> tuple:
+        """Transforma y agrupa un lote por clave de conflicto. Retorna ({conflicto: [(id_origen, fila)]}, saltadas)."""
+        columnas_clave = spec['conflicto'].split(',')
+        grupos = {}
+        saltadas = 0
+        for fila_origen in filas:
+            id_origen = fila_origen.get('id', fila_origen['_rowid'])
+            fila = spec['transformar'](fila_origen)
+
+            # Traducir claves ajenas a ids de Supabase
+            ok = True
+            for columna, tabla_ref in spec.get('referencias', {}).items():
+                destino = self._estado(tabla_ref)['ids'].get(str(fila.get(columna)))
+                if destino is None:
+                    ok = False
+                    break
+                fila[columna] = destino
+            if not ok:
+                saltadas += 1
                 continue
 
-            # Verificar si ya existe por matrícula
-            if veh.get('matricula'):
-                existe = supabase.table('vehiculos_competencia').select('id')\
-                    .eq('competidor_id', nuevo_comp_id)\
-                    .eq('matricula', veh['matricula']).execute()
-                if existe.data:
-                    continue  # Ya existe
-
-            supabase.table('vehiculos_competencia').insert({
-                'competidor_id': nuevo_comp_id,
-                'matricula': veh.get('matricula'),
-                'tipo_vehiculo': veh.get('tipo_vehiculo', 'AUTOBUS'),
-                'marca': veh.get('marca', ''),
-                'modelo': veh.get('modelo', ''),
-                'plazas': veh.get('plazas'),
-                'ano_matriculacion': veh.get('ano_matriculacion'),
-                'edad': veh.get('edad'),
-                'distintivo_ambiental': veh.get('distintivo_ambiental', ''),
-                'pmr': bool(veh.get('pmr')),
-                'wc': bool(veh.get('wc')),
-                'wifi': bool(veh.get('wifi')),
-                'escolar': bool(veh.get('escolar')),
-                'observaciones': veh.get('observaciones', ''),
-                'activo': True
-            }).execute()
-            count_vehiculos += 1
+            # ignore_duplicates solo evita el choque en la columna del on_conflict: la clave de
+            # migración (UNIQUE) se pone solo si es esa columna, o chocaría por su cuenta
+            clave_migracion = f"{spec['origen']}:{id_origen}"
+            if spec['conflicto'] == COLUMNA_CLAVE_MIGRACION:
+                fila[COLUMNA_CLAVE_MIGRACION] = clave_migracion
+            if all(fila.get(c) is not None for c in columnas_clave):
+                conflicto = spec['conflicto']
+            elif spec.get('clave_migracion'):
+                fila[COLUMNA_CLAVE_MIGRACION] = clave_migracion
+                conflicto = COLUMNA_CLAVE_MIGRACION
+            else:
+                saltadas += 1
+                continue
+            grupos.setdefault(conflicto, {})
+            clave = tuple(fila.get(c) for c in conflicto.split(','))
+            # Una misma clave dos veces en el lote haría fallar el upsert: gana la última
+            grupos[conflicto][clave] = (id_origen, fila)
+        return {c: list(g.values()) for c, g in grupos.items()}, saltadas
+
+    def _upsert(self, destino: str, filas: list, conflicto: str):
+        """Upsert con reintentos solo ante errores transitorios; los demás se relanzan al momento."""
+        for intento in range(MAX_REINTENTOS):
+            try:
+                self.cliente.table(destino).upsert(filas, on_conflict=conflicto, ignore_duplicates=True).execute()
+                return
+            except Exception as e:
+                if not es_error_transitorio(e) or intento == MAX_REINTENTOS - 1:
+                    raise
+                espera = 2 ** intento
+                print(f"   - Error escribiendo en {destino} ({e}); reintento en {espera}s")
+                time.sleep(espera)
+
+    def _escribir_grupo(self, destino: str, pares: list, conflicto: str) -> tuple:
+        """
+        Escribe [(id_origen, fila)]. Si Supabase rechaza el lote (no transitorio) se
+        escribe fila a fila para aislar las culpables.
+        Retorna (pares escritos, [{'id': id_origen, 'error': texto}] rechazados).
+        """
+        try:
+            self._upsert(destino, [fila for _, fila in pares], conflicto)
+            return pares, []
         except Exception as e:
-            print(f"   - Error vehículo {veh.get('matricula')}: {e}")
+            if es_error_transitorio(e):
+                raise
+
+        escritos, rechazados = [], []
+        for id_origen, fila in pares:
+            try:
+                self._upsert(destino, [fila], conflicto)
+                escritos.append((id_origen, fila))
+            except Exception as e:
+                if es_error_transitorio(e):
+                    raise
+                print(f"   - Fila {id_origen} rechazada por {destino}: {e}")
+                rechazados.append({'id': id_origen, 'error': str(e)})
+        return escritos, rechazados
+
+    def _leer_ids(self, spec: dict, pares: list) -> dict:
+        """id origen -> id destino, buscando en Supabase por la clave natural (de una sola columna)."""
+        columna = spec['conflicto']
+        valores = [fila[columna] for _, fila in pares]
+        result = self.cliente.table(spec['destino']).select(f"id, {columna}").in_(columna, valores).execute()
+        por_valor = {r[columna]: r['id'] for r in result.data or []}
+        return {str(id_origen): por_valor[fila[columna]] for id_origen, fila in pares if fila[columna] in por_valor}
+
+    def migrar_tabla(self, conn, spec: dict) -> dict:
+        estado = self._estado(spec['origen'])
+        if estado['completada']:
+            print(f"   - {spec['origen']}: ya migrada ({estado['escritas']} filas)")
+            return estado
 
-    print(f"   Total vehículos migrados: {count_vehiculos}")
+        for lote in self._leer_lotes(conn, spec, estado['ultimo_rowid']):
+            grupos, saltadas = self._preparar(spec, lote)
+            for conflicto, pares in grupos.items():
+                escritos, rechazados = self._escribir_grupo(spec['destino'], pares, conflicto)
+                if spec.get('guardar_ids') and escritos:
+                    estado['ids'].update(self._leer_ids(spec, escritos))
+                estado['escritas'] += len(escritos)
+                estado.setdefault('rechazadas', []).extend(rechazados)
+                saltadas += len(rechazados)
 
-    # 3. Migrar cotizaciones
-    print("\n3. Migrando cotizaciones...")
-    cursor.execute("SELECT * FROM cotizaciones_competencia")
-    cotizaciones = [dict(row) for row in cursor.fetchall()]
+            estado['leidas'] += len(lote)
+            estado['saltadas'] += saltadas
+            estado['ultimo_rowid'] = lote[-1]['_rowid']
+            self._guardar_checkpoint()
+            print(f"   - {spec['origen']}: {estado['leidas']} leídas, {estado['escritas']} escritas, "
+                  f"{estado['saltadas']} saltadas")
 
-    count_cot = 0
-    for cot in cotizaciones:
+        estado['completada'] = True
+        self._guardar_checkpoint()
+        return estado
+
+    def migrar(self, especificaciones: list) -> dict:
+        """Migra las tablas en orden (las referenciadas antes que las que las referencian)."""
+        conn = sqlite3.connect(str(self.ruta_sqlite))
+        conn.row_factory = sqlite3.Row
         try:
-            nuevo_comp_id = mapa_ids.get(cot['competidor_id'])
-            if not nuevo_comp_id:
-                continue
+            existentes = {r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+            resumen = {}
+            for i, spec in enumerate(especificaciones, start=1):
+                print(f"{i}. Migrando {spec['origen']} -> {spec['destino']}...")
+                if spec['origen'] not in existentes:
+                    print(f"   - {spec['origen']}: no existe en {self.ruta_sqlite.name}, se omite")
+                    continue
+                estado = self.migrar_tabla(conn, spec)
+                resumen[spec['origen']] = {k: estado[k] for k in ('leidas', 'escritas', 'saltadas')}
+            return resumen
+        finally:
+            conn.close()
 
-            supabase.table('cotizaciones_competencia').insert({
-                'competidor_id': nuevo_comp_id,
-                'tipo_servicio': cot.get('tipo_servicio'),
-                'precio': cot.get('precio'),
-                'tipo_vehiculo': cot.get('tipo_vehiculo', 'STD'),
-                'km_estimados': cot.get('km_estimados'),
-                'duracion_horas': cot.get('duracion_horas'),
-                'origen': cot.get('origen', ''),
-                'destino': cot.get('destino', ''),
-                'fecha_captura': cot.get('fecha_captura'),
-                'fuente': cot.get('fuente', ''),
-                'notas': cot.get('notas', '')
-            }).execute()
-            count_cot += 1
-        except Exception as e:
-            print(f"   - Error cotización: {e}")
 
-    print(f"   Total cotizaciones migradas: {count_cot}")
+def migrar(nombre: str = 'competencia', reiniciar: bool = False):
+    print(f"=== Migración de {nombre} a Supabase ===\n")
+
+    if nombre not in MIGRACIONES:
+        print(f"ERROR: migración desconocida '{nombre}'. Opciones: {', '.join(MIGRACIONES)}")
+        return
+
+    # Conectar a SQLite local
+    if not SQLITE_PATH.exists():
+        print(f"ERROR: No se encuentra la base de datos local en {SQLITE_PATH}")
+        return
+
+    # Conectar a Supabase
+    creds = get_supabase_creds()
+    if not creds.get('SUPABASE_URL') or not creds.get('SUPABASE_SERVICE_ROLE_KEY'):
+        print("ERROR: No se encontraron las credenciales de Supabase en .streamlit/secrets.toml")
+        return
+
+    supabase = create_client(creds['SUPABASE_URL'], creds['SUPABASE_SERVICE_ROLE_KEY'])
+
+    migrador = MigradorSQLite(SQLITE_PATH, supabase, nombre)
+    if reiniciar:
+        migrador.reiniciar()
+
+    try:
+        resumen = migrador.migrar(MIGRACIONES[nombre])
+    except Exception as e:
+        print(f"\nERROR: {e}")
+        print("La migración se ha detenido. Vuelve a ejecutar el script para continuar desde el último lote.")
+        return
 
-    conn.close()
     print("\n=== Migración completada ===")
+    for tabla, datos in resumen.items():
+        print(f"   {tabla}: {datos['escritas']} escritas, {datos['saltadas']} saltadas de {datos['leidas']}")
 
 
 if __name__ == "__main__":
-    migrar()
+    argumentos = [a for a in sys.argv[1:] if not a.startswith('--')]
+    migrar(argumentos[0] if argumentos else 'competencia', reiniciar='--reiniciar' in sys.argv)
@@ -0,0 +1,73 @@
+"""
+Servicio de permisos por sección
+Carga la matriz completa usuario × sección de permisos_seccion en una sola consulta
+y la mantiene en caché hasta que cambia la versión de la tabla (ver supabase_schema_sync.sql).
+La usan tanto la comprobación de acceso de app.py como el editor del panel de administración.
+"""
+import streamlit as st
+from supabase_client import get_admin_client
+from invalidacion import registrar_invalidacion
+
+# Filas por página al leer permisos_seccion (límite por defecto de PostgREST)
+TAMANO_PAGINA = 1000
+
+# Permiso que se asume para una sección sin fila en permisos_seccion
+PERMISO_POR_DEFECTO = {'ver': True, 'editar': False}
+
+
+def construir_matriz(filas: list) -> dict:
+    """Filas de permisos_seccion -> {usuario_id: {seccion: {'ver', 'editar'}}}."""
+    matriz = {}
+    for p in filas:
+        matriz.setdefault(p['usuario_id'], {})[p['seccion']] = {
+            'ver': p['puede_ver'],
+            'editar': p['puede_editar']
+        }
+    return matriz
+
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def _cargar_matriz_cached() -> dict:
+    """Matriz completa de permisos (una consulta; más solo si supera TAMANO_PAGINA filas)."""
+    client = get_admin_client()
+    filas = []
+    while True:
+        pagina = client.table('permisos_seccion').select(
+            'usuario_id, seccion, puede_ver, puede_editar'
+        ).order('usuario_id').order('seccion').range(len(filas), len(filas) + TAMANO_PAGINA - 1).execute().data or []
+        filas.extend(pagina)
+        if len(pagina) < TAMANO_PAGINA:
+            break
+    return construir_matriz(filas)
+
+
+def obtener_matriz_permisos() -> dict:
+    """{usuario_id: {seccion: {'ver': bool, 'editar': bool}}} de todos los usuarios (cacheado)."""
+    return _cargar_matriz_cached()
+
+
+def permisos_usuario(usuario_id: str) -> dict:
+    """Permisos de un usuario: {seccion: {'ver', 'editar'}}."""
+    return obtener_matriz_permisos().get(usuario_id, {})
+
+
+def limpiar_cache_permisos():
+    _cargar_matriz_cached.clear()
+
+
+def guardar_permisos_usuario(usuario_id: str, permisos: dict):
+    """Guarda {seccion: {'ver', 'editar'}} de un usuario en un único upsert."""
+    get_admin_client().table('permisos_seccion').upsert([
+        {
+            'usuario_id': usuario_id,
+            'seccion': seccion,
+            'puede_ver': p['ver'],
+            'puede_editar': p['editar'] if p['ver'] else False
+        }
+        for seccion, p in permisos.items()
+    ], on_conflict='usuario_id,seccion').execute()
+    limpiar_cache_permisos()
+
+
+# Cambios de permisos hechos desde otro proceso
+registrar_invalidacion('permisos_seccion', _cargar_matriz_cached)
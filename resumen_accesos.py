@@ -0,0 +1,83 @@
+"""
+Resúmenes del log de accesos por hora y por día
+Supabase mantiene log_accesos_resumen con un trigger en cada inserción
+(ver supabase_schema_admin.sql); agregar_accesos hace lo mismo en local,
+para pruebas y como respaldo si la tabla de resumen no está desplegada.
+"""
+from datetime import datetime, timezone
+
+import streamlit as st
+from supabase_client import get_admin_client
+
+GRANULARIDADES = ('hora', 'dia')
+
+# Filas por página al leer el resumen (límite por defecto de PostgREST)
+TAMANO_PAGINA = 1000
+
+
+def truncar_periodo(timestamp: str, granularidad: str) -> str:
+    """Inicio (UTC, ISO) de la hora o el día al que pertenece el timestamp, como date_trunc."""
+    momento = datetime.fromisoformat(str(timestamp).replace('Z', '+00:00'))
+    if momento.tzinfo is None:
+        momento = momento.replace(tzinfo=timezone.utc)
+    momento = momento.astimezone(timezone.utc)
+    if granularidad == 'hora':
+        momento = momento.replace(minute=0, second=0, microsecond=0)
+    else:
+        momento = momento.replace(hour=0, minute=0, second=0, microsecond=0)
+    return momento.isoformat()
+
+
+def agregar_accesos(eventos: list, granularidad: str = 'dia') -> list:
+    """
+    Agrega eventos de log_accesos por (periodo, usuario_id, seccion, accion).
+    Retorna filas con la misma forma que log_accesos_resumen.
+    """
+    totales = {}
+    for e in eventos:
+        clave = (truncar_periodo(e['timestamp'], granularidad), e.get('usuario_id'),
+                 e.get('seccion') or '', e.get('accion'))
+        totales[clave] = totales.get(clave, 0) + 1
+    return [
+        {'granularidad': granularidad, 'periodo': periodo, 'usuario_id': usuario_id,
+         'seccion': seccion, 'accion': accion, 'total': total}
+        for (periodo, usuario_id, seccion, accion), total in sorted(totales.items(), key=lambda x: x[0][0])
+    ]
+
+
+def totales_por(filas: list, campo: str) -> dict:
+    """Suma 'total' de filas de resumen agrupando por un campo (periodo, seccion, usuario_id o accion)."""
+    totales = {}
+    for f in filas:
+        totales[f[campo]] = totales.get(f[campo], 0) + f['total']
+    return dict(sorted(totales.items(), key=lambda x: x[1], reverse=True))
+
+
+def _leer_todo(query_base) -> list:
+    """
+    Lee todas las páginas por rangos. query_base() debe ordenar por una clave única:
+    con empates el orden entre páginas no es estable y se repetirían o saltarían filas.
+    """
+    filas = []
+    while True:
+        pagina = query_base().range(len(filas), len(filas) + TAMANO_PAGINA - 1).execute().data or []
+        filas.extend(pagina)
+        if len(pagina) < TAMANO_PAGINA:
+            return filas
+
+
+@st.cache_data(ttl=300, show_spinner="Cargando actividad...")
+def obtener_resumen_accesos(granularidad: str, desde: str) -> list:
+    """Filas de log_accesos_resumen desde una fecha (ISO). Si el resumen no existe, agrega el log en local."""
+    client = get_admin_client()
+    try:
+        return _leer_todo(lambda: client.table('log_accesos_resumen')
+                          .select('granularidad, periodo, usuario_id, seccion, accion, total')
+                          .eq('granularidad', granularidad).gte('periodo', desde)
+                          .order('periodo').order('usuario_id').order('seccion').order('accion'))
+    except Exception as e:
+        print(f"Resumen de accesos no disponible ({e}); se agrega el log en local")
+        eventos = _leer_todo(lambda: client.table('log_accesos')
+                             .select('timestamp, usuario_id, seccion, accion')
+                             .gte('timestamp', desde).order('timestamp').order('id'))
+        return agregar_accesos(eventos, granularidad)
@@ -0,0 +1,333 @@
+"""
+Rutas por carretera para la Calculadora (OSRM)
+calcular_ruta_osrm consulta un tramo; planificar_ruta resuelve a la vez los tres
+tramos de un presupuesto (posicionamiento de ida, servicio y posicionamiento de vuelta),
+de modo que la espera total es la del tramo más lento y no la suma de todos.
+Las rutas calculadas se guardan en disco (CacheRutas) con las coordenadas ajustadas
+a una rejilla, así un mismo trayecto entre cocheras, colegios o aeropuertos no vuelve a OSRM
+aunque el geocodificador devuelva un punto ligeramente distinto.
+La geometría viaja como polilínea codificada (ver geometria.py), no como lista de puntos.
+Si OSRM falla o está caído (circuito abierto) se responde al momento con una
+estimación calibrada con esas mismas rutas guardadas (ver estimador_rutas.py).
+"""
+import json
+import sqlite3
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+
+import requests
+import streamlit as st
+
+try:
+    from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+except ImportError:  # Streamlit antiguo: los hilos trabajan sin contexto
+    add_script_run_ctx = get_script_run_ctx = None
+
+from geometria import codificar_polilinea, decodificar_polilinea
+from estimador_rutas import EstimadorRutas
+
+URL_OSRM = "http://router.project-osrm.org/route/v1/driving"
+
+# Segundos máximos por petición a OSRM
+TIMEOUT_OSRM = 10
+
+# Hilos para los tramos de un presupuesto (como mucho hay tres en paralelo)
+HILOS_TRAMOS = 3
+
+TRAMOS = ('pos_ida', 'servicio', 'pos_vuelta')
+
+RUTA_CACHE_RUTAS = Path(__file__).parent / "datos_locales" / "rutas.db"
+
+# Tamaño de la rejilla en grados (0.002° ≈ 200 m de latitud)
+REJILLA_GRADOS = 0.002
+
+# Segundos que vale una ruta guardada (las carreteras cambian poco)
+TTL_RUTAS = 180 * 24 * 3600
+
+# Fallos seguidos de OSRM que abren el circuito y segundos que permanece abierto
+FALLOS_APERTURA = 3
+SEGUNDOS_CIRCUITO_ABIERTO = 120
+
+# Segundos entre recalibraciones del estimador con la caché de rutas
+INTERVALO_CALIBRACION = 24 * 3600
+
+
+def cuantizar(puntos, rejilla: float = REJILLA_GRADOS) -> tuple:
+    """Ajusta cada (lat, lon) al centro de su celda de la rejilla."""
+    return tuple((round(round(lat / rejilla) * rejilla, 6), round(round(lon / rejilla) * rejilla, 6))
+                 for lat, lon in puntos)
+
+
+class CacheRutas:
+    """
+    Rutas OSRM en SQLite, clave = secuencia de puntos cuantizados.
+    Guarda distancia, duración y la polilínea codificada comprimida con zlib.
+    """
+
+    def __init__(self, ruta: Path = RUTA_CACHE_RUTAS, rejilla: float = REJILLA_GRADOS, ttl: float = TTL_RUTAS):
+        self._ruta = Path(ruta)
+        self.rejilla = rejilla
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._ruta.parent.mkdir(parents=True, exist_ok=True)
+        self._crear_esquema()
+
+    @contextmanager
+    def _conexion(self):
+        conn = sqlite3.connect(str(self._ruta), timeout=10)
+        try:
+            yield conn
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _crear_esquema(self):
+        with self._conexion() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS rutas (
+                    clave TEXT PRIMARY KEY,
+                    puntos TEXT NOT NULL,
+                    distancia_km REAL NOT NULL,
+                    duracion_min REAL NOT NULL,
+                    geometria BLOB,
+                    fecha REAL NOT NULL
+                )
+            """)
+
+    def _clave(self, puntos) -> str:
+        return ';'.join(f"{lat:.6f},{lon:.6f}" for lat, lon in cuantizar(puntos, self.rejilla))
+
+    @staticmethod
+    def _comprimir(polilinea: str) -> bytes:
+        return zlib.compress(polilinea.encode())
+
+    @staticmethod
+    def _descomprimir(geometria: bytes) -> str:
+        return zlib.decompress(geometria).decode() if geometria else ''
+
+    def obtener(self, puntos, ahora: float = None):
+        """Ruta guardada (mismo formato que calcular_ruta_osrm) o None si no hay o ha caducado."""
+        ahora = time.time() if ahora is None else ahora
+        with self._conexion() as conn:
+            fila = conn.execute(
+                "SELECT distancia_km, duracion_min, geometria, fecha FROM rutas WHERE clave = ?",
+                (self._clave(puntos),)
+            ).fetchone()
+        if fila is None or fila[3] + self.ttl < ahora:
+            return None
+        return {'distancia_km': fila[0], 'duracion_min': fila[1], 'polilinea': self._descomprimir(fila[2])}
+
+    def guardar(self, puntos, ruta: dict, ahora: float = None):
+        ahora = time.time() if ahora is None else ahora
+        with self._lock, self._conexion() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO rutas (clave, puntos, distancia_km, duracion_min, geometria, fecha) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (self._clave(puntos), json.dumps(cuantizar(puntos, self.rejilla)), ruta['distancia_km'],
+                 ruta['duracion_min'], self._comprimir(ruta.get('polilinea', '')), ahora)
+            )
+
+    def purgar_caducadas(self, ahora: float = None) -> int:
+        ahora = time.time() if ahora is None else ahora
+        with self._lock, self._conexion() as conn:
+            return conn.execute("DELETE FROM rutas WHERE fecha < ?", (ahora - self.ttl,)).rowcount
+
+    def muestras(self) -> list:
+        """[(puntos, distancia_km, duracion_min)] de todas las rutas guardadas (para calibrar el estimador)."""
+        with self._conexion() as conn:
+            filas = conn.execute("SELECT puntos, distancia_km, duracion_min FROM rutas").fetchall()
+        return [([tuple(p) for p in json.loads(puntos)], distancia, duracion) for puntos, distancia, duracion in filas]
+
+
+class Circuito:
+    """
+    Cortacircuitos del servicio de rutas: tras FALLOS_APERTURA fallos seguidos deja de
+    llamarlo durante SEGUNDOS_CIRCUITO_ABIERTO. Pasado ese tiempo queda semiabierto:
+    deja pasar una sola petición de prueba y rechaza las demás hasta que esa termine
+    (exito lo cierra, fallo lo vuelve a abrir).
+    """
+
+    def __init__(self, fallos_apertura: int = FALLOS_APERTURA,
+                 segundos_abierto: float = SEGUNDOS_CIRCUITO_ABIERTO, reloj=time.monotonic):
+        self.fallos_apertura = fallos_apertura
+        self.segundos_abierto = segundos_abierto
+        self._reloj = reloj
+        self._fallos = 0
+        self._abierto_hasta = 0.0
+        self._prueba_en_curso = False
+        self._lock = threading.Lock()
+
+    def permite(self) -> bool:
+        """Si se puede llamar al servicio; quien recibe True debe llamar después a exito o fallo."""
+        with self._lock:
+            if self._fallos < self.fallos_apertura:
+                return True
+            if self._reloj() < self._abierto_hasta or self._prueba_en_curso:
+                return False
+            self._prueba_en_curso = True
+            return True
+
+    def exito(self):
+        with self._lock:
+            self._fallos = 0
+            self._prueba_en_curso = False
+
+    def fallo(self):
+        with self._lock:
+            self._fallos += 1
+            self._prueba_en_curso = False
+            if self._fallos >= self.fallos_apertura:
+                self._abierto_hasta = self._reloj() + self.segundos_abierto
+
+
+@st.cache_resource
+def obtener_cache_rutas() -> CacheRutas:
+    """Caché de rutas compartida por todas las sesiones del proceso."""
+    cache = CacheRutas()
+    cache.purgar_caducadas()
+    return cache
+
+
+@st.cache_resource
+def obtener_circuito_osrm() -> Circuito:
+    return Circuito()
+
+
+@st.cache_resource(ttl=INTERVALO_CALIBRACION)
+def obtener_estimador_rutas() -> EstimadorRutas:
+    """Estimador calibrado con la caché de rutas (se recalibra una vez al día)."""
+    try:
+        return EstimadorRutas().calibrar(obtener_cache_rutas().muestras())
+    except Exception as e:
+        print(f"No se pudo calibrar el estimador de rutas: {e}")
+        return EstimadorRutas()
+
+
+def _consultar_osrm(puntos) -> dict:
+    """Consulta OSRM; lanza excepción si falla."""
+    # Formatear coordenadas para OSRM (lon,lat)
+    coords = ";".join([f"{p[1]},{p[0]}" for p in puntos])
+    response = requests.get(f"{URL_OSRM}/{coords}", params={'overview': 'full', 'geometries': 'polyline'},
+                            timeout=TIMEOUT_OSRM)
+    response.raise_for_status()
+    data = response.json()
+    if data['code'] != 'Ok':
+        raise ValueError(f"OSRM respondió {data['code']}")
+    route = data['routes'][0]
+    # OSRM ya entrega la geometría como polilínea codificada (precisión 1e-5, lat/lon)
+    return {
+        'distancia_km': round(route['distance'] / 1000, 1),
+        'duracion_min': round(route['duration'] / 60, 0),
+        'polilinea': route['geometry']
+    }
+
+
+def calcular_ruta_osrm(puntos, cache: CacheRutas = None, circuito: Circuito = None,
+                       estimador: EstimadorRutas = None):
+    """
+    Calcula la ruta por carretera usando OSRM (gratuito), pasando antes por la caché en disco.
+    puntos: lista de tuplas (lat, lon)
+    Retorna: distancia en km, duracion en minutos, polilínea codificada de la ruta.
+    Si OSRM no responde retorna una estimación con 'estimado': True (no se guarda en la caché).
+    Solo retorna None con menos de dos puntos.
+    """
+    if len(puntos) < 2:
+        return None
+    puntos = [(float(p[0]), float(p[1])) for p in puntos]
+    cache = cache or obtener_cache_rutas()
+    ruta = cache.obtener(puntos)
+    if ruta is not None:
+        return ruta
+
+    circuito = circuito or obtener_circuito_osrm()
+    if circuito.permite():
+        try:
+            ruta = _consultar_osrm(puntos)
+        except Exception as e:
+            print(f"Error al calcular ruta: {e}")
+            circuito.fallo()
+        else:
+            circuito.exito()
+            cache.guardar(puntos, ruta)
+            return ruta
+    return (estimador or obtener_estimador_rutas()).estimar(puntos)
+
+
+def _heredar_contexto():
+    """
+    Inicializador de hilos que les pasa el ScriptRunContext de la sesión actual, para que
+    geocodificar y calcular_ruta puedan usar st.cache_*, st.secrets y st.session_state.
+    """
+    contexto = get_script_run_ctx() if get_script_run_ctx else None
+    if contexto is None:
+        return None
+    return lambda: add_script_run_ctx(threading.current_thread(), contexto)
+
+
+def planificar_ruta(origen, destino, paradas=(), base_direccion: str = None,
+                    incluir_pos_ida: bool = True, incluir_pos_vuelta: bool = True,
+                    *, geocodificar, calcular_ruta=calcular_ruta_osrm, consultar_matriz=None) -> dict:
+    """
+    Calcula los tramos de un presupuesto en paralelo (los hilos heredan el contexto
+    de Streamlit de la sesión que llama, ver _heredar_contexto).
+    origen, destino, paradas: coordenadas (lat, lon). base_direccion se geocodifica
+    (una sola vez) con geocodificar(direccion) -> (lat, lon, nombre) si hay posicionamientos.
+    consultar_matriz(a, b): distancia/duración precalculada entre lugares frecuentes
+    (ver matriz_distancias.py); si responde, el posicionamiento no se enruta y va sin geometría.
+
+    Retorna {'tramos': {tramo: ruta o None}, 'base': (lat, lon) o None,
+             'km_desglose': {tramo: km}, 'minutos_desglose': {tramo: min}, 'km_total',
+             'puntos': [(lat, lon)], 'polilinea': ruta completa codificada,
+             'estimado': [tramo sin servicio de rutas], 'errores': ['base'] o []}.
+    Los tramos siempre tienen ruta (real o estimada); el único error posible es que
+    no se pueda geocodificar la base, y entonces no hay posicionamientos.
+    """
+    puntos_servicio = [origen, *paradas, destino]
+    necesita_base = bool(base_direccion) and (incluir_pos_ida or incluir_pos_vuelta)
+
+    with ThreadPoolExecutor(max_workers=HILOS_TRAMOS, initializer=_heredar_contexto()) as pool:
+        futuro_servicio = pool.submit(calcular_ruta, puntos_servicio)
+        futuro_base = pool.submit(geocodificar, base_direccion) if necesita_base else None
+
+        base = None
+        tramos = dict.fromkeys(TRAMOS)
+        futuros = {'servicio': futuro_servicio}
+        if futuro_base is not None:
+            base_geo = futuro_base.result()
+            if base_geo:
+                base = (base_geo[0], base_geo[1])
+                for tramo, incluir, a, b in (('pos_ida', incluir_pos_ida, base, origen),
+                                             ('pos_vuelta', incluir_pos_vuelta, destino, base)):
+                    if not incluir:
+                        continue
+                    precalculado = consultar_matriz(a, b) if consultar_matriz else None
+                    if precalculado:
+                        tramos[tramo] = {**precalculado, 'polilinea': ''}
+                    else:
+                        futuros[tramo] = pool.submit(calcular_ruta, [a, b])
+        tramos.update({tramo: futuro.result() for tramo, futuro in futuros.items()})
+
+    puntos = ([base] if base and incluir_pos_ida else []) + puntos_servicio \
+        + ([base] if base and incluir_pos_vuelta else [])
+    ruta_coords = []
+    for tramo in TRAMOS:
+        if tramos[tramo]:
+            ruta_coords.extend(decodificar_polilinea(tramos[tramo].get('polilinea', '')))
+
+    km_desglose = {t: round(tramos[t]['distancia_km']) if tramos[t] else 0 for t in TRAMOS}
+    return {
+        'tramos': tramos,
+        'base': base,
+        'km_desglose': km_desglose,
+        'minutos_desglose': {t: tramos[t].get('duracion_min', 0) if tramos[t] else 0 for t in TRAMOS},
+        'km_total': sum(km_desglose.values()),
+        'puntos': puntos,
+        'polilinea': codificar_polilinea(ruta_coords),
+        'estimado': [t for t in TRAMOS if tramos[t] and tramos[t].get('estimado')],
+        'errores': ['base'] if necesita_base and base is None else [],
+    }
@@ -16,6 +16,18 @@ def get_supabase() -> Client:
     )
 
 
+def crear_cliente_sesion() -> Client:
+    """
+    Crea un cliente Supabase nuevo con la clave anónima, sin cachear, para operar con la
+    sesión de un único usuario (set_session, refresh_session, sign_out). El cliente de
+    get_supabase() es compartido por todas las sesiones y no debe guardar tokens de nadie.
+    """
+    return create_client(
+        st.secrets["SUPABASE_URL"],
+        st.secrets["SUPABASE_ANON_KEY"]
+    )
+
+
 def get_admin_client() -> Client:
     """
     Obtiene el cliente Supabase con la clave de servicio (para operaciones admin).
@@ -25,3 +37,48 @@ def get_admin_client() -> Client:
         st.secrets["SUPABASE_URL"],
         st.secrets["SUPABASE_SERVICE_ROLE_KEY"]
     )
+
+
+def paginar_keyset(query, tamano: int = 50, cursor: tuple = None,
+                   columna_fecha: str = 'fecha', columna_id: str = 'id') -> dict:
+    """
+    Pagina una consulta de Supabase por clave (columna_fecha, columna_id) descendente.
+    Cada página cuesta O(tamano) gracias al índice sobre (columna_fecha, columna_id),
+    sin importar cuántas filas tenga la tabla ni en qué página estemos.
+    Las filas con columna_fecha NULL van al final, ordenadas solo por columna_id.
+
+    query: función sin argumentos que devuelve la consulta ya filtrada
+           (lambda: client.table(...).select(...).eq(...)), sin order ni limit.
+    cursor: (fecha, id) de la última fila de la página anterior, (None, id) dentro de las
+            filas sin fecha, o None para la primera.
+    Retorna {'filas': [...], 'cursor': cursor de la siguiente página o None si no hay más}.
+    """
+    filas = []
+    if cursor is None or cursor[0] is not None:
+        consulta = query().not_.is_(columna_fecha, 'null')
+        if cursor:
+            fecha, ident = cursor
+            consulta = consulta.or_(
+                f'{columna_fecha}.lt."{fecha}",'
+                f'and({columna_fecha}.eq."{fecha}",{columna_id}.lt."{ident}")'
+            )
+        filas = consulta.order(columna_fecha, desc=True).order(columna_id, desc=True) \
+            .limit(tamano + 1).execute().data or []
+        if len(filas) > tamano:
+            ultima = filas[tamano - 1]
+            return {'filas': filas[:tamano], 'cursor': (ultima[columna_fecha], ultima[columna_id])}
+        desde_id = None
+    else:
+        desde_id = cursor[1]
+
+    # Filas sin fecha: el filtro por fecha no las alcanza (fecha.lt."None"), se siguen por id
+    consulta = query().is_(columna_fecha, 'null')
+    if desde_id is not None:
+        consulta = consulta.lt(columna_id, desde_id)
+    hueco = tamano - len(filas)
+    sin_fecha = consulta.order(columna_id, desc=True).limit(hueco + 1).execute().data or []
+
+    siguiente = None
+    if len(sin_fecha) > hueco:
+        siguiente = (None, sin_fecha[hueco - 1][columna_id] if hueco else None)
+    return {'filas': filas + sin_fecha[:hueco], 'cursor': siguiente}
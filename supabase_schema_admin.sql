@@ -0,0 +1,64 @@
+-- =============================================
+-- ÍNDICES Y AMPLIACIONES PARA TABLAS DE ADMINISTRACIÓN
+-- (usuarios, permisos_seccion, log_accesos)
+-- Ejecutar en Supabase SQL Editor
+-- =============================================
+
+-- Paginación por clave (fecha, id) en el panel de administración
+CREATE INDEX IF NOT EXISTS idx_log_accesos_timestamp_id ON log_accesos(timestamp DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_usuarios_fecha_registro_id ON usuarios(fecha_registro DESC, id DESC);
+
+-- Identificador de escritura de la cola diferida (reintentos sin duplicados)
+ALTER TABLE log_accesos ADD COLUMN IF NOT EXISTS id_escritura UUID UNIQUE;
+
+-- Resumen del log de accesos por hora y por día (usado por ver_log_accesos)
+-- Se mantiene en cada inserción; las gráficas del panel no leen el log completo
+CREATE TABLE IF NOT EXISTS log_accesos_resumen (
+    granularidad TEXT NOT NULL CHECK (granularidad IN ('hora', 'dia')),
+    periodo TIMESTAMPTZ NOT NULL,
+    usuario_id UUID NOT NULL,
+    seccion TEXT NOT NULL DEFAULT '',
+    accion TEXT NOT NULL,
+    total BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (granularidad, periodo, usuario_id, seccion, accion)
+);
+
+ALTER TABLE log_accesos_resumen ENABLE ROW LEVEL SECURITY;
+CREATE POLICY "Allow all for service role" ON log_accesos_resumen FOR ALL USING (true);
+
+-- Un trigger por sentencia: cada lote de la cola de escritura se agrega de una vez.
+-- Las filas descartadas por ON CONFLICT (reintentos) no llegan a la tabla de transición.
+CREATE OR REPLACE FUNCTION acumular_log_accesos()
+RETURNS TRIGGER LANGUAGE plpgsql AS $$
+BEGIN
+    INSERT INTO log_accesos_resumen (granularidad, periodo, usuario_id, seccion, accion, total)
+    SELECT g.granularidad,
+           date_trunc(CASE g.granularidad WHEN 'hora' THEN 'hour' ELSE 'day' END, n.timestamp),
+           n.usuario_id, COALESCE(n.seccion, ''), n.accion, COUNT(*)
+    FROM nuevas n
+    CROSS JOIN (VALUES ('hora'), ('dia')) AS g(granularidad)
+    WHERE n.usuario_id IS NOT NULL
+    GROUP BY 1, 2, 3, 4, 5
+    ON CONFLICT (granularidad, periodo, usuario_id, seccion, accion)
+        DO UPDATE SET total = log_accesos_resumen.total + EXCLUDED.total;
+    RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS trg_resumen_log_accesos ON log_accesos;
+CREATE TRIGGER trg_resumen_log_accesos AFTER INSERT ON log_accesos
+    REFERENCING NEW TABLE AS nuevas
+    FOR EACH STATEMENT EXECUTE FUNCTION acumular_log_accesos();
+
+CREATE INDEX IF NOT EXISTS idx_log_accesos_resumen_periodo ON log_accesos_resumen(granularidad, periodo);
+
+-- Carga inicial con el histórico. Recalcula desde el log completo: se puede repetir
+INSERT INTO log_accesos_resumen (granularidad, periodo, usuario_id, seccion, accion, total)
+SELECT g.granularidad,
+       date_trunc(CASE g.granularidad WHEN 'hora' THEN 'hour' ELSE 'day' END, l.timestamp),
+       l.usuario_id, COALESCE(l.seccion, ''), l.accion, COUNT(*)
+FROM log_accesos l
+CROSS JOIN (VALUES ('hora'), ('dia')) AS g(granularidad)
+WHERE l.usuario_id IS NOT NULL
+GROUP BY 1, 2, 3, 4, 5
+ON CONFLICT (granularidad, periodo, usuario_id, seccion, accion) DO UPDATE SET total = EXCLUDED.total;
@@ -57,6 +57,12 @@ CREATE TABLE IF NOT EXISTS vehiculos_competencia (
     fecha_actualizacion TIMESTAMPTZ DEFAULT NOW()
 );
 
+-- Clave de origen de las filas migradas desde SQLite ('tabla:id'): permite repetir la
+-- migración sin duplicar filas que no tienen clave natural (ver migrar_competencia.py).
+-- En vehiculos_competencia solo la llevan los vehículos sin matrícula.
+ALTER TABLE cotizaciones_competencia ADD COLUMN IF NOT EXISTS clave_migracion TEXT UNIQUE;
+ALTER TABLE vehiculos_competencia ADD COLUMN IF NOT EXISTS clave_migracion TEXT UNIQUE;
+
 -- Índices para mejor rendimiento
 CREATE INDEX IF NOT EXISTS idx_competidores_nombre ON competidores(nombre);
 CREATE INDEX IF NOT EXISTS idx_competidores_activo ON competidores(activo);
@@ -65,6 +71,65 @@ CREATE INDEX IF NOT EXISTS idx_cotizaciones_tipo ON cotizaciones_competencia(tip
 CREATE INDEX IF NOT EXISTS idx_vehiculos_competidor ON vehiculos_competencia(competidor_id);
 CREATE INDEX IF NOT EXISTS idx_vehiculos_activo ON vehiculos_competencia(activo);
 
+-- Clave natural de un vehículo: una matrícula por competidor (importación idempotente,
+-- ver importar_vehiculos_masivo). Los NULL no chocan entre sí: se admiten vehículos sin matrícula.
+UPDATE vehiculos_competencia
+SET matricula = UPPER(REGEXP_REPLACE(matricula, '[\s-]', '', 'g'))
+WHERE matricula IS NOT NULL AND matricula <> UPPER(REGEXP_REPLACE(matricula, '[\s-]', '', 'g'));
+-- Si el índice falla por duplicados previos, localizarlos con:
+--   SELECT competidor_id, matricula, COUNT(*) FROM vehiculos_competencia
+--   WHERE matricula IS NOT NULL GROUP BY 1, 2 HAVING COUNT(*) > 1;
+CREATE UNIQUE INDEX IF NOT EXISTS idx_vehiculos_competidor_matricula
+    ON vehiculos_competencia(competidor_id, matricula);
+
+-- Resumen de flota por competidor (usado por obtener_estadisticas_flota_competencia)
+CREATE OR REPLACE VIEW v_estadisticas_flota AS
+SELECT
+    c.id AS competidor_id,
+    c.nombre AS competidor,
+    COUNT(v.id) AS total_vehiculos,
+    COUNT(v.id) FILTER (WHERE COALESCE(v.plazas, 0) >= 50) AS buses_grandes,
+    COUNT(v.id) FILTER (WHERE COALESCE(v.plazas, 0) >= 30 AND COALESCE(v.plazas, 0) < 50) AS buses_medianos,
+    COUNT(v.id) FILTER (WHERE COALESCE(v.plazas, 0) < 30) AS microbuses,
+    ROUND(AVG(NULLIF(v.edad, 0)), 1) AS edad_media,
+    COALESCE(SUM(v.plazas), 0) AS capacidad_total,
+    COUNT(v.id) FILTER (WHERE v.pmr) AS con_pmr,
+    COUNT(v.id) FILTER (WHERE v.wc) AS con_wc,
+    COUNT(v.id) FILTER (WHERE v.wifi) AS con_wifi,
+    COUNT(v.id) FILTER (WHERE v.escolar) AS escolares
+FROM competidores c
+LEFT JOIN vehiculos_competencia v ON v.competidor_id = c.id AND v.activo
+WHERE c.activo
+GROUP BY c.id, c.nombre;
+
+CREATE INDEX IF NOT EXISTS idx_vehiculos_competidor_activo ON vehiculos_competencia(competidor_id) WHERE activo;
+
+-- Borrado de un competidor con sus vehículos y cotizaciones en una sola transacción
+-- (usado por eliminar_competidor). Retorna cuántos dependientes se han borrado.
+CREATE OR REPLACE FUNCTION eliminar_competidor(p_competidor_id BIGINT)
+RETURNS TABLE (eliminado BOOLEAN, cotizaciones BIGINT, vehiculos BIGINT)
+LANGUAGE plpgsql AS $$
+DECLARE
+    v_cotizaciones BIGINT;
+    v_vehiculos BIGINT;
+BEGIN
+    -- Bloquea el competidor para que nadie le añada datos mientras se borra
+    PERFORM 1 FROM competidores WHERE id = p_competidor_id FOR UPDATE;
+    IF NOT FOUND THEN
+        RETURN QUERY SELECT false, 0::BIGINT, 0::BIGINT;
+        RETURN;
+    END IF;
+
+    DELETE FROM cotizaciones_competencia WHERE competidor_id = p_competidor_id;
+    GET DIAGNOSTICS v_cotizaciones = ROW_COUNT;
+    DELETE FROM vehiculos_competencia WHERE competidor_id = p_competidor_id;
+    GET DIAGNOSTICS v_vehiculos = ROW_COUNT;
+    DELETE FROM competidores WHERE id = p_competidor_id;
+
+    RETURN QUERY SELECT true, v_cotizaciones, v_vehiculos;
+END;
+$$;
+
 -- Habilitar RLS (Row Level Security)
 ALTER TABLE competidores ENABLE ROW LEVEL SECURITY;
 ALTER TABLE cotizaciones_competencia ENABLE ROW LEVEL SECURITY;
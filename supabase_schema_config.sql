@@ -16,6 +16,64 @@ CREATE TABLE IF NOT EXISTS notas (
 );
 CREATE INDEX IF NOT EXISTS idx_notas_cliente ON notas(cliente);
 CREATE INDEX IF NOT EXISTS idx_notas_presupuesto ON notas(cod_presupuesto);
+CREATE INDEX IF NOT EXISTS idx_notas_fecha_id ON notas(fecha DESC, id DESC);
+
+-- Identificador de escritura de la cola diferida (reintentos sin duplicados)
+ALTER TABLE notas ADD COLUMN IF NOT EXISTS id_escritura UUID UNIQUE;
+
+-- Clave de origen de las notas migradas desde crm_notas.db (ver migrar_competencia.py)
+ALTER TABLE notas ADD COLUMN IF NOT EXISTS clave_migracion TEXT UNIQUE;
+
+-- Búsqueda de texto completo en notas (contenido, cliente y presupuesto)
+-- unaccent no es IMMUTABLE: se envuelve para poder usarlo en columnas generadas
+CREATE EXTENSION IF NOT EXISTS unaccent;
+CREATE OR REPLACE FUNCTION f_unaccent(TEXT)
+RETURNS TEXT LANGUAGE sql IMMUTABLE PARALLEL SAFE STRICT AS $$
+    SELECT public.unaccent('public.unaccent', $1);
+$$;
+
+ALTER TABLE notas ADD COLUMN IF NOT EXISTS busqueda TSVECTOR
+    GENERATED ALWAYS AS (
+        setweight(to_tsvector('spanish', f_unaccent(COALESCE(contenido, ''))), 'A') ||
+        setweight(to_tsvector('spanish', f_unaccent(COALESCE(cliente, ''))), 'B') ||
+        setweight(to_tsvector('spanish', COALESCE(cod_presupuesto, '')), 'B')
+    ) STORED;
+CREATE INDEX IF NOT EXISTS idx_notas_busqueda ON notas USING GIN (busqueda);
+
+-- Resultados por relevancia con paginación por cursor (rank, id)
+CREATE OR REPLACE FUNCTION buscar_notas_fts(
+    p_termino TEXT,
+    p_limite INTEGER DEFAULT 50,
+    p_cursor_rank REAL DEFAULT NULL,
+    p_cursor_id BIGINT DEFAULT NULL
+)
+RETURNS TABLE (
+    id BIGINT, cod_presupuesto TEXT, cliente TEXT, fecha TIMESTAMPTZ,
+    usuario TEXT, contenido TEXT, tipo TEXT, rank REAL
+)
+LANGUAGE sql STABLE AS $$
+    WITH resultados AS (
+        SELECT n.id, n.cod_presupuesto, n.cliente, n.fecha, n.usuario, n.contenido, n.tipo,
+               ts_rank_cd(n.busqueda, q.consulta)::REAL AS rank
+        FROM notas n,
+             websearch_to_tsquery('spanish', f_unaccent(p_termino)) AS q(consulta)
+        WHERE n.busqueda @@ q.consulta
+    )
+    SELECT * FROM resultados r
+    WHERE p_cursor_rank IS NULL OR (r.rank, r.id) < (p_cursor_rank, p_cursor_id)
+    ORDER BY r.rank DESC, r.id DESC
+    LIMIT p_limite;
+$$;
+
+-- Conteo de notas por cliente (agregado en servidor, usado por contar_notas_por_cliente)
+CREATE OR REPLACE FUNCTION contar_notas_por_cliente(p_clientes TEXT[] DEFAULT NULL)
+RETURNS TABLE (cliente TEXT, total BIGINT)
+LANGUAGE sql STABLE AS $$
+    SELECT n.cliente, COUNT(*)::BIGINT AS total
+    FROM notas n
+    WHERE p_clientes IS NULL OR n.cliente = ANY(p_clientes)
+    GROUP BY n.cliente;
+$$;
 
 -- Tabla de tipos de servicio
 CREATE TABLE IF NOT EXISTS tipos_servicio (
@@ -0,0 +1,95 @@
+-- =============================================
+-- SINCRONIZACIÓN INCREMENTAL DE TABLAS DE REFERENCIA
+-- Usado por espejo_local.py (réplica SQLite en cada servidor)
+-- y por invalidacion.py (limpieza de cachés entre procesos)
+-- Ejecutar en Supabase SQL Editor después de los demás esquemas
+-- =============================================
+
+-- Versión por tabla: se incrementa en cada INSERT/UPDATE/DELETE
+CREATE TABLE IF NOT EXISTS versiones_tablas (
+    tabla TEXT PRIMARY KEY,
+    version BIGINT NOT NULL DEFAULT 0,
+    fecha_actualizacion TIMESTAMPTZ DEFAULT NOW()
+);
+
+ALTER TABLE versiones_tablas ENABLE ROW LEVEL SECURITY;
+CREATE POLICY "Allow all for service role" ON versiones_tablas FOR ALL USING (true);
+
+CREATE OR REPLACE FUNCTION incrementar_version_tabla()
+RETURNS TRIGGER LANGUAGE plpgsql AS $$
+BEGIN
+    INSERT INTO versiones_tablas (tabla, version, fecha_actualizacion)
+    VALUES (TG_TABLE_NAME, 1, NOW())
+    ON CONFLICT (tabla) DO UPDATE
+        SET version = versiones_tablas.version + 1,
+            fecha_actualizacion = NOW();
+    RETURN NULL;
+END;
+$$;
+
+-- Marca de tiempo de la última modificación de cada fila (para traer solo el delta).
+-- La pone siempre el servidor, también al insertar: una hora enviada por el cliente
+-- (reloj desfasado) podría quedar detrás de la marca de agua del espejo y perderse.
+CREATE OR REPLACE FUNCTION tocar_fecha_actualizacion()
+RETURNS TRIGGER LANGUAGE plpgsql AS $$
+BEGIN
+    NEW.fecha_actualizacion = NOW();
+    RETURN NEW;
+END;
+$$;
+
+-- Añade columna, índice y triggers a cada tabla de referencia
+DO $$
+DECLARE
+    t TEXT;
+BEGIN
+    FOREACH t IN ARRAY ARRAY[
+        'tipos_servicio', 'tipos_bus', 'tipos_cliente', 'temporadas',
+        'tarifas_servicio', 'tarifas_cliente', 'comisiones_tramos', 'bonus_objetivos',
+        'puntos_acciones', 'puntos_premios', 'competidores'
+    ]
+    LOOP
+        EXECUTE format('ALTER TABLE %I ADD COLUMN IF NOT EXISTS fecha_actualizacion TIMESTAMPTZ DEFAULT NOW()', t);
+        EXECUTE format('CREATE INDEX IF NOT EXISTS %I ON %I (fecha_actualizacion)', 'idx_' || t || '_fecha_act', t);
+
+        EXECUTE format('DROP TRIGGER IF EXISTS trg_fecha_actualizacion ON %I', t);
+        EXECUTE format('CREATE TRIGGER trg_fecha_actualizacion BEFORE INSERT OR UPDATE ON %I
+                        FOR EACH ROW EXECUTE FUNCTION tocar_fecha_actualizacion()', t);
+
+        EXECUTE format('DROP TRIGGER IF EXISTS trg_version_tabla ON %I', t);
+        EXECUTE format('CREATE TRIGGER trg_version_tabla AFTER INSERT OR UPDATE OR DELETE ON %I
+                        FOR EACH STATEMENT EXECUTE FUNCTION incrementar_version_tabla()', t);
+
+        INSERT INTO versiones_tablas (tabla, version) VALUES (t, 1) ON CONFLICT (tabla) DO NOTHING;
+    END LOOP;
+END;
+$$;
+
+-- vehiculos_competencia no se espeja, pero su fecha_actualizacion también la pone el
+-- servidor (db_competencia.py no la envía)
+DROP TRIGGER IF EXISTS trg_fecha_actualizacion ON vehiculos_competencia;
+CREATE TRIGGER trg_fecha_actualizacion BEFORE INSERT OR UPDATE ON vehiculos_competencia
+    FOR EACH ROW EXECUTE FUNCTION tocar_fecha_actualizacion();
+
+-- Tablas que no se espejan pero cuyas cachés se invalidan entre procesos (invalidacion.py)
+DO $$
+DECLARE
+    t TEXT;
+BEGIN
+    FOREACH t IN ARRAY ARRAY['notas', 'vehiculos_competencia', 'cotizaciones_competencia', 'permisos_seccion']
+    LOOP
+        EXECUTE format('DROP TRIGGER IF EXISTS trg_version_tabla ON %I', t);
+        EXECUTE format('CREATE TRIGGER trg_version_tabla AFTER INSERT OR UPDATE OR DELETE ON %I
+                        FOR EACH STATEMENT EXECUTE FUNCTION incrementar_version_tabla()', t);
+
+        INSERT INTO versiones_tablas (tabla, version) VALUES (t, 1) ON CONFLICT (tabla) DO NOTHING;
+    END LOOP;
+END;
+$$;
+
+-- usuarios: solo los cambios que afectan a la sesión (activo, rol), no las escrituras de
+-- ultimo_acceso, invalidan las sesiones verificadas que auth.py guarda en cada proceso
+DROP TRIGGER IF EXISTS trg_version_tabla ON usuarios;
+CREATE TRIGGER trg_version_tabla AFTER INSERT OR DELETE OR UPDATE OF activo, rol ON usuarios
+    FOR EACH STATEMENT EXECUTE FUNCTION incrementar_version_tabla();
+INSERT INTO versiones_tablas (tabla, version) VALUES ('usuarios', 1) ON CONFLICT (tabla) DO NOTHING;
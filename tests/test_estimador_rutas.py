@@ -0,0 +1,103 @@
+"""
+Pruebas del estimador de rutas sin servicio de rutas (todo en local, sin red)
+"""
+import pytest
+
+from estimador_rutas import (
+    EstimadorRutas, FACTOR_RODEO_DEFECTO, VELOCIDADES_DEFECTO, PESO_PREVIO,
+    MINIMO_KM_CALIBRACION, distancia_recta_km, region
+)
+from geometria import decodificar_polilinea
+
+# Dos regiones de la rejilla de 0.5° (Donostia y Bilbao)
+DONOSTIA = (43.30, -1.98)
+BILBAO = (43.26, -2.93)
+
+KM_POR_GRADO_LAT = 111.195
+
+
+def trayecto(inicio, km_recta):
+    """Dos puntos separados km_recta en línea recta hacia el norte."""
+    return [inicio, (inicio[0] + km_recta / KM_POR_GRADO_LAT, inicio[1])]
+
+
+def muestra(inicio, km_recta, factor, velocidad_kmh=60.0):
+    puntos = trayecto(inicio, km_recta)
+    distancia = distancia_recta_km(puntos) * factor
+    return puntos, distancia, distancia / velocidad_kmh * 60
+
+
+def test_sin_muestras_usa_valores_por_defecto():
+    estimador = EstimadorRutas().calibrar([])
+
+    assert estimador.muestras == 0
+    assert estimador.factor_global == FACTOR_RODEO_DEFECTO
+    assert estimador.velocidades == list(VELOCIDADES_DEFECTO)
+    assert estimador.factor_rodeo(trayecto(DONOSTIA, 20)) == pytest.approx(FACTOR_RODEO_DEFECTO)
+
+
+def test_factor_de_region_se_acerca_al_global_con_pocas_muestras():
+    muestras = [muestra(DONOSTIA, 20, 1.6) for _ in range(5)] + [muestra(BILBAO, 20, 1.2) for _ in range(45)]
+    estimador = EstimadorRutas().calibrar(muestras)
+
+    assert estimador.factor_global == pytest.approx(1.2)
+    # 5 muestras propias pesan lo mismo que PESO_PREVIO del global
+    assert estimador.factor_rodeo(trayecto(DONOSTIA, 20)) == pytest.approx((1.6 * 5 + 1.2 * PESO_PREVIO) / (5 + PESO_PREVIO))
+    assert estimador.factor_rodeo(trayecto(BILBAO, 20)) == pytest.approx(1.2)
+    # Región sin muestras: el global
+    assert estimador.factor_rodeo(trayecto((40.42, -3.70), 20)) == pytest.approx(1.2)
+
+
+def test_descarta_muestras_fuera_de_rango_o_demasiado_cortas():
+    puntos = trayecto(DONOSTIA, 20)
+    recta = distancia_recta_km(puntos)
+    descartadas = [
+        (puntos, recta * 3.5, 30),                               # factor por encima de RANGO_FACTOR
+        (puntos, recta * 0.9, 30),                               # menos que la línea recta
+        muestra(DONOSTIA, MINIMO_KM_CALIBRACION / 2, 1.3),       # trayecto urbano demasiado corto
+        (puntos, 0, 30),                                         # sin distancia
+        (puntos[:1], 10, 30),                                    # un solo punto
+    ]
+    estimador = EstimadorRutas().calibrar(descartadas)
+
+    assert estimador.muestras == 0
+    assert estimador.factor_global == FACTOR_RODEO_DEFECTO
+    assert estimador.velocidades == list(VELOCIDADES_DEFECTO)
+
+    estimador.calibrar(descartadas + [muestra(DONOSTIA, 20, 1.4)])
+    assert estimador.muestras == 1
+    assert estimador.factor_global == pytest.approx(1.4)
+
+
+def test_velocidad_por_tramo_de_distancia():
+    # Trayectos cortos (< 10 km) a 30 km/h y largos (> 80 km) a 90 km/h
+    muestras = [muestra(DONOSTIA, 5, 1.3, 30.0) for _ in range(3)] + [muestra(DONOSTIA, 100, 1.3, 90.0) for _ in range(3)]
+    estimador = EstimadorRutas().calibrar(muestras)
+
+    assert estimador.velocidades[0] == pytest.approx(30.0)
+    assert estimador.velocidades[3] == pytest.approx(90.0)
+    # Tramos sin muestras conservan el valor por defecto
+    assert estimador.velocidades[1:3] == list(VELOCIDADES_DEFECTO[1:3])
+
+    corta = estimador.estimar(trayecto(DONOSTIA, 5))
+    assert corta['duracion_min'] == pytest.approx(round(corta['distancia_km'] / 30.0 * 60), abs=1)
+    larga = estimador.estimar(trayecto(DONOSTIA, 100))
+    assert larga['duracion_min'] == pytest.approx(round(larga['distancia_km'] / 90.0 * 60), abs=1)
+
+
+def test_estimar_marca_estimado_y_codifica_los_puntos():
+    puntos = [DONOSTIA, (43.28, -2.20), BILBAO]
+    ruta = EstimadorRutas().estimar(puntos)
+
+    assert ruta['estimado'] is True
+    assert ruta['distancia_km'] == pytest.approx(distancia_recta_km(puntos) * FACTOR_RODEO_DEFECTO, abs=0.05)
+    decodificados = decodificar_polilinea(ruta['polilinea'])
+    assert len(decodificados) == len(puntos)
+    for (lat, lon), (lat_orig, lon_orig) in zip(decodificados, puntos):
+        assert lat == pytest.approx(lat_orig, abs=1e-5)
+        assert lon == pytest.approx(lon_orig, abs=1e-5)
+
+
+def test_estimar_con_menos_de_dos_puntos():
+    assert EstimadorRutas().estimar([DONOSTIA]) is None
+    assert region([DONOSTIA, BILBAO]) == region([BILBAO, DONOSTIA])
@@ -0,0 +1,130 @@
+"""
+Verificación local de los access tokens de Supabase
+Comprueba firma, expiración y audiencia sin llamar al servidor de autenticación.
+HS256 se verifica con la librería estándar (hmac) y el JWT secret del proyecto;
+RS256/ES256 (claves JWKS) usan PyJWT[crypto] (en requirements.txt).
+"""
+import base64
+import hashlib
+import hmac
+import json
+import time
+
+# Audiencia de los tokens de usuarios autenticados en Supabase
+AUDIENCIA = 'authenticated'
+
+# Segundos de tolerancia por desfase de reloj con el servidor
+TOLERANCIA_RELOJ = 30
+
+# Segundos antes de la expiración a partir de los cuales conviene refrescar el token
+MARGEN_REFRESCO = 120
+
+ALGORITMOS_ASIMETRICOS = ('RS256', 'ES256')
+
+
+class TokenInvalido(Exception):
+    """Firma, formato o audiencia incorrectos: hay que volver a iniciar sesión."""
+
+
+class TokenExpirado(TokenInvalido):
+    """Token caducado: se puede recuperar con el refresh token."""
+
+
+class VerificacionNoDisponible(Exception):
+    """No hay secreto ni clave pública para verificar en local: usar el servidor de auth."""
+
+
+def _b64url_decode(texto: str) -> bytes:
+    return base64.urlsafe_b64decode(texto + '=' * (-len(texto) % 4))
+
+
+def _b64url_encode(datos: bytes) -> str:
+    return base64.urlsafe_b64encode(datos).rstrip(b'=').decode()
+
+
+def firmar_token_hs256(claims: dict, secreto: str) -> str:
+    """Genera un JWT HS256 (para pruebas y desarrollo sin Supabase)."""
+    cabecera = _b64url_encode(json.dumps({'alg': 'HS256', 'typ': 'JWT'}, separators=(',', ':')).encode())
+    payload = _b64url_encode(json.dumps(claims, separators=(',', ':')).encode())
+    firma = hmac.new(secreto.encode(), f"{cabecera}.{payload}".encode(), hashlib.sha256).digest()
+    return f"{cabecera}.{payload}.{_b64url_encode(firma)}"
+
+
+def _verificar_firma_asimetrica(token: str, algoritmo: str, kid: str, obtener_clave_publica):
+    try:
+        import jwt
+    except ImportError:
+        raise VerificacionNoDisponible("PyJWT no está instalado")
+    try:
+        jwt.decode(token, obtener_clave_publica(kid), algorithms=[algoritmo],
+                   options={'verify_exp': False, 'verify_aud': False})
+    except jwt.InvalidTokenError as e:
+        raise TokenInvalido(f"Firma no válida: {e}")
+
+
+def verificar_token(token: str, secreto: str = None, obtener_clave_publica=None,
+                    audiencia: str = AUDIENCIA, ahora: float = None) -> dict:
+    """
+    Verifica un access token y retorna sus claims.
+    secreto: JWT secret del proyecto (tokens HS256).
+    obtener_clave_publica(kid): clave pública para tokens RS256/ES256 (ver crear_obtener_clave_jwks).
+    Lanza TokenExpirado, TokenInvalido o VerificacionNoDisponible.
+    """
+    partes = (token or '').split('.')
+    if len(partes) != 3:
+        raise TokenInvalido("Formato de token no válido")
+    try:
+        cabecera = json.loads(_b64url_decode(partes[0]))
+        claims = json.loads(_b64url_decode(partes[1]))
+        firma = _b64url_decode(partes[2])
+    except ValueError:
+        raise TokenInvalido("Token mal codificado")
+
+    algoritmo = cabecera.get('alg')
+    if algoritmo == 'HS256':
+        if not secreto:
+            raise VerificacionNoDisponible("Falta SUPABASE_JWT_SECRET")
+        esperada = hmac.new(secreto.encode(), f"{partes[0]}.{partes[1]}".encode(), hashlib.sha256).digest()
+        if not hmac.compare_digest(esperada, firma):
+            raise TokenInvalido("Firma no válida")
+    elif algoritmo in ALGORITMOS_ASIMETRICOS:
+        if obtener_clave_publica is None:
+            raise VerificacionNoDisponible("No hay JWKS configurado")
+        _verificar_firma_asimetrica(token, algoritmo, cabecera.get('kid'), obtener_clave_publica)
+    else:
+        raise TokenInvalido(f"Algoritmo no admitido: {algoritmo}")
+
+    ahora = time.time() if ahora is None else ahora
+    if 'exp' not in claims or claims['exp'] + TOLERANCIA_RELOJ < ahora:
+        raise TokenExpirado("Token expirado")
+    if claims.get('nbf') and claims['nbf'] - TOLERANCIA_RELOJ > ahora:
+        raise TokenInvalido("Token aún no válido")
+
+    if audiencia:
+        aud = claims.get('aud')
+        audiencias = aud if isinstance(aud, list) else [aud]
+        if audiencia not in audiencias:
+            raise TokenInvalido(f"Audiencia no válida: {aud}")
+
+    if not claims.get('sub'):
+        raise TokenInvalido("Token sin usuario")
+    return claims
+
+
+def necesita_refresco(claims: dict, margen: float = MARGEN_REFRESCO, ahora: float = None) -> bool:
+    """True si el token expira dentro del margen."""
+    ahora = time.time() if ahora is None else ahora
+    return claims.get('exp', 0) - ahora < margen
+
+
+def crear_obtener_clave_jwks(url_jwks: str):
+    """
+    Retorna una función kid -> clave pública que consulta (y cachea) el JWKS del proyecto.
+    None si PyJWT no está instalado.
+    """
+    try:
+        from jwt import PyJWKClient
+    except ImportError:
+        return None
+    cliente = PyJWKClient(url_jwks, cache_keys=True)
+    return lambda kid: cliente.get_signing_key(kid).key